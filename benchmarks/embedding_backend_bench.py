@@ -0,0 +1,80 @@
+"""
+Compares the inference backends of an embedder (see EMBEDDING_BACKENDS) on
+the RISC-V corpus of the riscv-rag example, on the CPU:
+1. Parity: the cosine similarity of every vector with the vector the torch
+   backend gives for the same text (the minimum and the mean).
+2. Throughput: the texts per second when embedding the whole sample.
+3. Latency: the p50 and p95 of embedding a single text, like a query.
+
+The embedding cache is bypassed, so every pass runs the model. The first
+run of an ONNX backend exports (and quantizes) the model to the cache
+directory, which is not timed. --synthetic and --random-layers replace the
+corpus and the weights of the embedder, like in embedding_bench.py.
+
+Usage: python benchmarks/embedding_backend_bench.py [--embedder ember]
+          [--limit 512] [--queries 64]
+          [--backends torch onnx onnx-int8]
+          [--synthetic] [--random-layers 4]
+"""
+
+import os, sys, time, argparse
+
+# Add the root of the repo to the path
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(root)
+import numpy as np
+import lib as lp
+from embedding_bench import (
+   load_corpus, synthetic_corpus, register_random_ember
+)
+
+def load_embedder(name: str, backend: str):
+   from lib.embedders import EmberV1Embedder, BgeLLMEmbedder
+   if name == 'ember':
+      return EmberV1Embedder(backend=backend)
+   return BgeLLMEmbedder(backend=backend)
+
+def percentile(values: list[float], p: float) -> float:
+   return float(np.percentile(np.array(values), p))
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--embedder', choices=['ember', 'bge'], default='ember')
+   parser.add_argument('--limit', type=int, default=512)
+   parser.add_argument('--queries', type=int, default=64)
+   parser.add_argument('--backends', nargs='+',
+                       choices=lp.EMBEDDING_BACKENDS,
+                       default=list(lp.EMBEDDING_BACKENDS))
+   parser.add_argument('--synthetic', action='store_true')
+   parser.add_argument('--random-layers', type=int, default=None)
+   args = parser.parse_args()
+   if args.random_layers is not None:
+      if args.embedder != 'ember':
+         sys.exit('--random-layers only supports the ember embedder')
+      register_random_ember(args.random_layers)
+   texts = synthetic_corpus(args.limit) if args.synthetic \
+      else load_corpus(args.limit)
+   queries = texts[:args.queries]
+   print(f'{len(texts)} texts, {len(queries)} single-text queries')
+   reference = load_embedder(args.embedder, 'torch').run_model(texts)
+   for backend in args.backends:
+      embedder = load_embedder(args.embedder, backend)
+      # Warm up the backend once
+      embedder.run_model(queries[:8])
+      start = time.perf_counter()
+      vectors = embedder.run_model(texts)
+      elapsed = time.perf_counter() - start
+      latencies: list[float] = []
+      for query in queries:
+         start = time.perf_counter()
+         embedder.run_model([query])
+         latencies.append(time.perf_counter() - start)
+      # The vectors are normalized, so the dot product is the cosine
+      cosine = (vectors * reference).sum(axis=1)
+      print(f'{backend:>9}: {len(texts) / elapsed:8.1f} texts/s, '
+            f'p50 {percentile(latencies, 50) * 1000:7.2f}ms, '
+            f'p95 {percentile(latencies, 95) * 1000:7.2f}ms, '
+            f'cosine min {cosine.min():.4f} mean {cosine.mean():.4f}')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,155 @@
+"""
+Benchmarks the CPU embedding throughput on the RISC-V corpus of the
+riscv-rag example (the chunks build_embeddings embeds), comparing batches
+formed in document order (padded to their longest member) with batches
+bucketed by tokenized length under token budgets (see bucket_by_length).
+
+The embedding cache is bypassed, so every pass runs the model over every
+text. The padding efficiency is the share of the padded batch that is made
+of real tokens.
+
+The corpus is generated by the scripts in plugins/examples/riscv-rag/data,
+which write output_tokens_combined.json. Without it (or without the
+weights of the embedder), --synthetic embeds texts of random words with
+log-normal lengths instead, and --random-layers serves a random BERT with
+the architecture of ember-v1 (and the given number of layers) as the
+embedder, with a word tokenizer.
+
+Usage: python benchmarks/embedding_bench.py [--embedder ember]
+          [--limit 2048] [--batch-size 64] [--budgets 4096 8192 16384]
+          [--synthetic] [--random-layers 4]
+"""
+
+import os, sys, json, time, random, argparse
+
+# Add the root of the repo to the path
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(root)
+import lib as lp
+
+CORPUS = os.path.join(
+   root, 'plugins', 'examples', 'riscv-rag', 'data',
+   'output_tokens_combined.json')
+
+def load_corpus(limit: int | None) -> list[str]:
+   """ Loads the texts of the corpus, the same way build_embeddings does. """
+   if not os.path.isfile(CORPUS):
+      sys.exit(f'{CORPUS} not found, generate it with the scripts in '
+               f'{os.path.dirname(CORPUS)} first')
+   with open(CORPUS, 'r') as f:
+      document = json.load(f)
+   texts: list[str] = []
+   for section in document:
+      for subsection in section['sections']:
+         if subsection['type'] in {'code', 'table'}:
+            continue
+         texts.extend(subsection['text'])
+   return texts[:limit] if limit else texts
+
+def synthetic_corpus(limit: int, num_words: int = 1024) -> list[str]:
+   """
+   Texts of random words, whose lengths follow a log-normal distribution
+   (a median of 60 words, up to 510), like chunks of a document.
+   """
+   rng = random.Random(0)
+   texts: list[str] = []
+   for _ in range(limit):
+      length = min(max(int(rng.lognormvariate(4.1, 0.9)), 1), 510)
+      texts.append(' '.join(
+         f'w{rng.randrange(num_words)}' for _ in range(length)))
+   return texts
+
+def register_random_ember(num_layers: int, num_words: int = 1024):
+   """
+   Serves a BERT with random weights and the architecture of ember-v1 (but
+   num_layers layers) as llmrails/ember-v1, with a tokenizer of the words
+   of synthetic_corpus. The cache directory moves to a temporary one, so the
+   ONNX exports of the random model do not replace the ones of ember-v1.
+   """
+   import tempfile, torch, transformers
+   from lib._private import resolver
+   from tokenizers import Tokenizer, models, pre_tokenizers, processors
+   vocab = {'[PAD]': 0, '[UNK]': 1, '[CLS]': 2, '[SEP]': 3}
+   for i in range(num_words):
+      vocab[f'w{i}'] = len(vocab)
+   tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='[UNK]'))
+   tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+   tokenizer.post_processor = processors.TemplateProcessing(
+      single='[CLS] $A [SEP]', special_tokens=[('[CLS]', 2), ('[SEP]', 3)])
+   torch.manual_seed(0)
+   config = transformers.BertConfig(
+      vocab_size=len(vocab), hidden_size=1024, num_hidden_layers=num_layers,
+      num_attention_heads=16, intermediate_size=4096)
+   resolver.cache_dir = tempfile.mkdtemp(prefix='ducky-bench-')
+   lp.register_model(
+      'llmrails/ember-v1', transformers.BertModel(config).eval(),
+      transformers.PreTrainedTokenizerFast(
+         tokenizer_object=tokenizer, pad_token='[PAD]', unk_token='[UNK]',
+         cls_token='[CLS]', sep_token='[SEP]', model_max_length=512))
+
+def load_embedder(name: str):
+   from lib.embedders import EmberV1Embedder, BgeLLMEmbedder
+   if name == 'ember':
+      return EmberV1Embedder(), 512
+   return BgeLLMEmbedder(), None
+
+def padding_efficiency(lengths: list[int], batches: list[list[int]]) -> float:
+   real = sum(lengths)
+   padded = sum(len(b) * max(lengths[i] for i in b) for b in batches)
+   return real / padded if padded > 0 else 1.0
+
+def run_pass(embedder, texts: list[str], batch_size: int,
+             max_tokens: int) -> float:
+   """
+   Embeds the texts in chunks of batch_size (in document order), bucketing
+   each chunk under the max_tokens budget. Returns the elapsed seconds.
+   """
+   embedder.max_batch_tokens = max_tokens
+   start = time.perf_counter()
+   for i in range(0, len(texts), batch_size):
+      embedder.run_model(texts[i:i + batch_size])
+   return time.perf_counter() - start
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--embedder', choices=['ember', 'bge'], default='ember')
+   parser.add_argument('--limit', type=int, default=2048)
+   parser.add_argument('--batch-size', type=int, default=64)
+   parser.add_argument('--budgets', type=int, nargs='+',
+                       default=[4096, 8192, 16384])
+   parser.add_argument('--synthetic', action='store_true')
+   parser.add_argument('--random-layers', type=int, default=None)
+   args = parser.parse_args()
+   if args.random_layers is not None:
+      if args.embedder != 'ember':
+         sys.exit('--random-layers only supports the ember embedder')
+      register_random_ember(args.random_layers)
+   texts = synthetic_corpus(args.limit) if args.synthetic \
+      else load_corpus(args.limit)
+   embedder, max_length = load_embedder(args.embedder)
+   encoded = embedder.tokenizer(
+      texts, max_length=max_length, truncation=max_length is not None)
+   lengths = [len(x) for x in encoded['input_ids']]
+   print(f'{len(texts)} texts, {sum(lengths)} tokens, '
+         f'longest {max(lengths)}, mean {sum(lengths) / len(lengths):.1f}')
+   # Warm up the model once
+   run_pass(embedder, texts[:args.batch_size], args.batch_size, 1 << 30)
+   # Document-order batches of batch_size, as before bucketing
+   order = [list(range(i, min(i + args.batch_size, len(texts))))
+            for i in range(0, len(texts), args.batch_size)]
+   elapsed = run_pass(embedder, texts, args.batch_size, 1 << 30)
+   print(f'document order x{args.batch_size}: '
+         f'{len(texts) / elapsed:8.1f} texts/s, padding efficiency '
+         f'{padding_efficiency(lengths, order):.0%}')
+   baseline = elapsed
+   # Bucketed batches, over all of the texts at once
+   for budget in args.budgets:
+      batches = lp.bucket_by_length(lengths, budget)
+      elapsed = run_pass(embedder, texts, len(texts), budget)
+      print(f'bucketed, {budget:>6} tokens: '
+            f'{len(texts) / elapsed:8.1f} texts/s, padding efficiency '
+            f'{padding_efficiency(lengths, batches):.0%}, '
+            f'{len(batches)} batches, {baseline / elapsed:.2f}x')
+
+if __name__ == '__main__':
+   main()
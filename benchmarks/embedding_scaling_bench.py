@@ -0,0 +1,78 @@
+"""
+Measures how embedding the RISC-V corpus of the riscv-rag example scales
+with the number of worker processes of embed_sharded (the driver of
+build_embeddings), from 1 to --max-workers. Every run starts from an empty
+shard directory, and includes spawning the workers and loading the model,
+like a real build.
+
+The cores are split evenly between the workers unless --threads sets the
+torch threads of every worker. --synthetic and --random-layers replace the
+corpus and the weights of the embedder, like in embedding_bench.py (every
+worker registers the random model).
+
+Usage: python benchmarks/embedding_scaling_bench.py [--embedder ember]
+          [--limit 4096] [--max-workers 8] [--threads 2]
+          [--shard-size 256] [--synthetic] [--random-layers 4]
+"""
+
+import os, sys, time, shutil, argparse, tempfile, functools
+
+# Add the root of the repo to the path
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(root)
+import lib as lp
+from embedding_bench import (
+   load_corpus, synthetic_corpus, register_random_ember
+)
+
+def load_ember():
+   from lib.embedders import EmberV1Embedder
+   return EmberV1Embedder(cache=False).run_model
+
+def load_random_ember(num_layers: int):
+   register_random_ember(num_layers)
+   return load_ember()
+
+def load_bge():
+   from lib.embedders import BgeLLMEmbedder
+   return BgeLLMEmbedder(cache=False).run_model
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--embedder', choices=['ember', 'bge'], default='ember')
+   parser.add_argument('--limit', type=int, default=4096)
+   parser.add_argument('--max-workers', type=int,
+                       default=os.cpu_count() or 1)
+   parser.add_argument('--threads', type=int, default=None)
+   parser.add_argument('--shard-size', type=int, default=256)
+   parser.add_argument('--synthetic', action='store_true')
+   parser.add_argument('--random-layers', type=int, default=None)
+   args = parser.parse_args()
+   texts = synthetic_corpus(args.limit) if args.synthetic \
+      else load_corpus(args.limit)
+   load, dimension = (load_ember, 1024) if args.embedder == 'ember' \
+      else (load_bge, 768)
+   if args.random_layers is not None:
+      if args.embedder != 'ember':
+         sys.exit('--random-layers only supports the ember embedder')
+      load = functools.partial(load_random_ember, args.random_layers)
+   print(f'{len(texts)} texts, {os.cpu_count()} cores, '
+         f'shards of {args.shard_size}')
+   baseline = None
+   for workers in range(1, args.max_workers + 1):
+      directory = tempfile.mkdtemp(prefix='embedding-shards-')
+      try:
+         start = time.perf_counter()
+         lp.embed_sharded(
+            texts, load, dimension, directory, num_workers=workers,
+            num_threads=args.threads, shard_size=args.shard_size)
+         elapsed = time.perf_counter() - start
+      finally:
+         shutil.rmtree(directory, ignore_errors=True)
+      baseline = baseline or elapsed
+      print(f'{workers:>3} workers: {elapsed:8.2f}s, '
+            f'{len(texts) / elapsed:8.1f} texts/s, '
+            f'{baseline / elapsed:.2f}x')
+
+if __name__ == '__main__':
+   main()
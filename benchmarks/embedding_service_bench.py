@@ -0,0 +1,91 @@
+"""
+Measures the latency of embedding queries for concurrent callers, each on
+its own thread and event loop (like the sessions of the server), with and
+without an EmbeddingService:
+1. Direct: every caller runs the model over its own query, so the calls
+   contend for the cores.
+2. Service: the queries of the callers are embedded in shared batches.
+
+Every caller embeds --queries queries (of 4 to 24 random words) one after
+the other. The embedding cache is bypassed. --random-layers serves a random
+model instead of the weights of ember-v1, like in embedding_bench.py.
+
+Usage: python benchmarks/embedding_service_bench.py [--callers 1 4 16]
+          [--queries 8] [--window 0.005] [--random-layers 4]
+"""
+
+import os, sys, time, random, asyncio, argparse, threading
+
+# Add the root of the repo to the path
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(root)
+import numpy as np
+import lib as lp
+from embedding_bench import register_random_ember
+
+def synthetic_queries(limit: int, num_words: int = 1024) -> list[str]:
+   """ Queries of 4 to 24 random words (see register_random_ember). """
+   rng = random.Random(0)
+   return [' '.join(f'w{rng.randrange(num_words)}'
+                    for _ in range(rng.randint(4, 24)))
+           for _ in range(limit)]
+
+def run_callers(num_callers: int, num_queries: int,
+                embed) -> list[float]:
+   """
+   Runs the callers, each on its own thread and event loop, and returns the
+   latency of every query.
+   """
+   queries = synthetic_queries(num_callers * num_queries)
+   latencies: list[float] = []
+   lock = threading.Lock()
+   def caller(i: int):
+      async def run():
+         for query in queries[i::num_callers]:
+            start = time.perf_counter()
+            await embed(query)
+            with lock:
+               latencies.append(time.perf_counter() - start)
+      asyncio.run(run())
+   threads = [threading.Thread(target=caller, args=(i,))
+              for i in range(num_callers)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   return latencies
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--callers', type=int, nargs='+', default=[1, 4, 16])
+   parser.add_argument('--queries', type=int, default=8)
+   parser.add_argument('--window', type=float, default=0.005)
+   parser.add_argument('--random-layers', type=int, default=None)
+   args = parser.parse_args()
+   os.environ['DUCKY_EMBEDDING_CACHE'] = '0'
+   if args.random_layers is not None:
+      register_random_ember(args.random_layers)
+   from lib.embedders import EmberV1Embedder
+   embedder = EmberV1Embedder()
+   # Warm up the model once
+   embedder.run_model(synthetic_queries(4))
+   for num_callers in args.callers:
+      async def direct(query: str):
+         return embedder.run_model([query])
+      service = lp.EmbeddingService(embedder.run_model, window=args.window)
+      async def shared(query: str):
+         return await service.embed([query])
+      for name, embed in [('direct', direct), ('service', shared)]:
+         start = time.perf_counter()
+         latencies = run_callers(num_callers, args.queries, embed)
+         elapsed = time.perf_counter() - start
+         print(f'{num_callers:>3} callers, {name:>7}: '
+               f'{len(latencies) / elapsed:7.1f} queries/s, '
+               f'p50 {np.percentile(latencies, 50) * 1000:8.2f}ms, '
+               f'p95 {np.percentile(latencies, 95) * 1000:8.2f}ms')
+      print(f'{num_callers:>3} callers, service: {service.batches} batches '
+            f'for {service.requests} queries')
+      service.close()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,128 @@
+"""
+Measures the per-call latency of OpenAIChatProvider against a local
+OpenAI-compatible stub server, comparing a fresh AsyncOpenAI client per
+request (what the provider used to do) with the provider's pooled client.
+Like the server, every request runs in its own asyncio.run.
+
+The stub server adds a fixed delay per new TCP connection to stand in for the
+TLS handshake and DNS lookup of the real API.
+
+Usage: python benchmarks/openai_client_bench.py [--requests 100]
+          [--chunks 20] [--connect-delay 0.05]
+"""
+
+import os, sys, json, time, argparse, asyncio, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from openai import AsyncOpenAI
+
+# Add the root of the repo to the path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import lib as lp
+from lib._private.chat import OpenAIChatProvider
+
+MODEL = 'gpt-3.5-turbo-1106'
+
+def make_handler(chunks: int, connect_delay: float):
+   class StubHandler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+
+      def setup(self):
+         super().setup()
+         time.sleep(connect_delay)
+
+      def log_message(self, *_):
+         pass
+
+      def send_body(self, body: bytes, content_type: str):
+         self.send_response(200)
+         self.send_header('Content-Type', content_type)
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_GET(self):
+         self.send_body(json.dumps({
+            'object': 'list',
+            'data': [{
+               'id': MODEL, 'object': 'model',
+               'created': 0, 'owned_by': 'stub'
+            }]
+         }).encode(), 'application/json')
+
+      def do_POST(self):
+         self.rfile.read(int(self.headers['Content-Length']))
+         events = []
+         for i in range(chunks):
+            events.append('data: ' + json.dumps({
+               'id': 'stub', 'object': 'chat.completion.chunk',
+               'created': 0, 'model': MODEL,
+               'choices': [{
+                  'index': 0, 'finish_reason': None,
+                  'delta': {'content': f'word{i} '}
+               }]
+            }) + '\n\n')
+         events.append('data: [DONE]\n\n')
+         self.send_body(''.join(events).encode(), 'text/event-stream')
+   return StubHandler
+
+def request() -> lp.ChatContext:
+   return lp.ChatContext(
+      provider=None,  # type: ignore
+      model=MODEL,
+      document=[lp.ChatItem(type='user', text='Hello!')]
+   )
+
+async def fresh_client(base_url: str):
+   client = AsyncOpenAI(api_key='stub', base_url=base_url)
+   response = await client.chat.completions.create(
+      model=MODEL, messages=[{'role': 'user', 'content': 'Hello!'}],
+      stream=True)
+   async for _ in response:
+      pass
+   await client.close()
+
+async def pooled_client(provider: OpenAIChatProvider):
+   async for _ in provider.fetch_response(request()):
+      pass
+
+def measure(fn, n: int) -> list[float]:
+   latencies = []
+   for _ in range(n):
+      started = time.perf_counter()
+      asyncio.run(fn())
+      latencies.append(time.perf_counter() - started)
+   return latencies
+
+def report(name: str, latencies: list[float]):
+   latencies = sorted(latencies)
+   p50 = latencies[len(latencies) // 2]
+   p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+   print(f'   {name:16} p50 {p50 * 1000:7.2f}ms   p99 {p99 * 1000:7.2f}ms')
+   return p50
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--requests', type=int, default=100)
+   parser.add_argument('--chunks', type=int, default=20)
+   parser.add_argument('--connect-delay', type=float, default=0.05)
+   args = parser.parse_args()
+   server = ThreadingHTTPServer(
+      ('127.0.0.1', 0), make_handler(args.chunks, args.connect_delay))
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   base_url = f'http://127.0.0.1:{server.server_port}/v1'
+   provider = OpenAIChatProvider(api_key='stub', base_url=base_url)
+   # Warm up both paths once
+   asyncio.run(fresh_client(base_url))
+   asyncio.run(pooled_client(provider))
+   print(f'{args.requests} requests, {args.chunks} chunks each, '
+         f'{args.connect_delay * 1000:.0f}ms per new connection')
+   fresh = report('fresh client', measure(
+      lambda: fresh_client(base_url), args.requests))
+   pooled = report('pooled client', measure(
+      lambda: pooled_client(provider), args.requests))
+   print(f'   saved {(fresh - pooled) * 1000:.2f}ms per call (p50)')
+   server.shutdown()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,196 @@
+"""
+Benchmarks the session engine (ChatSession, the notifier and the SSE fan-out)
+by driving the example flows in plugins/examples against simulated providers,
+so it runs offline and costs nothing. Every session runs on the same event
+loop, like concurrent requests sharing a server.
+
+Two passes are run for every flow:
+1. A zero-latency pass, where the providers never sleep. All of the time
+   spent is overhead of the engine, which gives the per-chunk overhead.
+2. A pass with the given latency profile, which gives the end-to-end and
+   time-to-first-token percentiles and the throughput.
+
+With --replay, the OpenAI steps play back responses recorded with
+DUCKY_PROVIDER_MODE=record instead (see RecordingChatProvider), with their
+timing scaled by --time-scale.
+
+The latency pass uses the named --profile from LATENCY_PROFILES if given,
+otherwise the --ttft/--tps options, plus the given --jitter and --error-rate.
+Messages that fail are counted, but not timed.
+
+Usage: python benchmarks/session_bench.py [--concurrency 32] [--messages 4]
+          [--ttft 0.5] [--ttft-stddev 0.1] [--tps 60] [--tps-stddev 10]
+          [--jitter 0] [--error-rate 0] [--profile gpt-4]
+          [--listeners 4] [--flows echo test_flow gpt35_basic]
+          [--replay recordings.jsonl] [--time-scale 1.0]
+"""
+
+import os, sys, time, argparse, asyncio, dataclasses, importlib.util
+
+# Add the root of the repo to the path
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(root)
+import lib as lp
+from lib._private.chat import (
+   SimulatedChatProvider, SimulatedProviderError, LatencyProfile,
+   LATENCY_PROFILES, ReplayChatProvider
+)
+
+def load_announcer():
+   """
+   Loads server/sse.py on its own, as importing the server package starts
+   the whole server.
+   """
+   path = os.path.join(root, 'server', 'sse.py')
+   spec = importlib.util.spec_from_file_location('bench_sse', path)
+   assert spec is not None and spec.loader is not None
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module.MessageAnnouncer()
+
+class BenchNotifier(lp.IChatNotifier):
+   """
+   Same as the server's ChatNotifier, but with its own announcer.
+   """
+   def __init__(self, announcer):
+      self.announcer = announcer
+
+   def notify_assistant_message(self, message: str) -> None:
+      self.announcer.announce(data=message, event='assistant')
+
+   def notify_flow_step(self, name: str) -> None:
+      self.announcer.announce(data=name, event='flow-step')
+
+   def notify_search(self, query: str) -> None:
+      self.announcer.announce(data=query, event='vector-search')
+
+   def notify_final_response(self) -> None:
+      self.announcer.announce(data='', event='final-response-start')
+
+   def notify_step_metrics(self, metrics: lp.StepMetrics) -> None:
+      pass
+
+def percentile(values: list[float], p: float) -> float:
+   if len(values) == 0:
+      return float('nan')
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def use_profile(profile: LatencyProfile, replay: str | None = None,
+                time_scale: float = 1.0):
+   """
+   Makes every flow use simulated providers with the given profile, or
+   replay the given recordings for the OpenAI steps.
+   """
+   for name in ('openai', 'openai-cached', 'dummy'):
+      if replay is not None and name != 'dummy':
+         lp.register_provider(name, ReplayChatProvider(replay, time_scale))
+      else:
+         lp.register_provider(name, SimulatedChatProvider(profile, seed=0))
+
+async def run_session(flow: lp.FlowDescriptor, notifier: BenchNotifier,
+                      messages: int, latencies: list[float],
+                      ttfts: list[float], chunks: list[int],
+                      errors: list[int]):
+   session = lp.ChatSession(notifier=notifier)
+   for i in range(messages):
+      started = time.perf_counter()
+      try:
+         await session.start_flow(f'Message {i}: is red a color?', flow)
+      except SimulatedProviderError:
+         errors.append(i)
+         continue
+      latencies.append(time.perf_counter() - started)
+      ttft = session.current_completion().metrics.time_to_first_token
+      if ttft is not None:
+         ttfts.append(ttft)
+      # Count the chunks of every step, not only the final response
+      chunks.append(sum(
+         x.metrics.chunks for x in session.current_completion().steps))
+
+async def run_flow(flow: lp.FlowDescriptor, args, listeners: list):
+   announcer = load_announcer()
+   for _ in range(args.listeners):
+      listeners.append(announcer.listen())
+   latencies: list[float] = []
+   ttfts: list[float] = []
+   chunks: list[int] = []
+   errors: list[int] = []
+   started = time.perf_counter()
+   cpu_started = time.process_time()
+   await asyncio.gather(*[
+      run_session(flow, BenchNotifier(announcer), args.messages,
+                  latencies, ttfts, chunks, errors)
+      for _ in range(args.concurrency)
+   ])
+   elapsed = time.perf_counter() - started
+   cpu = time.process_time() - cpu_started
+   return elapsed, cpu, sum(chunks), latencies, ttfts, len(errors)
+
+def drain(listeners: list):
+   """ Empties the SSE queues, as if the clients had read them. """
+   for q in listeners:
+      while not q.empty():
+         q.get_nowait()
+   listeners.clear()
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--concurrency', type=int, default=32)
+   parser.add_argument('--messages', type=int, default=4)
+   parser.add_argument('--ttft', type=float, default=0.5)
+   parser.add_argument('--ttft-stddev', type=float, default=0.1)
+   parser.add_argument('--tps', type=float, default=60.0)
+   parser.add_argument('--tps-stddev', type=float, default=10.0)
+   parser.add_argument('--jitter', type=float, default=0.0)
+   parser.add_argument('--error-rate', type=float, default=0.0)
+   parser.add_argument('--profile', type=str, default=None,
+                       choices=list(LATENCY_PROFILES))
+   parser.add_argument('--listeners', type=int, default=4)
+   parser.add_argument('--flows', nargs='*',
+                       default=['echo', 'test_flow', 'gpt35_basic'])
+   parser.add_argument('--replay', type=str, default=None)
+   parser.add_argument('--time-scale', type=float, default=1.0)
+   args = parser.parse_args()
+
+   flows = lp.resolve_flows(os.path.join(root, 'plugins', 'examples'))
+   flows = [f for f in flows if f.id in args.flows]
+   if len(flows) == 0:
+      print('No flows found')
+      return
+   zero = LatencyProfile(0, 0, 0, 0)
+   if args.profile is not None:
+      profile = LATENCY_PROFILES[args.profile]
+   else:
+      profile = LatencyProfile(
+         args.ttft, args.ttft_stddev, args.tps, args.tps_stddev)
+   profile = dataclasses.replace(
+      profile,
+      jitter=profile.jitter + args.jitter,
+      error_rate=profile.error_rate + args.error_rate)
+   listeners: list = []
+   print(f'{args.concurrency} sessions x {args.messages} messages, '
+         f'{args.listeners} SSE listeners')
+   for flow in flows:
+      use_profile(zero, args.replay, 0.0)
+      elapsed, cpu, chunks, _, _, _ = asyncio.run(
+         run_flow(flow, args, listeners))
+      drain(listeners)
+      overhead = cpu / max(chunks, 1) * 1e6
+      use_profile(profile, args.replay, args.time_scale)
+      elapsed, _, chunks, latencies, ttfts, errors = asyncio.run(
+         run_flow(flow, args, listeners))
+      drain(listeners)
+      print(f'{flow.id}:')
+      print(f'   overhead:   {overhead:8.1f} us/chunk (zero latency)')
+      print(f'   throughput: {chunks / elapsed:8.1f} chunks/s, '
+            f'{len(latencies) / elapsed:.1f} messages/s')
+      print(f'   latency:    p50 {percentile(latencies, 50):.3f}s, '
+            f'p99 {percentile(latencies, 99):.3f}s')
+      print(f'   ttft:       p50 {percentile(ttfts, 50):.3f}s, '
+            f'p99 {percentile(ttfts, 99):.3f}s')
+      if errors > 0:
+         print(f'   errors:     {errors} messages failed')
+
+if __name__ == '__main__':
+   main()
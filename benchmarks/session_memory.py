@@ -0,0 +1,136 @@
+"""
+Measures the memory used by the chat history of a single session, comparing
+the session data classes against plain (dict-backed, non-interned) copies of
+them. The conversation mimics the RISC-V RAG flow: every turn has a query
+generation step and a final answer step with retrieved passages.
+
+Usage: python benchmarks/session_memory.py [--turns 50] [--sessions 20]
+"""
+
+import os, sys, argparse, random, tracemalloc
+from dataclasses import dataclass, field
+from typing import Any
+
+# Add the root of the repo to the path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import lib as lp
+
+# Plain copies of the data classes, as they were before they were slotted
+
+@dataclass
+class PlainReferenceItem:
+   type: str
+   data: str
+   url: str
+
+@dataclass
+class PlainChatItem:
+   type: str
+   text: str
+
+@dataclass
+class PlainChatContext:
+   provider: Any
+   document: list[PlainChatItem]
+   is_final_context: bool = False
+   model: str | None = None
+   system_prompt: str = ''
+   temperature: float = 1.0
+   max_tokens: int | None = None
+   frequency_penalty: float = 0.0
+   presence_penalty: float = 0.0
+   request_tokens: int = 0
+   completion_tokens: int = 0
+   user_data: dict[str, Any] = field(default_factory=dict)
+
+@dataclass
+class PlainChatCompletion:
+   user_query: str = ''
+   response: str = ''
+   steps: list[PlainChatContext] = field(default_factory=list)
+   flow_id: str | None = None
+   references: list[PlainReferenceItem] = field(default_factory=list)
+
+QUERY_PROMPT = "You are an assistant that will help with querying an embedding vector database. " * 8
+ANSWER_PROMPT = "You are an assistant that will help the user with searching and synthesizing answers from the RISC-V Unprivileged ISA specifications. " * 16
+
+def copy_text(text: str) -> str:
+   """
+   Returns an equal but distinct copy of the text, like a string that was
+   loaded from disk or deserialized from the vector database.
+   """
+   return text.encode('utf-8').decode('utf-8')
+
+def build_history(plain: bool, turns: int, passages: list[str],
+                  rng: random.Random) -> list:
+   Reference = PlainReferenceItem if plain else lp.ReferenceItem
+   Item = PlainChatItem if plain else lp.ChatItem
+   Context = PlainChatContext if plain else lp.ChatContext
+   Completion = PlainChatCompletion if plain else lp.ChatCompletion
+   history = []
+   for i in range(turns):
+      question = f'Question {i}: what does the FENCE.I instruction do?'
+      picked = rng.sample(passages, 6)
+      sources = '\n'.join(f'Source {j+1}: """{p}"""' for j, p in enumerate(picked))
+      answer = 'The answer is ' + 'lorem ipsum ' * 40
+      steps = [
+         Context(
+            provider=None,
+            model='gpt-3.5-turbo-1106',
+            system_prompt=copy_text(QUERY_PROMPT),
+            document=[
+               Item(type='user', text=f'Can you come up with search queries for the question:\n{question}'),
+               Item(type='assistant', text='"fence.i" "instruction fetch"'),
+            ]
+         ),
+         Context(
+            provider=None,
+            model='gpt-3.5-turbo-1106',
+            system_prompt=copy_text(ANSWER_PROMPT),
+            document=[
+               Item(type='user', text=f'Relative passages:\n\n{sources}\n\nUser question: {question}'),
+               Item(type='assistant', text=answer),
+            ],
+            is_final_context=True
+         ),
+      ]
+      history.append(Completion(
+         user_query=question,
+         response=answer,
+         steps=steps,
+         flow_id='flow_rag',
+         references=[
+            Reference(type='text', data=copy_text(p), url='???')
+            for p in picked
+         ]
+      ))
+   return history
+
+def measure(plain: bool, turns: int, sessions: int) -> float:
+   rng = random.Random(0)
+   passages = [f'Passage {i}: ' + 'RISC-V base integer ISA text. ' * 40
+               for i in range(64)]
+   lp.get_string_pool().clear()
+   tracemalloc.start()
+   before, _ = tracemalloc.get_traced_memory()
+   histories = [build_history(plain, turns, passages, rng)
+                for _ in range(sessions)]
+   after, _ = tracemalloc.get_traced_memory()
+   tracemalloc.stop()
+   del histories
+   return (after - before) / sessions
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--turns', type=int, default=50)
+   parser.add_argument('--sessions', type=int, default=20)
+   args = parser.parse_args()
+   plain = measure(True, args.turns, args.sessions)
+   slotted = measure(False, args.turns, args.sessions)
+   print(f'{args.turns}-turn session, averaged over {args.sessions} sessions')
+   print(f'   plain dataclasses:       {plain / 1024:10.1f} KiB/session')
+   print(f'   slotted + interned:      {slotted / 1024:10.1f} KiB/session')
+   print(f'   saved:                   {100 * (1 - slotted / plain):10.1f} %')
+
+if __name__ == '__main__':
+   main()
@@ -3,3 +3,12 @@ from ._private.notify import *
 from ._private.resolver import *
 from ._private.embedder import *
 from ._private.cache import *
+from ._private.history import *
+from ._private.pool import *
+from ._private.store import *
+from ._private.metrics import *
+from ._private.aio import *
+from ._private.tokens import *
+from ._private.embedcache import *
+from ._private.embedservice import *
+from ._private.shardembed import *
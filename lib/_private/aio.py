@@ -0,0 +1,94 @@
+"""
+Internal module for sharing loop-bound resources across event loops.
+"""
+
+import asyncio, threading
+from concurrent.futures import Future
+from typing import Any, AsyncGenerator, Coroutine, TypeVar
+
+T = TypeVar('T')
+
+class BackgroundLoop:
+   """
+   An event loop that runs forever in a daemon thread. Resources that are
+   bound to the loop they were first used on (i.e., HTTP connection pools)
+   should live on this loop, so they can be shared by code running on other,
+   short-lived loops such as the per-request asyncio.run in the server.
+   """
+
+   __loop: asyncio.AbstractEventLoop
+   __thread: threading.Thread
+
+   def __init__(self, name: str = 'background-loop'):
+      self.__loop = asyncio.new_event_loop()
+      self.__thread = threading.Thread(
+         target=self.__loop.run_forever, name=name, daemon=True)
+      self.__thread.start()
+
+   @property
+   def loop(self) -> asyncio.AbstractEventLoop:
+      """ Returns the event loop. """
+      return self.__loop
+
+   def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+      """ Schedules the coroutine on the loop. This is thread-safe. """
+      return asyncio.run_coroutine_threadsafe(coro, self.__loop)
+
+   async def run(self, coro: Coroutine[Any, Any, T]) -> T:
+      """
+      Runs the coroutine on the loop and waits for it from the caller's loop.
+      Cancelling the caller cancels the coroutine too.
+      """
+      return await asyncio.wrap_future(self.submit(coro))
+
+   async def iterate(self, gen: AsyncGenerator[T, None]
+                     ) -> AsyncGenerator[T, None]:
+      """
+      Runs the async generator on the loop and yields its items on the
+      caller's loop. If the caller stops early (or is cancelled), then the
+      generator is closed on the loop.
+      """
+      caller = asyncio.get_running_loop()
+      queue: asyncio.Queue[tuple[str, Any]] = asyncio.Queue()
+      def put(kind: str, value: Any):
+         caller.call_soon_threadsafe(queue.put_nowait, (kind, value))
+      async def produce():
+         try:
+            async for item in gen:
+               put('item', item)
+            put('done', None)
+         except asyncio.CancelledError:
+            raise
+         except RuntimeError as e:
+            # The caller's loop was closed, there is no one left to tell
+            if caller.is_closed():
+               return
+            put('error', e)
+         except BaseException as e:
+            put('error', e)
+         finally:
+            await gen.aclose()
+      future = self.submit(produce())
+      try:
+         while True:
+            kind, value = await queue.get()
+            if kind == 'done':
+               break
+            if kind == 'error':
+               raise value
+            yield value
+      finally:
+         future.cancel()
+
+_background_loop: BackgroundLoop | None = None
+_background_loop_lock = threading.Lock()
+
+def get_background_loop() -> BackgroundLoop:
+   """ Returns the background loop shared by the providers. """
+   global _background_loop
+   with _background_loop_lock:
+      if _background_loop is None:
+         _background_loop = BackgroundLoop()
+      return _background_loop
+
+__all__ = ['BackgroundLoop', 'get_background_loop']
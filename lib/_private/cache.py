@@ -1,13 +1,17 @@
+import os, inspect
 from typing import Any
 from transformers import (
    PreTrainedTokenizer,
    PreTrainedTokenizerFast,
    AutoModel,
+   AutoModelForCausalLM,
    AutoTokenizer
 )
 
 _model_cache: dict[str, Any] = {}
+_causal_lm_cache: dict[str, Any] = {}
 _tokenizer_cache: dict[str, PreTrainedTokenizer | PreTrainedTokenizerFast] = {}
+_onnx_cache: dict[tuple[str, bool], Any] = {}
 
 def load_model_and_tokenizer(name: str):
    global _model_cache, _tokenizer_cache
@@ -17,10 +21,113 @@ def load_model_and_tokenizer(name: str):
       _tokenizer_cache[name] = AutoTokenizer.from_pretrained(name)
    return _model_cache[name], _tokenizer_cache[name]
 
+def load_causal_lm_and_tokenizer(name: str):
+   global _causal_lm_cache, _tokenizer_cache
+   if name not in _causal_lm_cache:
+      _causal_lm_cache[name] = AutoModelForCausalLM.from_pretrained(name)
+      _causal_lm_cache[name].eval()
+   if name not in _tokenizer_cache:
+      _tokenizer_cache[name] = AutoTokenizer.from_pretrained(name)
+   return _causal_lm_cache[name], _tokenizer_cache[name]
+
+def load_tokenizer(name: str):
+   global _tokenizer_cache
+   if name not in _tokenizer_cache:
+      _tokenizer_cache[name] = AutoTokenizer.from_pretrained(name)
+   return _tokenizer_cache[name]
+
+def register_model(name: str, model: Any,
+                   tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast):
+   """
+   Registers (or replaces) the model and tokenizer returned by
+   load_model_and_tokenizer for the given name. This is useful to swap in
+   models that are not on the hub, i.e., for tests and benchmarks.
+   """
+   global _model_cache, _tokenizer_cache
+   _model_cache[name] = model
+   _tokenizer_cache[name] = tokenizer
+
+def _export_onnx(name: str, path: str):
+   """
+   Exports the encoder to ONNX, with its last hidden state as the output and
+   dynamic batch and sequence axes.
+   """
+   import torch
+   # Prefer the loaded (or registered) model, without caching a new one
+   model = _model_cache.get(name)
+   if model is None:
+      model = AutoModel.from_pretrained(name)
+   model.eval()
+   encoded = load_tokenizer(name)(['Hello, world!'], return_tensors='pt')
+   # Pass the inputs positionally, in the order of the parameters of the
+   # model, as the exporter binds them by position
+   parameters = list(inspect.signature(model.forward).parameters)
+   count = max(parameters.index(key) for key in encoded.keys()) + 1
+   args = tuple(encoded.get(key) for key in parameters[:count])
+   inputs = {key: encoded[key] for key in parameters[:count] if key in encoded}
+   axes = {0: 'batch', 1: 'sequence'}
+   # Write to a temporary file first so readers never see a partial model
+   tmp_path = f'{path}.{os.getpid()}.tmp'
+   # Newer versions of torch default to the dynamo exporter, which needs
+   # onnxscript and ignores dynamic_axes
+   options = {}
+   if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+      options['dynamo'] = False
+   with torch.no_grad():
+      torch.onnx.export(
+         model, args, tmp_path,
+         input_names=list(inputs.keys()),
+         output_names=['last_hidden_state'],
+         dynamic_axes={
+            **{key: axes for key in inputs.keys()},
+            'last_hidden_state': axes
+         },
+         opset_version=14,
+         **options
+      )
+   os.replace(tmp_path, path)
+
+def load_onnx_model(name: str, quantize: bool = False):
+   """
+   Returns an ONNX Runtime session of the encoder, whose output is its last
+   hidden state. The model is exported on first use (and, if quantize is
+   set, dynamically quantized to int8) to DUCKY_CACHE_DIR/onnx, so later
+   runs only load it. Needs the onnxruntime package (and torch and onnx to
+   export the model).
+   """
+   global _onnx_cache
+   from .resolver import cache_dir
+   key = (name, quantize)
+   if key not in _onnx_cache:
+      import onnxruntime
+      directory = os.path.join(cache_dir, 'onnx', name.replace('/', '--'))
+      os.makedirs(directory, exist_ok=True)
+      path = os.path.join(directory, 'model.onnx')
+      if not os.path.isfile(path):
+         _export_onnx(name, path)
+      if quantize:
+         from onnxruntime.quantization import quantize_dynamic, QuantType
+         fp32_path, path = path, os.path.join(directory, 'model.int8.onnx')
+         if not os.path.isfile(path):
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, path)
+      _onnx_cache[key] = onnxruntime.InferenceSession(
+         path, providers=['CPUExecutionProvider'])
+   return _onnx_cache[key]
+
 def is_model_cached(name: str):
    return name in _model_cache
 
 def is_tokenizer_cached(name: str):
    return name in _tokenizer_cache
 
-__all__ = ['load_model_and_tokenizer', 'is_model_cached', 'is_tokenizer_cached']
+__all__ = [
+   'load_model_and_tokenizer',
+   'load_causal_lm_and_tokenizer',
+   'load_tokenizer',
+   'load_onnx_model',
+   'register_model',
+   'is_model_cached',
+   'is_tokenizer_cached'
+]
@@ -1,3 +1,15 @@
 from .openai import OpenAIChatProvider
-from .babbler import DummyChatProvider
+from .babbler import (
+   DummyChatProvider, SimulatedChatProvider, SimulatedProviderError,
+   LatencyProfile, LATENCY_PROFILES, get_latency_profile
+)
 from .nop import NoOpChatProvider
+from .caching import CachedChatProvider, CompletionCache
+from .fingerprint import request_fingerprint
+from .coalescing import CoalescingChatProvider
+from .scheduling import (
+   RateLimitScheduler, ScheduledChatProvider, SchedulerStats, TokenBucket,
+   request_priority, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+)
+from .replay import RecordingChatProvider, ReplayChatProvider
+from .hedging import HedgedChatProvider, get_latency_histogram
@@ -1,4 +1,5 @@
-from time import sleep
+import math, asyncio, random
+from dataclasses import dataclass
 from lib import ChatGeneratorT, ChatContext, IChatProvider
 
 LOREM_IPSUM_TEXT = """
@@ -17,7 +18,7 @@ class DummyChatProvider(IChatProvider):
       assert len(request.document) > 0, "No questions to ask"
       for chunk in LOREM_IPSUM_TEXT.strip().split(' '):
          yield (chunk, x, y)
-         sleep(self.delay)
+         await asyncio.sleep(self.delay)
          yield (' ', x, y)
 
    def total_request_tokens(self) -> int:
@@ -25,3 +26,141 @@ class DummyChatProvider(IChatProvider):
 
    def total_completion_tokens(self) -> int:
       return 6969
+
+class SimulatedProviderError(RuntimeError):
+   """ An error injected by a SimulatedChatProvider. """
+
+@dataclass
+class LatencyProfile:
+   """
+   The latency distribution of a simulated provider. Times are in seconds.
+   The time to first token and the tokens per second are sampled from a
+   normal distribution (clamped to be non-negative), or a log-normal one
+   with the same mean and standard deviation for a long tail.
+   """
+   time_to_first_token: float = 0.5
+   time_to_first_token_stddev: float = 0.1
+   tokens_per_second: float = 60.0
+   tokens_per_second_stddev: float = 10.0
+   distribution: str = 'normal'
+   """ Either 'normal' or 'lognormal'. """
+
+   jitter: float = 0.0
+   """ Up to this much extra delay is added to every token, uniformly. """
+
+   stall_rate: float = 0.0
+   """ The probability that a token stalls the stream for stall_time. """
+
+   stall_time: float = 1.0
+
+   error_rate: float = 0.0
+   """ The probability that a request fails before its first token. """
+
+   midstream_error_rate: float = 0.0
+   """ The probability that a request fails partway through the stream. """
+
+   def sample(self, rng: random.Random, mean: float, stddev: float) -> float:
+      if self.distribution == 'lognormal' and mean > 0 and stddev > 0:
+         sigma2 = math.log(1 + (stddev / mean) ** 2)
+         return rng.lognormvariate(math.log(mean) - sigma2 / 2,
+                                   math.sqrt(sigma2))
+      return max(0.0, rng.gauss(mean, stddev))
+
+   def sample_time_to_first_token(self, rng: random.Random) -> float:
+      return self.sample(
+         rng, self.time_to_first_token, self.time_to_first_token_stddev)
+
+   def sample_token_delay(self, rng: random.Random) -> float:
+      if self.tokens_per_second <= 0:
+         return 0.0
+      tps = self.sample(
+         rng, self.tokens_per_second, self.tokens_per_second_stddev)
+      delay = 1.0 / max(tps, 1.0)
+      if self.jitter > 0:
+         delay += rng.uniform(0, self.jitter)
+      if self.stall_rate > 0 and rng.random() < self.stall_rate:
+         delay += self.stall_time
+      return delay
+
+LATENCY_PROFILES: dict[str, LatencyProfile] = {
+   'instant': LatencyProfile(0, 0, 0, 0),
+   'gpt-3.5': LatencyProfile(0.5, 0.1, 60, 10),
+   'gpt-4': LatencyProfile(1.0, 0.3, 20, 5, distribution='lognormal'),
+   'congested': LatencyProfile(
+      2.0, 1.5, 30, 15, distribution='lognormal', jitter=0.05,
+      stall_rate=0.01, stall_time=2.0),
+   'flaky': LatencyProfile(
+      0.5, 0.1, 60, 10, error_rate=0.05, midstream_error_rate=0.05),
+}
+"""
+Named profiles, which a context can select through the 'latency_profile'
+entry of its user data.
+"""
+
+def get_latency_profile(name: str) -> LatencyProfile:
+   """
+   Returns the profile in LATENCY_PROFILES with the given name. Raises a
+   ValueError if there is none.
+   """
+   if name not in LATENCY_PROFILES:
+      raise ValueError(
+         f'Unknown latency profile: {name} (expected one of '
+         f'{", ".join(LATENCY_PROFILES)})')
+   return LATENCY_PROFILES[name]
+
+class SimulatedChatProvider(DummyChatProvider):
+   """
+   A dummy provider that simulates the latency of a real provider without
+   blocking the event loop. Every word of the response is one token.
+
+   The latency profile can be overridden per request, by setting the
+   'latency_profile' entry of the context's user data to a LatencyProfile
+   or to the name of one in LATENCY_PROFILES.
+   """
+
+   def __init__(self, profile: LatencyProfile | None = None,
+                seed: int | None = 0, text: str = LOREM_IPSUM_TEXT):
+      super().__init__(delay=0)
+      self.profile = profile or LatencyProfile()
+      self.rng = random.Random(seed)
+      self.words = text.strip().split(' ')
+      self.total_reqtoks_ctr = 0
+      self.total_cmpltoks_ctr = 0
+
+   def get_profile(self, request: ChatContext) -> LatencyProfile:
+      """ Returns the latency profile of the request. """
+      profile = request.user_data.get('latency_profile')
+      if isinstance(profile, LatencyProfile):
+         return profile
+      if isinstance(profile, str):
+         return get_latency_profile(profile)
+      return self.profile
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      assert len(request.document) > 0, "No questions to ask"
+      profile = self.get_profile(request)
+      prompt_tokens = sum(
+         len(x.text.split()) for x in request.document
+      ) + len(request.system_prompt.split())
+      self.total_reqtoks_ctr += prompt_tokens
+      # Decide up front whether (and where) the request fails
+      fail_at = None
+      if self.rng.random() < profile.error_rate:
+         fail_at = 0
+      elif self.rng.random() < profile.midstream_error_rate:
+         fail_at = self.rng.randrange(1, max(len(self.words), 2))
+      await asyncio.sleep(profile.sample_time_to_first_token(self.rng))
+      for i, word in enumerate(self.words):
+         if i == fail_at:
+            raise SimulatedProviderError(
+               f'Simulated error after {i} tokens')
+         if i > 0:
+            await asyncio.sleep(profile.sample_token_delay(self.rng))
+         self.total_cmpltoks_ctr += 1
+         yield (word if i == 0 else ' ' + word, prompt_tokens, i + 1)
+
+   def total_request_tokens(self) -> int:
+      return self.total_reqtoks_ctr
+
+   def total_completion_tokens(self) -> int:
+      return self.total_cmpltoks_ctr
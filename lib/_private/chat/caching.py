@@ -0,0 +1,198 @@
+import os, json, time, asyncio
+from collections import OrderedDict
+from threading import Lock
+from lib import ChatGeneratorT, ChatContext, IChatProvider
+from .fingerprint import request_fingerprint
+
+ChunkT = tuple[str, int, int]
+
+class CompletionCache:
+   """
+   A cache of streamed responses, keyed by request fingerprint. Entries are
+   kept in a bounded in-memory LRU, backed by one JSON file per entry in the
+   cache directory (if any). Entries older than the TTL are dropped.
+
+   The directory is pruned when the cache is opened, and again after every
+   prune_interval writes: expired entries are removed, and so are the oldest
+   entries past max_disk_entries.
+   """
+   __entries: OrderedDict[str, tuple[float, list[ChunkT]]]
+   __lock: Lock
+   __writes: int
+
+   def __init__(self, directory: str | None = None,
+                max_entries: int = 1024, ttl: float = 7 * 24 * 3600,
+                max_disk_entries: int = 16384, prune_interval: int = 256):
+      self.directory = directory
+      self.max_entries = max_entries
+      self.ttl = ttl
+      self.max_disk_entries = max_disk_entries
+      self.prune_interval = prune_interval
+      self.__entries = OrderedDict()
+      self.__lock = Lock()
+      self.__writes = 0
+      if directory is not None:
+         os.makedirs(directory, exist_ok=True)
+         self.prune()
+
+   def prune(self) -> int:
+      """
+      Removes the expired entries from the directory, then the oldest ones
+      until at most max_disk_entries are left. Returns the number of entries
+      removed.
+      """
+      if self.directory is None:
+         return 0
+      now = time.time()
+      entries: list[tuple[float, str]] = []
+      removed = 0
+      with os.scandir(self.directory) as it:
+         for entry in it:
+            if not entry.name.endswith('.json') and \
+                  not entry.name.endswith('.tmp'):
+               continue
+            try:
+               modified = entry.stat().st_mtime
+            except OSError:
+               continue
+            # Temporary files are only left behind by killed writers
+            if entry.name.endswith('.tmp'):
+               expired = now - modified > 3600
+            else:
+               expired = now - modified > self.ttl
+            if expired:
+               removed += _remove(entry.path)
+            elif entry.name.endswith('.json'):
+               entries.append((modified, entry.path))
+      if len(entries) > self.max_disk_entries:
+         entries.sort()
+         for _, path in entries[:len(entries) - self.max_disk_entries]:
+            removed += _remove(path)
+      return removed
+
+   def __path(self, key: str) -> str:
+      assert self.directory is not None
+      return os.path.join(self.directory, f'{key}.json')
+
+   def __remember(self, key: str, created: float, chunks: list[ChunkT]):
+      with self.__lock:
+         self.__entries[key] = (created, chunks)
+         self.__entries.move_to_end(key)
+         while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+   def peek(self, key: str) -> list[ChunkT] | None:
+      """
+      Returns the chunks of the cached response if it is in memory, or None
+      otherwise. Never touches the directory, so it is safe to call on an
+      event loop.
+      """
+      now = time.time()
+      with self.__lock:
+         entry = self.__entries.get(key)
+         if entry is not None:
+            if now - entry[0] <= self.ttl:
+               self.__entries.move_to_end(key)
+               return entry[1]
+            del self.__entries[key]
+      return None
+
+   def get(self, key: str) -> list[ChunkT] | None:
+      """
+      Returns the chunks of the cached response, or None on a miss. This
+      reads the directory on a memory miss.
+      """
+      now = time.time()
+      chunks = self.peek(key)
+      if chunks is not None or self.directory is None:
+         return chunks
+      try:
+         with open(self.__path(key), 'r') as f:
+            data = json.load(f)
+      except (OSError, ValueError):
+         return None
+      if now - data['created'] > self.ttl:
+         _remove(self.__path(key))
+         return None
+      chunks = [(t, p, c) for t, p, c in data['chunks']]
+      self.__remember(key, data['created'], chunks)
+      return chunks
+
+   def put(self, key: str, chunks: list[ChunkT]) -> None:
+      """
+      Stores the chunks of a complete response. This writes (and every
+      prune_interval writes, prunes) the directory.
+      """
+      created = time.time()
+      self.__remember(key, created, chunks)
+      if self.directory is None:
+         return
+      # Write to a temporary file first so readers never see a partial entry
+      path = self.__path(key)
+      tmp_path = f'{path}.{os.getpid()}.tmp'
+      with open(tmp_path, 'w') as f:
+         json.dump({'created': created, 'chunks': chunks}, f)
+      os.replace(tmp_path, path)
+      with self.__lock:
+         self.__writes += 1
+         should_prune = self.__writes >= self.prune_interval
+         if should_prune:
+            self.__writes = 0
+      if should_prune:
+         self.prune()
+
+def _remove(path: str) -> int:
+   """ Removes the file, and returns 1 if it was removed. """
+   try:
+      os.remove(path)
+   except OSError:
+      return 0
+   return 1
+
+class CachedChatProvider(IChatProvider):
+   """
+   Wraps a provider and caches its responses to deterministic requests, that
+   is, requests with a temperature of at most max_temperature. Cache hits are
+   replayed chunk by chunk without contacting the wrapped provider. Only
+   the in-memory lookup runs on the event loop, reading and writing the
+   cache directory (and pruning it) runs in a worker thread.
+   """
+
+   def __init__(self, provider: IChatProvider, cache: CompletionCache,
+                max_temperature: float = 0.2):
+      self.provider = provider
+      self.cache = cache
+      self.max_temperature = max_temperature
+      self.hits = 0
+      self.misses = 0
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.provider.get_num_tokens(request)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      if request.temperature > self.max_temperature:
+         async for chunk in self.provider.fetch_response(request):
+            yield chunk
+         return
+      key = request_fingerprint(request)
+      chunks = self.cache.peek(key)
+      if chunks is None and self.cache.directory is not None:
+         chunks = await asyncio.to_thread(self.cache.get, key)
+      if chunks is not None:
+         self.hits += 1
+         for chunk in chunks:
+            yield chunk
+         return
+      self.misses += 1
+      chunks = []
+      async for chunk in self.provider.fetch_response(request):
+         chunks.append(chunk)
+         yield chunk
+      # Only complete responses make it into the cache
+      await asyncio.to_thread(self.cache.put, key, chunks)
+
+   def total_request_tokens(self) -> int:
+      return self.provider.total_request_tokens()
+
+   def total_completion_tokens(self) -> int:
+      return self.provider.total_completion_tokens()
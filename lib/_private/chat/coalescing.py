@@ -0,0 +1,152 @@
+import asyncio
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any
+from lib import ChatGeneratorT, ChatContext, IChatProvider, get_background_loop
+from .fingerprint import request_fingerprint
+
+ChunkT = tuple[str, int, int]
+
+class _Flight:
+   """
+   A request that is in flight upstream, along with everyone waiting on it.
+   Chunks are kept so that late subscribers can catch up.
+   """
+   __slots__ = ('chunks', 'subscribers', 'future', 'finished')
+
+   chunks: list[ChunkT]
+   subscribers: list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]]
+   future: Future | None
+   finished: tuple[str, Any] | None
+
+   def __init__(self):
+      self.chunks = []
+      self.subscribers = []
+      self.future = None
+      self.finished = None
+
+class CoalescingChatProvider(IChatProvider):
+   """
+   Wraps a provider so that identical requests in flight at the same time
+   share a single upstream stream. The first request starts the stream on
+   the background loop, and every identical request that arrives before it
+   finishes gets the chunks streamed so far, then follows it live. Sessions
+   may run on different threads and event loops.
+
+   Every subscriber gets the same chunks, token counts included, so each
+   session accounts for the tokens of its own context. The upstream stream
+   is cancelled only once all of its subscribers are gone.
+
+   Only deterministic requests (with a temperature of at most
+   max_temperature) are coalesced, as sampled requests are expected to get
+   replies of their own. Requests are matched on their fingerprint, which
+   covers the sampling parameters too.
+   """
+
+   __flights: dict[str, _Flight]
+   __lock: Lock
+
+   def __init__(self, provider: IChatProvider, max_temperature: float = 0.0):
+      self.provider = provider
+      self.max_temperature = max_temperature
+      self.requests = 0
+      self.coalesced = 0
+      self.__flights = {}
+      self.__lock = Lock()
+
+   def in_flight(self) -> int:
+      """ Returns the number of distinct requests in flight upstream. """
+      with self.__lock:
+         return len(self.__flights)
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.provider.get_num_tokens(request)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      if request.temperature > self.max_temperature:
+         async for chunk in self.provider.fetch_response(request):
+            yield chunk
+         return
+      key = request_fingerprint(request)
+      loop = asyncio.get_running_loop()
+      queue: asyncio.Queue[tuple[str, Any]] = asyncio.Queue()
+      with self.__lock:
+         self.requests += 1
+         flight = self.__flights.get(key)
+         if flight is None:
+            flight = self.__flights[key] = _Flight()
+            flight.future = get_background_loop().submit(
+               self.__produce(key, flight, request))
+         else:
+            self.coalesced += 1
+         backlog = list(flight.chunks)
+         finished = flight.finished
+         if finished is None:
+            flight.subscribers.append((loop, queue))
+      try:
+         for chunk in backlog:
+            yield chunk
+         if finished is not None:
+            if finished[0] == 'error':
+               raise finished[1]
+            return
+         while True:
+            kind, value = await queue.get()
+            if kind == 'done':
+               break
+            if kind == 'error':
+               raise value
+            yield value
+      finally:
+         self.__unsubscribe(key, flight, loop, queue)
+
+   def __unsubscribe(self, key: str, flight: _Flight,
+                     loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+      with self.__lock:
+         if (loop, queue) in flight.subscribers:
+            flight.subscribers.remove((loop, queue))
+         if len(flight.subscribers) > 0 or flight.finished is not None:
+            return
+         # Nobody is listening anymore, so stop the upstream request
+         if self.__flights.get(key) is flight:
+            del self.__flights[key]
+         future = flight.future
+      if future is not None:
+         future.cancel()
+
+   def __publish(self, flight: _Flight, kind: str, value: Any):
+      """ Sends a message to every subscriber. Call with the lock held. """
+      for loop, queue in flight.subscribers:
+         try:
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+         except RuntimeError:
+            # The subscriber's loop is closed, it is gone anyway
+            pass
+
+   async def __produce(self, key: str, flight: _Flight,
+                       request: ChatContext):
+      response = self.provider.fetch_response(request)
+      try:
+         async for chunk in response:
+            with self.__lock:
+               flight.chunks.append(chunk)
+               self.__publish(flight, 'item', chunk)
+         finished = ('done', None)
+      except asyncio.CancelledError:
+         raise
+      except BaseException as e:
+         finished = ('error', e)
+      finally:
+         await response.aclose()
+      with self.__lock:
+         flight.finished = finished
+         self.__publish(flight, *finished)
+         # New requests start a new flight from now on
+         if self.__flights.get(key) is flight:
+            del self.__flights[key]
+
+   def total_request_tokens(self) -> int:
+      return self.provider.total_request_tokens()
+
+   def total_completion_tokens(self) -> int:
+      return self.provider.total_completion_tokens()
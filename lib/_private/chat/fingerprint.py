@@ -0,0 +1,19 @@
+import json, hashlib
+from lib import ChatContext
+
+def request_fingerprint(request: ChatContext) -> str:
+   """
+   Returns a hash of everything in the request that affects the response:
+   the model, the prompt and the sampling parameters. Two requests with the
+   same fingerprint are interchangeable.
+   """
+   data = json.dumps([
+      request.model,
+      request.system_prompt,
+      [[x.type, x.text] for x in request.document],
+      request.temperature,
+      request.max_tokens,
+      request.frequency_penalty,
+      request.presence_penalty,
+   ], ensure_ascii=False, separators=(',', ':'))
+   return hashlib.sha256(data.encode('utf-8')).hexdigest()
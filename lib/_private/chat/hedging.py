@@ -0,0 +1,162 @@
+import time, asyncio, dataclasses
+from threading import Lock
+from weakref import WeakKeyDictionary
+from lib import ChatGeneratorT, ChatContext, IChatProvider, LatencyHistogram
+
+_histograms: 'WeakKeyDictionary[IChatProvider, LatencyHistogram]' = \
+   WeakKeyDictionary()
+_histograms_lock = Lock()
+
+def get_latency_histogram(provider: IChatProvider) -> LatencyHistogram:
+   """
+   Returns the histogram of the times to first token of the provider, as
+   observed by every HedgedChatProvider using it.
+   """
+   with _histograms_lock:
+      histogram = _histograms.get(provider)
+      if histogram is None:
+         histogram = _histograms[provider] = LatencyHistogram()
+      return histogram
+
+class _Attempt:
+   """ One of the requests racing for the response. """
+   __slots__ = ('provider', 'response', 'task', 'started')
+
+   def __init__(self, provider: IChatProvider, request: ChatContext):
+      self.provider = provider
+      self.response = provider.fetch_response(request)
+      self.task: asyncio.Task | None = asyncio.ensure_future(
+         anext(self.response))
+      self.started = time.perf_counter()
+
+   async def close(self):
+      if self.task is not None and not self.task.done():
+         self.task.cancel()
+         try:
+            await self.task
+         except BaseException:
+            pass
+      await self.response.aclose()
+
+class HedgedChatProvider(IChatProvider):
+   """
+   Sends requests to the primary provider, and if the first token does not
+   arrive in time, sends a duplicate (hedged) request to the fallback
+   provider (the primary by default), optionally with a fallback model.
+   The response comes from whichever request produces its first token
+   first, and the other one is cancelled. A request that fails before its
+   first token is hedged right away (failover).
+
+   The hedging delay is the given percentile of the primary's times to
+   first token, so only the slowest requests are hedged. Until min_samples
+   times are recorded, default_delay is used instead.
+
+   Note that a hedge identical to the request it hedges would be merged
+   back into it by a CoalescingChatProvider, so the fallback should not be
+   the same coalescing provider as the primary.
+   """
+
+   def __init__(self, primary: IChatProvider,
+                fallback: IChatProvider | None = None,
+                fallback_model: str | None = None,
+                percentile: float = 95.0,
+                min_samples: int = 20,
+                default_delay: float = 2.0,
+                min_delay: float = 0.1):
+      self.primary = primary
+      self.fallback = fallback or primary
+      self.fallback_model = fallback_model
+      self.percentile = percentile
+      self.min_samples = min_samples
+      self.default_delay = default_delay
+      self.min_delay = min_delay
+      self.hedges = 0
+      self.hedge_wins = 0
+
+   def hedge_delay(self) -> float:
+      """ Returns the seconds to wait for the first token before hedging. """
+      histogram = get_latency_histogram(self.primary)
+      delay = histogram.percentile(self.percentile)
+      if delay is None or histogram.count < self.min_samples:
+         delay = self.default_delay
+      return max(delay, self.min_delay)
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.primary.get_num_tokens(request)
+
+   def __hedge(self, request: ChatContext) -> _Attempt:
+      self.hedges += 1
+      if self.fallback_model is not None:
+         request = dataclasses.replace(request, model=self.fallback_model)
+      return _Attempt(self.fallback, request)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      attempts = [_Attempt(self.primary, request)]
+      deadline = attempts[0].started + self.hedge_delay()
+      winner: _Attempt | None = None
+      first: tuple[str, int, int] | None = None
+      error: BaseException | None = None
+      try:
+         while winner is None:
+            running = [x for x in attempts if x.task is not None]
+            if len(running) == 0:
+               assert error is not None
+               raise error
+            timeout = None
+            if len(attempts) == 1:
+               timeout = max(0.0, deadline - time.perf_counter())
+            done, _ = await asyncio.wait(
+               [x.task for x in running],  # type: ignore
+               timeout=timeout,
+               return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+               # The primary is slow, race it against a hedge
+               attempts.append(self.__hedge(request))
+               continue
+            for attempt in running:
+               if attempt.task not in done:
+                  continue
+               task, attempt.task = attempt.task, None
+               try:
+                  first = task.result()  # type: ignore
+               except StopAsyncIteration:
+                  pass
+               except Exception as e:
+                  error = e
+                  continue
+               winner = attempt
+               get_latency_histogram(attempt.provider).record(
+                  time.perf_counter() - attempt.started)
+               break
+            if winner is None and len(attempts) == 1:
+               # The primary failed before its first token, fail over
+               attempts.append(self.__hedge(request))
+         if winner is not attempts[0]:
+            self.hedge_wins += 1
+         # Cancel the loser before streaming the winner
+         for attempt in attempts:
+            if attempt is not winner:
+               if attempt.task is not None:
+                  # A lower bound of its time to first token
+                  get_latency_histogram(attempt.provider).record(
+                     time.perf_counter() - attempt.started)
+               await attempt.close()
+         if first is not None:
+            yield first
+            async for chunk in winner.response:
+               yield chunk
+      finally:
+         for attempt in attempts:
+            await attempt.close()
+
+   def total_request_tokens(self) -> int:
+      total = self.primary.total_request_tokens()
+      if self.fallback is not self.primary:
+         total += self.fallback.total_request_tokens()
+      return total
+
+   def total_completion_tokens(self) -> int:
+      total = self.primary.total_completion_tokens()
+      if self.fallback is not self.primary:
+         total += self.fallback.total_completion_tokens()
+      return total
@@ -0,0 +1,373 @@
+import asyncio, threading
+import torch
+from queue import Queue, Empty
+from typing import Any
+from lib import (
+   ChatGeneratorT, ChatContext, IChatProvider, load_causal_lm_and_tokenizer
+)
+
+DEFAULT_LOCAL_MODEL = 'TinyLlama/TinyLlama-1.1B-Chat-v1.0'
+
+class _Sequence:
+   """ A request being generated by the worker. """
+   __slots__ = (
+      'request', 'max_tokens', 'loop', 'queue', 'cancelled', 'prompt',
+      'tokens', 'prefix_offset', 'read_offset', 'position'
+   )
+
+   def __init__(self, request: ChatContext, max_tokens: int,
+                loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+      self.request = request
+      self.max_tokens = max_tokens
+      self.loop = loop
+      self.queue = queue
+      self.cancelled = False
+      self.prompt: list[int] = []
+      self.tokens: list[int] = []
+      # The tokens before read_offset were streamed already, and the ones
+      # from prefix_offset to read_offset are decoded again along with the
+      # new tokens, so that spaces and multi-token characters come out right
+      self.prefix_offset = 0
+      self.read_offset = 0
+      # The position of the next token, which is also the number of tokens
+      # the sequence has in the KV cache
+      self.position = 0
+
+   def send(self, kind: str, value: Any):
+      try:
+         self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+      except RuntimeError:
+         # The caller's loop is closed, so nobody is listening
+         self.cancelled = True
+
+class LocalChatProvider(IChatProvider):
+   """
+   Generates responses with a causal language model on the CPU. A single
+   worker thread decodes every active request together: each step runs one
+   batched forward pass over the last token of every sequence. Requests join
+   the batch as soon as their prompt is processed, and leave it as soon as
+   they are done, so short requests never wait for long ones (continuous
+   batching).
+
+   Every sequence keeps its keys and values in one row of a shared KV cache.
+   Rows are left-padded to the longest sequence and the padding is masked
+   out, so sequences of different lengths can be decoded together.
+
+   The model of the requests is ignored, as the provider serves one model.
+   Call close() to stop the worker.
+   """
+
+   __pending: Queue[_Sequence | None]
+   __worker: threading.Thread | None
+   __lock: threading.Lock
+   __closed: bool
+   __cache_class: Any
+
+   def __init__(self, model_name: str = DEFAULT_LOCAL_MODEL,
+                max_batch_size: int = 8, default_max_tokens: int = 256,
+                num_threads: int | None = None):
+      self.model_name = model_name
+      self.max_batch_size = max_batch_size
+      self.default_max_tokens = default_max_tokens
+      self.num_threads = num_threads
+      self.model = None
+      self.tokenizer = None
+      self.total_reqtoks_ctr = 0
+      self.total_cmpltoks_ctr = 0
+      self.__pending = Queue()
+      self.__worker = None
+      self.__lock = threading.Lock()
+      self.__closed = False
+      self.__cache_class = None
+
+   def __start(self):
+      """ Starts the worker if needed. Call with the lock held. """
+      if self.__closed:
+         raise RuntimeError('The local chat provider is closed')
+      if self.__worker is None:
+         self.__worker = threading.Thread(
+            target=self.__run, name='local-chat-provider', daemon=True)
+         self.__worker.start()
+
+   def __encode(self, request: ChatContext) -> list[int]:
+      assert self.tokenizer is not None
+      messages = []
+      if request.system_prompt:
+         messages.append({'role': 'system', 'content': request.system_prompt})
+      for item in request.document:
+         messages.append({'role': item.type, 'content': item.text})
+      return self.tokenizer.apply_chat_template(
+         messages, add_generation_prompt=True)
+
+   def close(self, timeout: float | None = None) -> None:
+      """
+      Stops the worker. The requests still being generated (or waiting)
+      fail, and so do the requests made from now on.
+      """
+      with self.__lock:
+         if self.__closed:
+            return
+         self.__closed = True
+         worker = self.__worker
+      if worker is not None:
+         self.__pending.put(None)
+         worker.join(timeout)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      assert len(request.document) > 0, "Empty document"
+      queue: asyncio.Queue[tuple[str, Any]] = asyncio.Queue()
+      sequence = _Sequence(
+         request, request.max_tokens or self.default_max_tokens,
+         asyncio.get_running_loop(), queue)
+      with self.__lock:
+         self.__start()
+         # Queued under the lock, so close() never misses it
+         self.__pending.put(sequence)
+      try:
+         while True:
+            kind, value = await queue.get()
+            if kind == 'done':
+               break
+            if kind == 'error':
+               raise value
+            yield value
+      finally:
+         # Makes the worker drop the sequence at its next step
+         sequence.cancelled = True
+
+   def __run(self):
+      try:
+         if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+         self.model, self.tokenizer = load_causal_lm_and_tokenizer(
+            self.model_name)
+      except BaseException as e:
+         # Fail every request until the provider is closed
+         while True:
+            sequence = self.__pending.get()
+            if sequence is None:
+               return
+            sequence.send('error', e)
+      active: list[_Sequence] = []
+      past: tuple[tuple[torch.Tensor, torch.Tensor], ...] | None = None
+      mask: torch.Tensor | None = None
+      stopping = False
+      while not stopping:
+         # Wait for work if there is nothing to decode
+         pending: list[_Sequence | None] = []
+         if len(active) == 0:
+            pending.append(self.__pending.get())
+         while len(active) + len(pending) < self.max_batch_size:
+            try:
+               pending.append(self.__pending.get_nowait())
+            except Empty:
+               break
+         stopping = None in pending
+         active_new = [x for x in pending if x is not None]
+         if stopping:
+            self.__fail(active + active_new)
+            break
+         for sequence in active_new:
+            try:
+               new_past = self.__prefill(sequence)
+            except Exception as e:
+               sequence.send('error', e)
+               continue
+            if new_past is None:
+               continue
+            past, mask = _join_cache(past, mask, new_past, sequence.position)
+            active.append(sequence)
+         # Drop the sequences that are done (or whose callers left)
+         keep = [i for i, x in enumerate(active) if not x.cancelled]
+         if len(keep) < len(active):
+            active = [active[i] for i in keep]
+            past, mask = _select_cache(past, mask, keep)
+         if len(active) == 0:
+            past, mask = None, None
+            continue
+         try:
+            past, mask = self.__decode(active, past, mask)
+         except Exception as e:
+            for sequence in active:
+               sequence.send('error', e)
+            active, past, mask = [], None, None
+      # Fail whatever was queued after the stop sentinel
+      remaining: list[_Sequence] = []
+      while True:
+         try:
+            sequence = self.__pending.get_nowait()
+         except Empty:
+            break
+         if sequence is not None:
+            remaining.append(sequence)
+      self.__fail(remaining)
+
+   def __fail(self, sequences: list[_Sequence]):
+      """ Fails the sequences, as the provider is closed. """
+      for sequence in sequences:
+         sequence.send(
+            'error', RuntimeError('The local chat provider is closed'))
+
+   def __prefill(self, sequence: _Sequence):
+      """
+      Runs the prompt of the sequence through the model, and emits the first
+      token. Returns the KV cache of the sequence, or None if it is done.
+      """
+      assert self.model is not None
+      if sequence.cancelled:
+         return None
+      # The prompt is encoded here, as the tokenizer is loaded by the worker
+      sequence.prompt = self.__encode(sequence.request)
+      self.total_reqtoks_ctr += len(sequence.prompt)
+      input_ids = torch.tensor([sequence.prompt])
+      with torch.no_grad():
+         outputs = self.model(input_ids=input_ids, use_cache=True)
+      sequence.position = len(sequence.prompt)
+      if not self.__emit(sequence, outputs.logits[0, -1]):
+         return None
+      return self.__to_legacy(outputs.past_key_values)
+
+   def __to_legacy(self, past):
+      """
+      Converts the KV cache returned by the model into the legacy tuple of
+      (keys, values) per layer, which is what the batch is made of. Newer
+      versions of transformers return Cache objects instead, in which case
+      their class is kept to convert the batch back (see __from_legacy).
+      """
+      if hasattr(past, 'to_legacy_cache'):
+         self.__cache_class = type(past)
+         return past.to_legacy_cache()
+      return past
+
+   def __from_legacy(self, past):
+      """ Converts the batch into the KV cache the model expects. """
+      if self.__cache_class is not None:
+         return self.__cache_class.from_legacy_cache(past)
+      return past
+
+   def __decode(self, active: list[_Sequence],
+                past: tuple[tuple[torch.Tensor, torch.Tensor], ...],
+                mask: torch.Tensor):
+      """ Runs one decoding step over every active sequence. """
+      assert self.model is not None
+      input_ids = torch.tensor([[x.tokens[-1]] for x in active])
+      position_ids = torch.tensor([[x.position] for x in active])
+      mask = torch.cat([mask, mask.new_ones((len(active), 1))], dim=1)
+      with torch.no_grad():
+         outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=self.__from_legacy(past),
+            use_cache=True
+         )
+      for i, sequence in enumerate(active):
+         sequence.position += 1
+         if not self.__emit(sequence, outputs.logits[i, -1]):
+            sequence.cancelled = True
+      return self.__to_legacy(outputs.past_key_values), mask
+
+   def __emit(self, sequence: _Sequence, logits: torch.Tensor) -> bool:
+      """
+      Samples the next token of the sequence and streams the new text.
+      Returns False once the sequence is done.
+      """
+      assert self.tokenizer is not None
+      if sequence.cancelled:
+         return False
+      temperature = sequence.request.temperature
+      if temperature <= 0:
+         token = int(torch.argmax(logits))
+      else:
+         probs = torch.softmax(logits / temperature, dim=-1)
+         token = int(torch.multinomial(probs, 1))
+      if token == self.tokenizer.eos_token_id:
+         self.__finish(sequence)
+         return False
+      sequence.tokens.append(token)
+      self.total_cmpltoks_ctr += 1
+      # Only the tokens since the last streamed text are decoded, so every
+      # step takes constant time however long the response gets
+      window = sequence.tokens[sequence.prefix_offset:]
+      prefix = self.tokenizer.decode(
+         window[:sequence.read_offset - sequence.prefix_offset],
+         skip_special_tokens=True)
+      text = self.tokenizer.decode(window, skip_special_tokens=True)
+      # Hold back incomplete characters until the next token completes them
+      if len(text) > len(prefix) and not text.endswith('�'):
+         sequence.send('item', (
+            text[len(prefix):],
+            len(sequence.prompt),
+            len(sequence.tokens)
+         ))
+         sequence.prefix_offset = sequence.read_offset
+         sequence.read_offset = len(sequence.tokens)
+      if len(sequence.tokens) >= sequence.max_tokens:
+         self.__finish(sequence)
+         return False
+      return True
+
+   def __finish(self, sequence: _Sequence):
+      """
+      Streams the text that was held back (i.e., a character the response
+      ended in the middle of), then ends the sequence.
+      """
+      assert self.tokenizer is not None
+      window = sequence.tokens[sequence.prefix_offset:]
+      prefix = self.tokenizer.decode(
+         window[:sequence.read_offset - sequence.prefix_offset],
+         skip_special_tokens=True)
+      text = self.tokenizer.decode(window, skip_special_tokens=True)
+      if len(text) > len(prefix):
+         sequence.send('item', (
+            text[len(prefix):],
+            len(sequence.prompt),
+            len(sequence.tokens)
+         ))
+      sequence.send('done', None)
+
+   def total_request_tokens(self) -> int:
+      return self.total_reqtoks_ctr
+
+   def total_completion_tokens(self) -> int:
+      return self.total_cmpltoks_ctr
+
+def _join_cache(past, mask, new_past, length: int):
+   """
+   Adds the KV cache of a new sequence (of the given length) as a new row
+   of the batch, left-padding the shorter side.
+   """
+   new_mask = torch.ones((1, length), dtype=torch.long)
+   if past is None:
+      return new_past, new_mask
+   total = max(mask.shape[1], length)
+   def pad(x: torch.Tensor, dim: int) -> torch.Tensor:
+      missing = total - x.shape[dim]
+      if missing == 0:
+         return x
+      shape = list(x.shape)
+      shape[dim] = missing
+      return torch.cat([x.new_zeros(shape), x], dim=dim)
+   past = tuple(
+      (torch.cat([pad(k, 2), pad(nk, 2)]), torch.cat([pad(v, 2), pad(nv, 2)]))
+      for (k, v), (nk, nv) in zip(past, new_past)
+   )
+   return past, torch.cat([pad(mask, 1), pad(new_mask, 1)])
+
+def _select_cache(past, mask, rows: list[int]):
+   """
+   Keeps the given rows of the batch, and drops the leading columns that are
+   padding in every remaining row.
+   """
+   if len(rows) == 0:
+      return None, None
+   index = torch.tensor(rows)
+   mask = mask.index_select(0, index)
+   start = int(mask.sum(dim=0).nonzero()[0])
+   mask = mask[:, start:]
+   past = tuple(
+      (k.index_select(0, index)[:, :, start:],
+       v.index_select(0, index)[:, :, start:])
+      for k, v in past
+   )
+   return past, mask
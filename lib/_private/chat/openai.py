@@ -1,49 +1,150 @@
-import tiktoken
-import openai
+import os, json, time, asyncio, httpx
+from concurrent.futures import Future
+from threading import Lock
 from openai import AsyncOpenAI
-from lib import ChatGeneratorT, ChatContext, IChatProvider
+from lib import (
+   ChatGeneratorT, ChatContext, IChatProvider, get_background_loop,
+   count_prompt_tokens
+)
 
 DEFAULT_MODEL = 'gpt-3.5-turbo-1106'
+MODELS_TTL = 24 * 3600
 
 class OpenAIChatProvider(IChatProvider):
-   models: set[str]
+   """
+   Streams responses from OpenAI's chat completions API. Nothing is sent
+   over the network when the provider is created: the model list is read
+   from the on-disk cache (if any, and if fresh), or fetched in the
+   background. Requests wait for the model list only if it is not there
+   yet, and fail if it cannot be fetched (i.e., the API key is invalid).
+   """
+   models: set[str] | None
    total_reqtoks_ctr: int
    total_cmpltoks_ctr: int
    api_key: str | None
-   encoding: tiktoken.Encoding
+   base_url: str | None
+   client: AsyncOpenAI | None
 
-   def __init__(self, api_key: str | None = None):
+   models_cache: str | None
+   __models_future: Future[set[str]] | None
+   __lock: Lock
+
+   def __init__(self, api_key: str | None = None,
+                base_url: str | None = None,
+                max_connections: int = 64,
+                models_cache: str | None = None,
+                models_ttl: float = MODELS_TTL):
       super().__init__()
       self.api_key = api_key
-      # Test the API key
-      try:
-         model_list = openai.models.list().data
-         self.models = set([d.id for d in model_list])
-      except:
-         raise ValueError("Invalid OpenAI API key")
+      self.base_url = base_url
+      self.max_connections = max_connections
+      self.models_cache = models_cache
+      self.models_ttl = models_ttl
       self.total_cmpltoks_ctr = 0
       self.total_reqtoks_ctr = 0
-      self.encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
+      self.client = None
+      self.__models_future = None
+      self.__lock = Lock()
+      self.models = self.__load_models()
+      if self.models is None:
+         self.refresh_models()
+
+   def __load_models(self) -> set[str] | None:
+      """ Reads the model list from the cache, if it is fresh. """
+      if self.models_cache is None:
+         return None
+      try:
+         with open(self.models_cache, 'r') as f:
+            data = json.load(f)
+      except (OSError, ValueError):
+         return None
+      if data.get('base_url') != self.base_url or \
+            time.time() - data['created'] > self.models_ttl:
+         return None
+      return set(data['models'])
+
+   def __store_models(self, models: set[str]):
+      if self.models_cache is None:
+         return
+      os.makedirs(os.path.dirname(self.models_cache) or '.', exist_ok=True)
+      # Write to a temporary file first so readers never see a partial list
+      tmp_path = f'{self.models_cache}.{os.getpid()}.tmp'
+      with open(tmp_path, 'w') as f:
+         json.dump({
+            'created': time.time(),
+            'base_url': self.base_url,
+            'models': sorted(models)
+         }, f)
+      os.replace(tmp_path, self.models_cache)
+
+   def refresh_models(self) -> Future[set[str]]:
+      """
+      Fetches the model list in the background, unless a fetch is already
+      in progress. Returns the future of the fetch.
+      """
+      with self.__lock:
+         if self.__models_future is None or self.__models_future.done():
+            self.__models_future = get_background_loop().submit(
+               self.__fetch_models())
+         return self.__models_future
+
+   async def __fetch_models(self) -> set[str]:
+      model_list = await self.get_client().models.list()
+      models = set([d.id for d in model_list.data])
+      self.models = models
+      try:
+         self.__store_models(models)
+      except OSError:
+         pass
+      return models
+
+   async def get_models(self) -> set[str]:
+      """
+      Returns the models available to the API key, waiting for the model
+      list to be fetched if needed.
+      """
+      if self.models is not None:
+         return self.models
+      try:
+         return await asyncio.wrap_future(self.refresh_models())
+      except Exception as e:
+         raise ValueError(
+            "Could not list the OpenAI models (is the API key valid?)") from e
+
+   def get_client(self) -> AsyncOpenAI:
+      """
+      Returns the client shared by every request. The client (and its
+      keep-alive connection pool) is bound to the background loop, as the
+      loop that calls fetch_response may only live for a single request.
+      """
+      if self.client is None:
+         self.client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=httpx.AsyncClient(
+               limits=httpx.Limits(
+                  max_connections=self.max_connections,
+                  max_keepalive_connections=self.max_connections,
+                  keepalive_expiry=60,
+               ),
+            ),
+         )
+      return self.client
 
    def get_num_tokens(self, request: ChatContext) -> int:
-      entire_prompt: list[str] = []
-      if request.system_prompt:
-         entire_prompt.append(request.system_prompt)
-      entire_prompt.extend([x.text for x in request.document])
-      prompt_encoding = self.encoding.encode_batch(entire_prompt)
-      prompt_tokens = sum([len(x) for x in prompt_encoding])
-      # TODO: Add system tokens and other special tokens
-      # Let's estimate the special token counts for now...
-      if request.system_prompt:
-         prompt_tokens += 2
-      prompt_tokens += 2 * len(request.document)
-      return prompt_tokens
+      return count_prompt_tokens(request, request.model or DEFAULT_MODEL)
 
    async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      # The request runs on the background loop, which owns the client
+      async for chunk in get_background_loop().iterate(
+            self.__fetch_response(request)):
+         yield chunk
+
+   async def __fetch_response(self, request: ChatContext) -> ChatGeneratorT:
       assert len(request.document) > 0, "Empty document"
       # Check if the model exists
       model = request.model or DEFAULT_MODEL
-      if model not in self.models:
+      if model not in await self.get_models():
          raise ValueError(f"Invalid OpenAI model: {model}")
       # Grab the number of prompt tokens
       prompt_tokens = self.get_num_tokens(request)
@@ -67,9 +168,7 @@ class OpenAIChatProvider(IChatProvider):
                'content': doc.text
             })
       # Send the prompt to OpenAI
-      # FIXME: We cannot cache the client... why?
-      client = AsyncOpenAI(api_key=self.api_key)
-      response = await client.chat.completions.create(
+      response = await self.get_client().chat.completions.create(
          model=model,
          messages=messages,
          frequency_penalty=request.frequency_penalty,
@@ -81,15 +180,20 @@ class OpenAIChatProvider(IChatProvider):
       )
       # Now iterate over the response and yield each chunk
       completion_tokens = 0
-      async for chunk in response:
-         # Update the token counters
-         completion_tokens += 1
-         self.total_cmpltoks_ctr += 1
-         # Yield the chunk
-         content = chunk.choices[0].delta.content
-         if content is None:
-            continue
-         yield (content, prompt_tokens, completion_tokens)
+      try:
+         async for chunk in response:
+            # Update the token counters
+            completion_tokens += 1
+            self.total_cmpltoks_ctr += 1
+            # Yield the chunk
+            content = chunk.choices[0].delta.content
+            if content is None:
+               continue
+            yield (content, prompt_tokens, completion_tokens)
+      finally:
+         # Close the stream, so a cancelled request stops generating tokens
+         # (this only releases the connection back to the pool)
+         await response.response.aclose()
 
    def total_request_tokens(self) -> int:
       return self.total_reqtoks_ctr
@@ -0,0 +1,128 @@
+import os, json, time, asyncio, itertools
+from threading import Lock
+from typing import Any
+from lib import ChatGeneratorT, ChatContext, IChatProvider
+from .fingerprint import request_fingerprint
+
+class RecordingChatProvider(IChatProvider):
+   """
+   Wraps a provider and records every response it streams to a JSONL file,
+   one line per response, so that ReplayChatProvider can play it back. Every
+   chunk is stored with its token counts and the seconds since the previous
+   chunk (or since the request, for the first chunk). Responses that did not
+   finish streaming are not recorded.
+   """
+
+   __lock: Lock
+
+   def __init__(self, provider: IChatProvider, path: str):
+      self.provider = provider
+      self.path = path
+      self.__lock = Lock()
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.provider.get_num_tokens(request)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      chunks: list[tuple[str, int, int, float]] = []
+      mark = time.perf_counter()
+      async for text, prompt_tokens, completion_tokens in \
+            self.provider.fetch_response(request):
+         now = time.perf_counter()
+         chunks.append((text, prompt_tokens, completion_tokens, now - mark))
+         mark = now
+         yield (text, prompt_tokens, completion_tokens)
+      self.__write({
+         'fingerprint': request_fingerprint(request),
+         'model': request.model,
+         'system_prompt': request.system_prompt,
+         'chunks': chunks,
+      })
+
+   def __write(self, entry: dict[str, Any]):
+      line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+      with self.__lock:
+         os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+         with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+   def total_request_tokens(self) -> int:
+      return self.provider.total_request_tokens()
+
+   def total_completion_tokens(self) -> int:
+      return self.provider.total_completion_tokens()
+
+RecordingT = list[tuple[str, int, int, float]]
+
+class ReplayChatProvider(IChatProvider):
+   """
+   Plays back the responses recorded by RecordingChatProvider, with their
+   original timing multiplied by time_scale (0 replays without any delay).
+   The delays are asyncio sleeps, so replays never block the event loop.
+
+   A request gets the recording of an identical request if there is one.
+   Otherwise, it gets a recording of a request with the same model and
+   system prompt (i.e., the same flow step), and failing that, any
+   recording. Requests that match several recordings cycle through them.
+   If strict is set, requests without an identical recording fail instead.
+   """
+
+   __by_fingerprint: dict[str, 'itertools.cycle[RecordingT]']
+   __by_step: dict[tuple[str | None, str], 'itertools.cycle[RecordingT]']
+   __any: 'itertools.cycle[RecordingT] | None'
+   __lock: Lock
+
+   def __init__(self, path: str, time_scale: float = 1.0,
+                strict: bool = False):
+      self.path = path
+      self.time_scale = time_scale
+      self.strict = strict
+      self.total_reqtoks_ctr = 0
+      self.total_cmpltoks_ctr = 0
+      self.__lock = Lock()
+      by_fingerprint: dict[str, list[RecordingT]] = {}
+      by_step: dict[tuple[str | None, str], list[RecordingT]] = {}
+      recordings: list[RecordingT] = []
+      with open(path, 'r', encoding='utf-8') as f:
+         for line in f:
+            # Skip a torn write at the end of the file
+            if not line.endswith('\n'):
+               continue
+            entry = json.loads(line)
+            chunks = [(t, p, c, d) for t, p, c, d in entry['chunks']]
+            by_fingerprint.setdefault(entry['fingerprint'], []).append(chunks)
+            by_step.setdefault(
+               (entry['model'], entry['system_prompt']), []).append(chunks)
+            recordings.append(chunks)
+      self.recordings = len(recordings)
+      self.__by_fingerprint = {
+         k: itertools.cycle(v) for k, v in by_fingerprint.items()}
+      self.__by_step = {k: itertools.cycle(v) for k, v in by_step.items()}
+      self.__any = itertools.cycle(recordings) if recordings else None
+
+   def __find(self, request: ChatContext) -> RecordingT:
+      with self.__lock:
+         found = self.__by_fingerprint.get(request_fingerprint(request))
+         if found is None and not self.strict:
+            found = self.__by_step.get(
+               (request.model, request.system_prompt), self.__any)
+         if found is None:
+            raise ValueError(f'No recording for the request in {self.path}')
+         return next(found)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      assert len(request.document) > 0, "Empty document"
+      chunks = self.__find(request)
+      if len(chunks) > 0:
+         self.total_reqtoks_ctr += chunks[0][1]
+      for text, prompt_tokens, completion_tokens, delay in chunks:
+         if self.time_scale > 0 and delay > 0:
+            await asyncio.sleep(delay * self.time_scale)
+         self.total_cmpltoks_ctr += 1
+         yield (text, prompt_tokens, completion_tokens)
+
+   def total_request_tokens(self) -> int:
+      return self.total_reqtoks_ctr
+
+   def total_completion_tokens(self) -> int:
+      return self.total_cmpltoks_ctr
@@ -0,0 +1,255 @@
+import time, heapq, asyncio, itertools
+from dataclasses import dataclass
+from threading import Lock
+from lib import ChatGeneratorT, ChatContext, IChatProvider
+
+PRIORITY_INTERACTIVE = 0
+""" The priority of final-answer steps, which a user is waiting on. """
+
+PRIORITY_BACKGROUND = 1
+""" The priority of intermediate steps. """
+
+class TokenBucket:
+   """
+   A token bucket holding up to `capacity` tokens, refilled at a constant
+   rate so that the bucket fills up once per `period` seconds. Not
+   thread-safe on its own.
+   """
+
+   def __init__(self, capacity: float, period: float = 60.0):
+      self.capacity = capacity
+      self.rate = capacity / period
+      self.tokens = capacity
+      self.updated = time.monotonic()
+
+   def refill(self, now: float) -> None:
+      self.tokens = min(
+         self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+   def delay(self, amount: float) -> float:
+      """ Returns the seconds until `amount` tokens are available. """
+      amount = min(amount, self.capacity)
+      if self.tokens >= amount:
+         return 0.0
+      return (amount - self.tokens) / self.rate
+
+   def take(self, amount: float) -> None:
+      self.tokens -= min(amount, self.capacity)
+
+   def give(self, amount: float) -> None:
+      self.tokens = min(self.capacity, self.tokens + amount)
+
+@dataclass(slots=True)
+class SchedulerStats:
+   """
+   A snapshot of the state of a scheduler. Times are in seconds.
+   """
+
+   queue_depth: int = 0
+   """ The number of requests waiting to be sent. """
+
+   in_flight: int = 0
+   """ The number of requests being streamed. """
+
+   requests: int = 0
+   """ The number of requests sent so far. """
+
+   total_wait_time: float = 0.0
+   """ The total time requests spent in the queue. """
+
+   max_wait_time: float = 0.0
+   """ The longest time a request spent in the queue. """
+
+   @property
+   def mean_wait_time(self) -> float:
+      if self.requests == 0:
+         return 0.0
+      return self.total_wait_time / self.requests
+
+class _Waiter:
+   __slots__ = ('priority', 'seq', 'tokens', 'loop', 'future', 'granted')
+
+   def __init__(self, priority: int, seq: int, tokens: int,
+                loop: asyncio.AbstractEventLoop):
+      self.priority = priority
+      self.seq = seq
+      self.tokens = tokens
+      self.loop = loop
+      self.future: asyncio.Future[None] = loop.create_future()
+      self.granted = False
+
+   def __lt__(self, other: '_Waiter') -> bool:
+      return (self.priority, self.seq) < (other.priority, other.seq)
+
+class RateLimitScheduler:
+   """
+   Decides when requests may be sent upstream, given a budget of requests
+   per minute, tokens per minute and concurrent requests (any of which may
+   be None for no limit). Requests wait in a priority queue and are sent in
+   order of priority, then arrival. The scheduler is thread-safe, so it can
+   be shared by sessions running on different event loops.
+   """
+
+   __queue: list[_Waiter]
+   __lock: Lock
+
+   def __init__(self, requests_per_minute: float | None = None,
+                tokens_per_minute: float | None = None,
+                max_concurrency: int | None = None):
+      self.requests = TokenBucket(requests_per_minute) \
+         if requests_per_minute else None
+      self.tokens = TokenBucket(tokens_per_minute) \
+         if tokens_per_minute else None
+      self.max_concurrency = max_concurrency
+      self.__queue = []
+      self.__seq = itertools.count()
+      self.__lock = Lock()
+      self.__stats = SchedulerStats()
+
+   def stats(self) -> SchedulerStats:
+      """ Returns a snapshot of the queue depth and wait times. """
+      with self.__lock:
+         return SchedulerStats(
+            queue_depth=sum(
+               1 for x in self.__queue if not x.future.cancelled()),
+            in_flight=self.__stats.in_flight,
+            requests=self.__stats.requests,
+            total_wait_time=self.__stats.total_wait_time,
+            max_wait_time=self.__stats.max_wait_time,
+         )
+
+   def __dispatch(self) -> float | None:
+      """
+      Grants as many waiters as the budgets allow, in priority order. Returns
+      the seconds until the budgets allow the next waiter, if any is left.
+      Call with the lock held.
+      """
+      now = time.monotonic()
+      for bucket in (self.requests, self.tokens):
+         if bucket is not None:
+            bucket.refill(now)
+      while len(self.__queue) > 0:
+         head = self.__queue[0]
+         if head.future.cancelled():
+            heapq.heappop(self.__queue)
+            continue
+         if self.max_concurrency is not None and \
+               self.__stats.in_flight >= self.max_concurrency:
+            # Woken up again when a request finishes
+            return None
+         delay = max(
+            self.requests.delay(1) if self.requests else 0.0,
+            self.tokens.delay(head.tokens) if self.tokens else 0.0)
+         if delay > 0:
+            return delay
+         heapq.heappop(self.__queue)
+         if self.requests is not None:
+            self.requests.take(1)
+         if self.tokens is not None:
+            self.tokens.take(head.tokens)
+         head.granted = True
+         self.__stats.in_flight += 1
+         try:
+            head.loop.call_soon_threadsafe(_resolve, head.future)
+         except RuntimeError:
+            # The waiter's loop is closed, give its budget back
+            self.__release(head.tokens)
+      return None
+
+   def __release(self, refund: int = 0) -> None:
+      """ Call with the lock held. """
+      self.__stats.in_flight -= 1
+      if refund > 0:
+         if self.requests is not None:
+            self.requests.give(1)
+         if self.tokens is not None:
+            self.tokens.give(refund)
+
+   async def acquire(self, tokens: int, priority: int) -> float:
+      """
+      Waits until a request with the given number of tokens may be sent, and
+      returns the time spent waiting. Every acquire must be followed by a
+      release once the request is done.
+      """
+      started = time.monotonic()
+      waiter = _Waiter(priority, next(self.__seq), tokens,
+                       asyncio.get_running_loop())
+      with self.__lock:
+         heapq.heappush(self.__queue, waiter)
+         delay = self.__dispatch()
+      try:
+         while not waiter.future.done():
+            try:
+               await asyncio.wait_for(asyncio.shield(waiter.future), delay)
+            except asyncio.TimeoutError:
+               pass
+            with self.__lock:
+               delay = self.__dispatch()
+      except asyncio.CancelledError:
+         with self.__lock:
+            waiter.future.cancel()
+            if waiter.granted:
+               # Granted, but never sent
+               self.__release(waiter.tokens)
+               self.__dispatch()
+         raise
+      waited = time.monotonic() - started
+      with self.__lock:
+         self.__stats.requests += 1
+         self.__stats.total_wait_time += waited
+         self.__stats.max_wait_time = max(self.__stats.max_wait_time, waited)
+      return waited
+
+   def release(self) -> None:
+      """ Marks a request as done, letting the next one in. """
+      with self.__lock:
+         self.__release()
+         self.__dispatch()
+
+def _resolve(future: asyncio.Future[None]):
+   if not future.done():
+      future.set_result(None)
+
+def request_priority(request: ChatContext) -> int:
+   """
+   Returns the priority of the request. Final-answer steps go first, unless
+   the flow sets a 'priority' in the user data of the context.
+   """
+   priority = request.user_data.get('priority')
+   if isinstance(priority, int):
+      return priority
+   if request.is_final_context:
+      return PRIORITY_INTERACTIVE
+   return PRIORITY_BACKGROUND
+
+class ScheduledChatProvider(IChatProvider):
+   """
+   Wraps a provider so that its requests go through a RateLimitScheduler.
+   The tokens of a request are estimated as its prompt tokens plus its
+   max_tokens, as the upstream rate limits count both. The time a request
+   spent in the queue is recorded in the queue_time of its step metrics.
+   """
+
+   def __init__(self, provider: IChatProvider, scheduler: RateLimitScheduler):
+      self.provider = provider
+      self.scheduler = scheduler
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.provider.get_num_tokens(request)
+
+   async def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      tokens = self.get_num_tokens(request) + (request.max_tokens or 0)
+      request.metrics.queue_time = await self.scheduler.acquire(
+         tokens, request_priority(request))
+      try:
+         async for chunk in self.provider.fetch_response(request):
+            yield chunk
+      finally:
+         self.scheduler.release()
+
+   def total_request_tokens(self) -> int:
+      return self.provider.total_request_tokens()
+
+   def total_completion_tokens(self) -> int:
+      return self.provider.total_completion_tokens()
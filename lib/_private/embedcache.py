@@ -0,0 +1,239 @@
+"""
+Internal module for caching embedding vectors on disk.
+"""
+
+import os, hashlib, contextlib
+import numpy as np
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+
+try:
+   import fcntl
+except ImportError:
+   # Not available on Windows, where the cache is single-process only
+   fcntl = None
+
+class EmbeddingCache:
+   """
+   A persistent cache of the embedding vectors of a single model, keyed by
+   the hash of (model name, instruction prefix, text). The vectors are
+   appended to a flat float32 file that is read back through a memory map,
+   so opening the cache only reads the keys. The most recently used vectors
+   are also kept in an in-memory LRU for hot queries. Thread-safe.
+
+   Several processes can share the cache: writers hold an exclusive lock on
+   the lock file (with fcntl, on POSIX systems) while they append, and pick
+   up the entries appended by the other processes first. The vectors file is
+   written before the keys file, so a key is never read before its vector,
+   and a torn write (of a killed writer) is truncated under the lock.
+
+   Entries are never evicted from the files, so every new text (including
+   every distinct user query) adds a row, and a key in memory. Once
+   max_entries rows are stored, new vectors are only kept in the in-memory
+   LRU. Rows are never rewritten in place, as the other processes hold
+   their row numbers, so the cache is reset by removing its directory while
+   no process uses it.
+   """
+
+   __rows: dict[bytes, int]
+   __synced: int
+   __hot: OrderedDict[bytes, np.ndarray]
+   __vectors: np.memmap | None
+   __lock: Lock
+
+   def __init__(self, directory: str, model_name: str, dimension: int,
+                hot_entries: int = 4096, max_entries: int = 262144):
+      self.directory = directory
+      self.model_name = model_name
+      self.dimension = dimension
+      self.hot_entries = hot_entries
+      self.max_entries = max_entries
+      self.__rows = {}
+      self.__synced = 0
+      self.__hot = OrderedDict()
+      self.__vectors = None
+      self.__lock = Lock()
+      os.makedirs(directory, exist_ok=True)
+      self.__keys_path = os.path.join(directory, 'keys.bin')
+      self.__vectors_path = os.path.join(directory, 'vectors.f32')
+      self.__lock_path = os.path.join(directory, 'lock')
+      with self.__file_lock():
+         self.__sync()
+         self.__truncate()
+
+   @contextlib.contextmanager
+   def __file_lock(self):
+      """ Holds the lock shared by every process using the cache. """
+      if fcntl is None:
+         yield
+         return
+      with open(self.__lock_path, 'a+b') as f:
+         fcntl.flock(f, fcntl.LOCK_EX)
+         try:
+            yield
+         finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+   def __truncate(self):
+      """
+      Drops whatever is past the last complete entry, left behind by a
+      writer that was killed. Call with the file lock held, after a sync.
+      """
+      for path, size in (
+            (self.__vectors_path, self.__synced * self.dimension * 4),
+            (self.__keys_path, self.__synced * 16)):
+         if os.path.isfile(path) and os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+               f.truncate(size)
+
+   def __sync(self):
+      """
+      Reads the keys appended (by any process) since the last sync. Call
+      with the lock held.
+      """
+      if not os.path.isfile(self.__keys_path):
+         return
+      # Every key is a 16 byte digest, and only counts once its vector is in
+      vectors = os.path.getsize(self.__vectors_path) // (self.dimension * 4) \
+         if os.path.isfile(self.__vectors_path) else 0
+      count = min(os.path.getsize(self.__keys_path) // 16, vectors)
+      if count <= self.__synced:
+         return
+      with open(self.__keys_path, 'rb') as f:
+         f.seek(self.__synced * 16)
+         keys = f.read((count - self.__synced) * 16)
+      for row in range(self.__synced, count):
+         offset = (row - self.__synced) * 16
+         self.__rows.setdefault(keys[offset:offset + 16], row)
+      self.__synced = count
+
+   def key(self, prefix: str, text: str) -> bytes:
+      """ Returns the cache key of the text with the instruction prefix. """
+      h = hashlib.blake2b(digest_size=16)
+      for part in (self.model_name, prefix, text):
+         data = part.encode('utf-8')
+         h.update(len(data).to_bytes(8, 'little'))
+         h.update(data)
+      return h.digest()
+
+   def __len__(self):
+      return len(self.__rows)
+
+   def __read(self, row: int) -> np.ndarray:
+      """ Call with the lock held. """
+      if self.__vectors is None or row >= self.__vectors.shape[0]:
+         # The file grew since it was mapped
+         self.__vectors = np.memmap(
+            self.__vectors_path, dtype=np.float32, mode='r',
+            shape=(self.__synced, self.dimension))
+      return np.array(self.__vectors[row])
+
+   def __remember(self, key: bytes, vector: np.ndarray):
+      """ Call with the lock held. """
+      self.__hot[key] = vector
+      self.__hot.move_to_end(key)
+      while len(self.__hot) > self.hot_entries:
+         self.__hot.popitem(last=False)
+
+   def get_many(self, keys: list[bytes]) -> list[np.ndarray | None]:
+      """ Returns the cached vector of every key, or None on a miss. """
+      result: list[np.ndarray | None] = []
+      with self.__lock:
+         if any(key not in self.__rows for key in keys):
+            # Other processes may have added them since
+            self.__sync()
+         for key in keys:
+            vector = self.__hot.get(key)
+            if vector is None:
+               row = self.__rows.get(key)
+               if row is not None:
+                  vector = self.__read(row)
+                  self.__remember(key, vector)
+            else:
+               self.__hot.move_to_end(key)
+            result.append(vector)
+      return result
+
+   def put_many(self, keys: list[bytes], vectors: np.ndarray) -> None:
+      """ Stores the vectors (one row per key) in the cache. """
+      vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+      with self.__lock, self.__file_lock():
+         self.__sync()
+         stored = {key for key in keys if key in self.__rows}
+         new = [i for i, key in enumerate(keys) if key not in stored]
+         # Rows must line up with the keys, so duplicates are stored once
+         new = list({keys[i]: i for i in new}.values())
+         # A full cache stores nothing more on disk
+         new = new[:max(self.max_entries - self.__synced, 0)]
+         if len(new) > 0:
+            # The new rows must start right after the last complete entry
+            self.__truncate()
+            with open(self.__vectors_path, 'ab') as f:
+               f.write(vectors[new].tobytes())
+            with open(self.__keys_path, 'ab') as f:
+               f.write(b''.join(keys[i] for i in new))
+            for i in new:
+               self.__rows[keys[i]] = self.__synced
+               self.__synced += 1
+         # The vectors already stored (i.e., by another process) win, so
+         # the memory never disagrees with the files
+         for key, vector in zip(keys, vectors):
+            if key not in stored:
+               self.__remember(key, vector)
+
+def embed_cached(cache: EmbeddingCache | None,
+                 items: list[tuple[str, str]],
+                 run_batch: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+   """
+   Embeds the (instruction prefix, text) items, running the model (through
+   run_batch, which takes the prefixed texts) only on the cache misses. The
+   vectors are returned in the order of the items.
+   """
+   if cache is None or len(items) == 0:
+      return run_batch([prefix + text for prefix, text in items])
+   keys = [cache.key(prefix, text) for prefix, text in items]
+   found = cache.get_many(keys)
+   misses = [i for i, x in enumerate(found) if x is None]
+   result = np.empty((len(items), cache.dimension), dtype=np.float32)
+   for i, vector in enumerate(found):
+      if vector is not None:
+         result[i] = vector
+   if len(misses) > 0:
+      # Items repeated within the batch are embedded once
+      unique = list({keys[i]: i for i in misses}.values())
+      vectors = run_batch([items[i][0] + items[i][1] for i in unique])
+      cache.put_many([keys[i] for i in unique], vectors)
+      row = {keys[i]: j for j, i in enumerate(unique)}
+      result[misses] = vectors[[row[keys[i]] for i in misses]]
+   return result
+
+_embedding_caches: dict[str, EmbeddingCache] = {}
+_embedding_caches_lock = Lock()
+
+def get_embedding_cache(model_name: str,
+                        dimension: int) -> EmbeddingCache | None:
+   """
+   Returns the embedding cache of the model, shared by every embedder of
+   the model. The caches live in DUCKY_CACHE_DIR/embeddings, and are
+   disabled by setting DUCKY_EMBEDDING_CACHE=0. DUCKY_EMBEDDING_CACHE_SIZE
+   sets the number of entries a cache stores on disk (see EmbeddingCache).
+   """
+   from .resolver import cache_dir
+   if os.environ.get('DUCKY_EMBEDDING_CACHE', '1') == '0':
+      return None
+   with _embedding_caches_lock:
+      cache = _embedding_caches.get(model_name)
+      if cache is None:
+         directory = os.path.join(
+            cache_dir, 'embeddings', model_name.replace('/', '--'))
+         cache = _embedding_caches[model_name] = EmbeddingCache(
+            directory, model_name, dimension, max_entries=int(
+               os.environ.get('DUCKY_EMBEDDING_CACHE_SIZE', '262144')))
+      return cache
+
+__all__ = [
+   'EmbeddingCache',
+   'embed_cached',
+   'get_embedding_cache'
+]
@@ -3,6 +3,7 @@ from docarray import BaseDoc, DocList
 from docarray.typing import NdArray
 from typing import Callable, Generator, TypeVar, overload
 from pydantic import create_model, Field
+import os
 import numpy as np
 
 class IEmbedder(ABC):
@@ -102,6 +103,70 @@ def batch_embed_raw(docs: list[T], embedder: EmbedderT[T],
       i += batch
    return returnvec
 
+def bucket_by_length(lengths: list[int], max_tokens: int) -> list[list[int]]:
+   """Groups the inputs into batches of similar lengths. The inputs are sorted by length (longest first), and each batch takes as many inputs as fit in the token budget once padded to its longest input, so short inputs are not padded to the length of a long one.
+
+   Args:
+       lengths (list[int]): The (tokenized) length of every input.
+       max_tokens (int): The token budget of a batch, counting the padding. An input longer than the budget gets a batch of its own.
+
+   Returns:
+       list[list[int]]: The indices of the inputs in every batch.
+   """
+   order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+   batches: list[list[int]] = []
+   batch: list[int] = []
+   for i in order:
+      # The first input of a batch is the longest one
+      if len(batch) > 0 and \
+            (len(batch) + 1) * max(lengths[batch[0]], 1) > max_tokens:
+         batches.append(batch)
+         batch = []
+      batch.append(i)
+   if len(batch) > 0:
+      batches.append(batch)
+   return batches
+
+def run_bucketed(lengths: list[int], run: Callable[[list[int]], np.ndarray],
+                 max_tokens: int, dimension: int) -> np.ndarray:
+   """Runs the model over the inputs in length-bucketed batches (see bucket_by_length) and scatters the vectors back to the order of the inputs.
+
+   Args:
+       lengths (list[int]): The (tokenized) length of every input.
+       run (Callable[[list[int]], np.ndarray]): Embeds the inputs with the given indices.
+       max_tokens (int): The token budget of a batch, counting the padding.
+       dimension (int): The dimension of the vectors.
+
+   Returns:
+       np.ndarray: The vectors, in the order of the inputs.
+   """
+   result = np.empty((len(lengths), dimension), dtype=np.float32)
+   for batch in bucket_by_length(lengths, max_tokens):
+      result[batch] = run(batch)
+   return result
+
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+def resolve_embedding_backend(backend: str | None = None) -> str:
+   """Returns the inference backend an embedder should use: the given one, or DUCKY_EMBEDDING_BACKEND, or torch.
+
+   The 'onnx' backend runs the model exported to ONNX with ONNX Runtime, and 'onnx-int8' runs it dynamically quantized to int8 (see load_onnx_model).
+
+   Args:
+       backend (str | None, optional): The backend. Defaults to None.
+
+   Raises:
+       ValueError: If the backend is not one of EMBEDDING_BACKENDS.
+
+   Returns:
+       str: The backend.
+   """
+   if backend is None:
+      backend = os.environ.get('DUCKY_EMBEDDING_BACKEND', 'torch')
+   if backend not in EMBEDDING_BACKENDS:
+      raise ValueError(f'Invalid embedding backend: {backend}')
+   return backend
+
 def EmbeddedDoc(embeddings: dict[str, IEmbedder]):
    """This decorator adds the embeddings to the doc. The embedding fields are then added to the doc type.
 
@@ -128,5 +193,9 @@ __all__ = [
    'IEmbedder',
    'batch_embed',
    'batch_embed_raw',
+   'bucket_by_length',
+   'run_bucketed',
+   'EMBEDDING_BACKENDS',
+   'resolve_embedding_backend',
    'EmbeddedDoc'
 ]
@@ -0,0 +1,173 @@
+"""
+Internal module for sharing embedding batches across concurrent callers.
+"""
+
+import time, asyncio, threading
+import numpy as np
+from queue import Queue, Empty
+from typing import Any, Callable
+
+class _Request:
+   """ The texts of one caller, waiting for their vectors. """
+   __slots__ = ('texts', 'loop', 'future', 'cancelled')
+
+   def __init__(self, texts: list[str], loop: asyncio.AbstractEventLoop,
+                future: asyncio.Future):
+      self.texts = texts
+      self.loop = loop
+      self.future = future
+      # Set by the caller once it stops waiting, as asyncio futures must
+      # not be inspected from the worker thread
+      self.cancelled = False
+
+   def send(self, resolve: Callable[[asyncio.Future, Any], None], value: Any):
+      try:
+         self.loop.call_soon_threadsafe(resolve, self.future, value)
+      except RuntimeError:
+         # The caller's loop is closed, so nobody is waiting
+         self.cancelled = True
+
+def _set_result(future: asyncio.Future, value: Any):
+   if not future.done():
+      future.set_result(value)
+
+def _set_exception(future: asyncio.Future, value: BaseException):
+   if not future.done():
+      future.set_exception(value)
+
+class EmbeddingService:
+   """
+   Embeds texts for concurrent callers (i.e., the sessions of the server) in
+   shared batches. A worker thread waits for the first request, then keeps
+   collecting requests for up to window seconds (or until max_batch_size
+   texts are queued), runs run_batch once over all of their texts, and
+   resolves the future of every caller with its own vectors. The callers'
+   event loops never block on the model.
+   """
+
+   __pending: Queue[_Request | None]
+   __worker: threading.Thread | None
+   __lock: threading.Lock
+   __closed: bool
+
+   def __init__(self, run_batch: Callable[[list[str]], np.ndarray],
+                window: float = 0.005, max_batch_size: int = 64,
+                name: str = 'embedding-service'):
+      self.run_batch = run_batch
+      self.window = window
+      self.max_batch_size = max_batch_size
+      self.name = name
+      self.requests = 0
+      self.batches = 0
+      self.texts = 0
+      self.__pending = Queue()
+      self.__worker = None
+      self.__lock = threading.Lock()
+      self.__closed = False
+
+   def __start(self):
+      """ Call with the lock held. """
+      if self.__closed:
+         raise RuntimeError('The embedding service is closed')
+      if self.__worker is None:
+         self.__worker = threading.Thread(
+            target=self.__run, name=self.name, daemon=True)
+         self.__worker.start()
+
+   def close(self, timeout: float | None = None) -> None:
+      """
+      Stops the worker. The requests still waiting fail, and so do the
+      requests made from now on.
+      """
+      with self.__lock:
+         if self.__closed:
+            return
+         self.__closed = True
+         worker = self.__worker
+      if worker is not None:
+         self.__pending.put(None)
+         worker.join(timeout)
+
+   async def embed(self, texts: list[str]) -> np.ndarray:
+      """ Returns the vectors of the texts, one row per text. """
+      loop = asyncio.get_running_loop()
+      request = _Request(list(texts), loop, loop.create_future())
+      with self.__lock:
+         self.__start()
+         # Queued under the lock, so close() never misses it
+         self.__pending.put(request)
+      try:
+         return await request.future
+      finally:
+         # Makes the worker skip the request if it is still queued
+         request.cancelled = True
+
+   def __collect(self) -> tuple[list[_Request], bool]:
+      """
+      Waits for the requests of the next batch. Returns them, and whether
+      the service was closed.
+      """
+      first = self.__pending.get()
+      if first is None:
+         return [], True
+      requests = [first]
+      count = len(first.texts)
+      deadline = time.monotonic() + self.window
+      while count < self.max_batch_size:
+         timeout = deadline - time.monotonic()
+         try:
+            if timeout > 0:
+               request = self.__pending.get(timeout=timeout)
+            else:
+               # Take whatever is already queued, without waiting
+               request = self.__pending.get_nowait()
+         except Empty:
+            break
+         if request is None:
+            return requests, True
+         requests.append(request)
+         count += len(request.texts)
+      return requests, False
+
+   def __fail(self, requests: list[_Request]):
+      """ Fails the requests, and every request still queued. """
+      while True:
+         try:
+            request = self.__pending.get_nowait()
+         except Empty:
+            break
+         if request is not None:
+            requests.append(request)
+      error = RuntimeError('The embedding service is closed')
+      for request in requests:
+         request.send(_set_exception, error)
+
+   def __run(self):
+      while True:
+         requests, closed = self.__collect()
+         if closed:
+            self.__fail(requests)
+            return
+         # Callers that were cancelled while queued are skipped
+         requests = [x for x in requests if not x.cancelled]
+         if len(requests) == 0:
+            continue
+         texts = [text for x in requests for text in x.texts]
+         self.requests += len(requests)
+         self.batches += 1
+         self.texts += len(texts)
+         try:
+            vectors = self.run_batch(texts)
+         except Exception as e:
+            for request in requests:
+               request.send(_set_exception, e)
+            continue
+         start = 0
+         for request in requests:
+            end = start + len(request.texts)
+            request.send(_set_result, vectors[start:end])
+            start = end
+
+__all__ = [
+   'EmbeddingService'
+]
@@ -0,0 +1,216 @@
+"""
+Internal module for keeping the chat history within a token budget.
+"""
+
+from collections import deque
+from typing import Callable
+from weakref import WeakKeyDictionary
+from .session import (
+   ChatItem, ChatContext, ChatHistory, ChatSession, IChatProvider
+)
+
+TokenCounterT = Callable[[str], int]
+"""
+A function that returns the number of tokens in the given text.
+"""
+
+DEFAULT_SUMMARY_PROMPT = "You are an assistant that summarizes conversations. Summarize the conversation given by the user into a short paragraph. Keep any facts, names, numbers and decisions that may be needed to continue the conversation. Do not add anything that was not said."
+
+SUMMARY_ACKNOWLEDGEMENT = "Understood, I will keep the summary in mind."
+
+def estimate_tokens(text: str) -> int:
+   """
+   Estimates the number of tokens in the text, assuming ~4 characters per
+   token. This is used when no token counter is given.
+   """
+   return (len(text) + 3) // 4
+
+class HistoryBudget:
+   """
+   A token budget for the history that a flow re-sends every turn. The budget
+   keeps one HistoryWindow per chat history, so it should be created once (for
+   example, at the module level of a flow) and reused across turns.
+   """
+
+   max_tokens: int
+   """
+   The maximum number of tokens the windowed document (including the summary
+   and the current user query) can take up.
+   """
+
+   count_tokens: TokenCounterT
+   """ The function used to count the tokens in a single chat item. """
+
+   message_overhead: int
+   """ The number of extra tokens counted for every chat item. """
+
+   summarize: bool
+   """
+   If this is set, then evicted turns are kept until the flow summarizes them
+   (see HistoryWindow.summary_context).
+   """
+
+   __windows: WeakKeyDictionary[ChatHistory, 'HistoryWindow']
+
+   def __init__(self, max_tokens: int,
+                count_tokens: TokenCounterT = estimate_tokens,
+                message_overhead: int = 4,
+                summarize: bool = False):
+      self.max_tokens = max_tokens
+      self.count_tokens = count_tokens
+      self.message_overhead = message_overhead
+      self.summarize = summarize
+      self.__windows = WeakKeyDictionary()
+
+   def count_item(self, item: ChatItem) -> int:
+      """ Returns the number of tokens the chat item takes up. """
+      return self.count_tokens(item.text) + self.message_overhead
+
+   def window(self, session: ChatSession) -> 'HistoryWindow':
+      """
+      Returns the window for the session, updated with every completion that
+      finished since the last call. The current completion is the one being
+      generated, so only its user query is taken into account.
+      """
+      history = session.history
+      window = self.__windows.get(history)
+      if window is None:
+         window = HistoryWindow(self)
+         self.__windows[history] = window
+      window._update(history, session.current_completion().user_query)
+      return window
+
+class HistoryWindow:
+   """
+   A sliding window over the history of a single chat session. Each finished
+   turn is counted exactly once when it enters the window, and the oldest
+   turns are evicted whenever the window goes over budget. Turns that got no
+   response are left out, so the roles of the document always alternate.
+   """
+
+   __budget: HistoryBudget
+   __turns: deque[list[tuple[ChatItem, int]]]
+   __evicted: list[ChatItem]
+   __seen: int
+   __total: int
+   __query: ChatItem
+   __query_tokens: int
+   __summary: str | None
+   __summary_items: list[ChatItem]
+   __summary_tokens: int
+
+   def __init__(self, budget: HistoryBudget):
+      self.__budget = budget
+      self.__turns = deque()
+      self.__evicted = []
+      self.__seen = 0
+      self.__total = 0
+      self.__query = ChatItem(type='user', text='')
+      self.__query_tokens = 0
+      self.__summary = None
+      self.__summary_items = []
+      self.__summary_tokens = 0
+
+   @property
+   def total_tokens(self) -> int:
+      """ Returns the number of tokens the windowed document takes up. """
+      return self.__total + self.__query_tokens + self.__summary_tokens
+
+   def document(self) -> list[ChatItem]:
+      """
+      Returns the windowed document: the summary of the evicted turns (if
+      any), the turns that fit the budget and the current user query. The
+      summary is a user turn acknowledged by the assistant, so the roles keep
+      alternating.
+      """
+      result: list[ChatItem] = list(self.__summary_items)
+      for turn in self.__turns:
+         result.extend(item for item, _ in turn)
+      result.append(self.__query)
+      return result
+
+   def needs_summary(self) -> bool:
+      """
+      Returns True if turns were evicted since the last summary and the budget
+      asks for them to be summarized.
+      """
+      return self.__budget.summarize and len(self.__evicted) > 0
+
+   def summary_context(self, provider: IChatProvider,
+                       model: str | None = None,
+                       max_tokens: int | None = 256) -> ChatContext:
+      """
+      Returns the context for a flow step that summarizes the evicted turns
+      (together with the previous summary). Once the step is done, pass the
+      response to set_summary.
+      """
+      transcript: list[str] = []
+      if self.__summary is not None:
+         transcript.append(self.__summary)
+      for item in self.__evicted:
+         transcript.append(f'{item.type.capitalize()}: {item.text}')
+      return ChatContext(
+         provider=provider,
+         model=model,
+         system_prompt=DEFAULT_SUMMARY_PROMPT,
+         document=[ChatItem(type='user', text='\n\n'.join(transcript))],
+         temperature=0.2,
+         max_tokens=max_tokens,
+      )
+
+   def set_summary(self, text: str) -> None:
+      """
+      Replaces the evicted turns with the given summary. The summary counts
+      towards the budget, so more turns may be evicted.
+      """
+      self.__evicted.clear()
+      self.__summary = text
+      self.__summary_items = [
+         ChatItem(
+            type='user',
+            text=f'Summary of our conversation so far: {text}'
+         ),
+         ChatItem(type='assistant', text=SUMMARY_ACKNOWLEDGEMENT),
+      ]
+      self.__summary_tokens = sum(
+         self.__budget.count_item(x) for x in self.__summary_items)
+      self.__evict()
+
+   def _update(self, history: ChatHistory, user_query: str) -> None:
+      """ Used by HistoryBudget. Do not use. """
+      budget = self.__budget
+      # Only the completions before the current one are finished
+      for i in range(self.__seen, len(history) - 1):
+         completion = history[i]
+         # Turns without a response (i.e., cancelled ones) are skipped, as
+         # their user message would follow another one, and some chat
+         # templates reject consecutive user turns
+         if not completion.response:
+            continue
+         turn = [
+            ChatItem(type='user', text=completion.user_query),
+            ChatItem(type='assistant', text=completion.response),
+         ]
+         counted = [(item, budget.count_item(item)) for item in turn]
+         self.__turns.append(counted)
+         self.__total += sum(tokens for _, tokens in counted)
+      self.__seen = max(self.__seen, len(history) - 1)
+      self.__query = ChatItem(type='user', text=user_query)
+      self.__query_tokens = budget.count_item(self.__query)
+      self.__evict()
+
+   def __evict(self) -> None:
+      """ Evicts the oldest turns until the window fits the budget. """
+      while len(self.__turns) > 0 and \
+            self.total_tokens > self.__budget.max_tokens:
+         turn = self.__turns.popleft()
+         self.__total -= sum(tokens for _, tokens in turn)
+         if self.__budget.summarize:
+            self.__evicted.extend(item for item, _ in turn)
+
+__all__ = [
+   'TokenCounterT',
+   'HistoryBudget',
+   'HistoryWindow',
+   'estimate_tokens',
+]
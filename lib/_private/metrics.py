@@ -0,0 +1,121 @@
+"""
+Internal module that contains the latency metrics recorded by the session.
+"""
+
+import math
+from dataclasses import dataclass
+from threading import Lock
+
+@dataclass(slots=True)
+class StepMetrics:
+   """
+   Timings of a single flow step. All the times are in seconds.
+   """
+
+   name: str = ''
+   """ The name of the flow step. """
+
+   flow_time: float = 0.0
+   """
+   The time spent in the flow generator before the step was yielded (i.e.,
+   retrieval or any other work the flow does between steps).
+   """
+
+   time_to_first_token: float | None = None
+   """
+   The time between sending the request and receiving the first chunk, or
+   None if no chunk was received. This includes the queue_time.
+   """
+
+   queue_time: float = 0.0
+   """
+   The time the request waited for the provider's rate limits before it was
+   sent upstream.
+   """
+
+   stream_time: float = 0.0
+   """ The time between sending the request and receiving the last chunk. """
+
+   chunks: int = 0
+   """ The number of chunks received. """
+
+   completion_tokens: int = 0
+   """ The number of tokens in the response, as reported by the provider. """
+
+   @property
+   def tokens_per_second(self) -> float:
+      """ Returns the number of tokens streamed per second. """
+      if self.stream_time <= 0:
+         return 0.0
+      return self.completion_tokens / self.stream_time
+
+@dataclass(slots=True)
+class CompletionMetrics:
+   """
+   Timings of a whole completion. All the times are in seconds.
+   """
+
+   total_time: float = 0.0
+   """ The time taken by the flow, from start to finish. """
+
+   time_to_first_token: float | None = None
+   """
+   The time between starting the flow and the first chunk of the final
+   response, or None if no chunk was received.
+   """
+
+class LatencyHistogram:
+   """
+   A histogram of latencies with logarithmic buckets, from min_latency to
+   max_latency seconds with buckets_per_decade buckets per power of ten, so
+   percentiles have a bounded relative error. Latencies outside the range
+   are clamped. Thread-safe.
+   """
+
+   __counts: list[int]
+   __lock: Lock
+
+   def __init__(self, min_latency: float = 1e-3, max_latency: float = 100.0,
+                buckets_per_decade: int = 20):
+      self.min_latency = min_latency
+      self.buckets_per_decade = buckets_per_decade
+      decades = math.log10(max_latency / min_latency)
+      self.__counts = [0] * (math.ceil(decades * buckets_per_decade) + 1)
+      self.__lock = Lock()
+      self.count = 0
+
+   def __bucket(self, latency: float) -> int:
+      if latency <= self.min_latency:
+         return 0
+      index = math.ceil(
+         math.log10(latency / self.min_latency) * self.buckets_per_decade)
+      return min(index, len(self.__counts) - 1)
+
+   def __upper_bound(self, bucket: int) -> float:
+      return self.min_latency * 10 ** (bucket / self.buckets_per_decade)
+
+   def record(self, latency: float) -> None:
+      """ Adds a latency (in seconds) to the histogram. """
+      bucket = self.__bucket(latency)
+      with self.__lock:
+         self.__counts[bucket] += 1
+         self.count += 1
+
+   def percentile(self, p: float) -> float | None:
+      """
+      Returns the latency below which p percent of the recorded latencies
+      fall (as the upper bound of its bucket), or None if nothing was
+      recorded.
+      """
+      with self.__lock:
+         if self.count == 0:
+            return None
+         rank = max(1, math.ceil(p / 100 * self.count))
+         seen = 0
+         for bucket, count in enumerate(self.__counts):
+            seen += count
+            if seen >= rank:
+               return self.__upper_bound(bucket)
+      return self.__upper_bound(len(self.__counts) - 1)
+
+__all__ = ['StepMetrics', 'CompletionMetrics', 'LatencyHistogram']
@@ -3,6 +3,7 @@ Internal module that contains the IChatNotifier interface.
 """
 
 from abc import ABC, abstractmethod
+from .metrics import StepMetrics
 
 class IChatNotifier(ABC):
    """
@@ -30,4 +31,11 @@ class IChatNotifier(ABC):
       """ Notifies that the final response is being generated. """
       raise NotImplementedError()
 
+   def notify_step_metrics(self, metrics: StepMetrics) -> None:
+      """
+      Notifies that a flow step has finished, with its timings. This does
+      nothing by default, so notifiers only implement it if they use it.
+      """
+      pass
+
 __all__ = ['IChatNotifier']
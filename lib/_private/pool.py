@@ -0,0 +1,57 @@
+"""
+Internal module for de-duplicating long strings that repeat across sessions,
+such as system prompts and reference passages.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+class StringPool:
+   """
+   A bounded pool of canonical copies of strings. Interning a string returns
+   the copy already in the pool if there is one, so equal strings that were
+   built separately end up sharing memory. Short strings are not worth
+   pooling and are returned as-is.
+   """
+   __pool: OrderedDict[str, str]
+   __lock: Lock
+
+   def __init__(self, max_entries: int = 4096, min_length: int = 64):
+      self.max_entries = max_entries
+      self.min_length = min_length
+      self.__pool = OrderedDict()
+      self.__lock = Lock()
+
+   def intern(self, text: str) -> str:
+      """ Returns the pooled copy of the text. """
+      if type(text) is not str or len(text) < self.min_length:
+         return text
+      with self.__lock:
+         pooled = self.__pool.get(text)
+         if pooled is not None:
+            self.__pool.move_to_end(text)
+            return pooled
+         self.__pool[text] = text
+         if len(self.__pool) > self.max_entries:
+            self.__pool.popitem(last=False)
+      return text
+
+   def clear(self) -> None:
+      """ Empties the pool. """
+      with self.__lock:
+         self.__pool.clear()
+
+   def __len__(self):
+      return len(self.__pool)
+
+_global_pool = StringPool()
+
+def get_string_pool() -> StringPool:
+   """ Returns the pool shared by all the sessions. """
+   return _global_pool
+
+def intern_text(text: str) -> str:
+   """ Interns the text in the shared pool. See StringPool.intern. """
+   return _global_pool.intern(text)
+
+__all__ = ['StringPool', 'get_string_pool', 'intern_text']
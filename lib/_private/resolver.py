@@ -2,12 +2,54 @@
 Internal module for resolving flows and providers.
 """
 
-import os, sys, inspect, importlib
-from typing import Literal
+import os, sys, inspect, importlib, warnings
+from typing import Literal, TYPE_CHECKING
 from .session import FlowDescriptor, IChatProvider
 
-ProvidersT = Literal['openai', 'dummy', 'no-op']
+if TYPE_CHECKING:
+   from .chat import RateLimitScheduler
+
+ProvidersT = Literal[
+   'openai', 'openai-cached', 'openai-hedged', 'replay', 'local',
+   'simulated', 'dummy', 'no-op'
+]
 __cached_providers: dict[ProvidersT, IChatProvider] = {}
+__schedulers: dict[ProvidersT, 'RateLimitScheduler'] = {}
+
+# Where the providers keep their on-disk caches
+cache_dir = os.environ.get('DUCKY_CACHE_DIR', os.path.join(
+   os.path.expanduser('~'), '.cache', 'ducky'))
+
+def _env_number(name: str) -> float | None:
+   value = os.environ.get(name)
+   return float(value) if value else None
+
+# The rate limits of the OpenAI account, shared by every session. Unset
+# limits are not enforced.
+openai_limits = {
+   'requests_per_minute': _env_number('DUCKY_OPENAI_RPM'),
+   'tokens_per_minute': _env_number('DUCKY_OPENAI_TPM'),
+   'max_concurrency': _env_number('DUCKY_OPENAI_MAX_CONCURRENCY'),
+}
+
+# DUCKY_PROVIDER_MODE=record records every OpenAI response to the recordings
+# file, and DUCKY_PROVIDER_MODE=replay plays them back instead of calling
+# OpenAI (with the recorded timing scaled by DUCKY_REPLAY_TIME_SCALE).
+provider_mode = os.environ.get('DUCKY_PROVIDER_MODE', '')
+recordings_path = os.environ.get(
+   'DUCKY_RECORDINGS', os.path.join(cache_dir, 'recordings.jsonl'))
+replay_time_scale = float(os.environ.get('DUCKY_REPLAY_TIME_SCALE', '1'))
+
+# The model that slow 'openai-hedged' requests are retried with (by default,
+# the model of the request)
+hedge_model = os.environ.get('DUCKY_HEDGE_MODEL') or None
+
+# The latency profile of the 'simulated' provider (see LATENCY_PROFILES)
+simulated_profile = os.environ.get('DUCKY_SIMULATED_PROFILE', 'gpt-3.5')
+
+# The model served by the 'local' provider
+local_model = os.environ.get(
+   'DUCKY_LOCAL_MODEL', 'TinyLlama/TinyLlama-1.1B-Chat-v1.0')
 
 def resolve_flows(flow_dir: str | None = None) -> list[FlowDescriptor]:
    """
@@ -56,6 +98,13 @@ def resolve_flows(flow_dir: str | None = None) -> list[FlowDescriptor]:
       # If not, then it's probably some random python file
       if entry == None or name == None or desc == None:
          continue
+      # The entry must be callable. Generator functions are the usual case,
+      # but any callable that returns a (sync or async) generator works too,
+      # which is checked when the flow is started.
+      if not callable(entry):
+         warnings.warn(f'Skipping the flow in {file}: __FLOWENTRY__ is not '
+                       f'callable')
+         continue
       # TODO: Use a better ID & should be invariant to the file too.
       id = filename[:-3]
       # Try to set the flow ID as session.start_flow_stream expects it
@@ -72,14 +121,63 @@ def resolve_flows(flow_dir: str | None = None) -> list[FlowDescriptor]:
 def resolve_provider(provider: ProvidersT) -> IChatProvider:
    """
    Resolves a provider from the given string.
+
+   The 'openai' provider coalesces identical requests in flight at the same
+   time (see CoalescingChatProvider), but only deterministic ones, with a
+   temperature of 0. Requests at the default temperature of 1.0 are never
+   coalesced, so a flow has to ask for temperature 0 to share its requests
+   (like the query generation of the riscv-rag example does).
    """
    from .chat import (
-      OpenAIChatProvider, DummyChatProvider, NoOpChatProvider
+      OpenAIChatProvider, DummyChatProvider, NoOpChatProvider,
+      CachedChatProvider, CompletionCache, CoalescingChatProvider,
+      RateLimitScheduler, ScheduledChatProvider, RecordingChatProvider,
+      ReplayChatProvider, HedgedChatProvider, SimulatedChatProvider,
+      get_latency_profile
    )
    if provider in __cached_providers:
       return __cached_providers[provider]
-   if provider == 'openai':
-      __cached_providers[provider] = OpenAIChatProvider()
+   if provider.startswith('openai') and provider_mode == 'replay':
+      __cached_providers[provider] = resolve_provider('replay')
+   elif provider == 'openai':
+      max_concurrency = openai_limits['max_concurrency']
+      scheduler = __schedulers[provider] = RateLimitScheduler(
+         requests_per_minute=openai_limits['requests_per_minute'],
+         tokens_per_minute=openai_limits['tokens_per_minute'],
+         max_concurrency=int(max_concurrency) if max_concurrency else None
+      )
+      upstream: IChatProvider = OpenAIChatProvider(
+         models_cache=os.path.join(cache_dir, 'openai-models.json'))
+      if provider_mode == 'record':
+         upstream = RecordingChatProvider(upstream, recordings_path)
+      # Identical deterministic (temperature 0) requests from concurrent
+      # sessions share one stream, so they are only scheduled once
+      __cached_providers[provider] = CoalescingChatProvider(
+         ScheduledChatProvider(upstream, scheduler))
+   elif provider == 'openai-cached':
+      # Caches deterministic (low temperature) OpenAI requests
+      __cached_providers[provider] = CachedChatProvider(
+         resolve_provider('openai'),
+         CompletionCache(os.path.join(cache_dir, 'completions'))
+      )
+   elif provider == 'openai-hedged':
+      primary = resolve_provider('openai')
+      # Hedges skip the coalescing layer, which would merge them right back
+      # into the requests they hedge
+      fallback = primary.provider \
+         if isinstance(primary, CoalescingChatProvider) else primary
+      __cached_providers[provider] = HedgedChatProvider(
+         primary, fallback, fallback_model=hedge_model)
+   elif provider == 'replay':
+      __cached_providers[provider] = ReplayChatProvider(
+         recordings_path, time_scale=replay_time_scale)
+   elif provider == 'local':
+      # Imported here, as it needs torch
+      from .chat.local import LocalChatProvider
+      __cached_providers[provider] = LocalChatProvider(local_model)
+   elif provider == 'simulated':
+      __cached_providers[provider] = SimulatedChatProvider(
+         get_latency_profile(simulated_profile), seed=None)
    elif provider == 'dummy':
       __cached_providers[provider] = DummyChatProvider()
    elif provider == 'no-op':
@@ -88,4 +186,36 @@ def resolve_provider(provider: ProvidersT) -> IChatProvider:
       raise ValueError(f'Unknown provider: {provider}')
    return __cached_providers[provider]
 
-__all__ = ['resolve_flows', 'resolve_provider']
+def register_provider(provider: str, instance: IChatProvider) -> None:
+   """
+   Registers (or replaces) the provider returned by resolve_provider for the
+   given name. This is useful to swap in simulated providers, i.e., for
+   benchmarks.
+   """
+   __cached_providers[provider] = instance  # type: ignore
+
+def provider_scheduler(provider: ProvidersT) -> 'RateLimitScheduler | None':
+   """
+   Returns the scheduler enforcing the rate limits of the provider with the
+   given name, or None if the provider is not rate limited (or was not
+   resolved yet).
+   """
+   return __schedulers.get(provider)
+
+def provider_name(provider: IChatProvider) -> ProvidersT | None:
+   """
+   Returns the name the provider was resolved from, or None if the provider
+   was not created by resolve_provider.
+   """
+   for name, cached in __cached_providers.items():
+      if cached is provider:
+         return name
+   return None
+
+__all__ = [
+   'resolve_flows',
+   'resolve_provider',
+   'register_provider',
+   'provider_scheduler',
+   'provider_name'
+]
@@ -2,11 +2,18 @@
 Internal module to handle chat sessions and contexts.
 """
 
+import time, asyncio, inspect
 from dataclasses import dataclass, field
-from typing import final, AsyncGenerator, Generator, Callable, Literal, Any
+from typing import (
+   final, AsyncGenerator, Awaitable, Generator, Callable, Literal, Any, TypeVar
+)
 from .notify import IChatNotifier
+from .metrics import StepMetrics, CompletionMetrics
+from .pool import intern_text
 from abc import ABC, abstractmethod
 
+T = TypeVar('T')
+
 ChatGeneratorT = AsyncGenerator[tuple[str, int, int], None]
 """
 A generator that yields strings (chunks of the response) and returns a tuple of
@@ -15,20 +22,57 @@ tokens in the request and completion_tokens is the number of tokens in the
 response.
 """
 
-@dataclass
+class FlowTimeoutError(TimeoutError):
+   """ Raised when a flow or one of its steps runs past its deadline. """
+   pass
+
+@dataclass(slots=True)
 class ReferenceItem:
    """ Represents a single reference item. """
    type: Literal['text']  # TODO: add more types later
    data: str
    url: str
 
-@dataclass
+   def __post_init__(self):
+      # The same passages are retrieved over and over again
+      self.data = intern_text(self.data)
+
+class ResponseBuffer:
+   """
+   Accumulates a streamed response one chunk at a time. Chunks are only joined
+   when the text is read, and the joined text is kept so the next read only
+   has to join the chunks that arrived since.
+   """
+   __slots__ = ('__chunks', '__length')
+   __chunks: list[str]
+   __length: int
+
+   def __init__(self, prefix: str = ''):
+      self.__chunks = [prefix] if prefix else []
+      self.__length = len(prefix)
+
+   def append(self, chunk: str) -> None:
+      """ Appends a chunk to the end of the response. """
+      self.__chunks.append(chunk)
+      self.__length += len(chunk)
+
+   @property
+   def text(self) -> str:
+      """ Returns the response text received so far. """
+      if len(self.__chunks) > 1:
+         self.__chunks = [''.join(self.__chunks)]
+      return self.__chunks[0] if self.__chunks else ''
+
+   def __len__(self):
+      return self.__length
+
+@dataclass(slots=True)
 class ChatItem:
    """ Represents a single chat item. """
    type: Literal['user', 'assistant']
    text: str
 
-@dataclass
+@dataclass(slots=True)
 class ChatContext:
    """
    Represents the context of a chat session. This includes the system prompt,
@@ -86,13 +130,49 @@ class ChatContext:
    keeping track of a stateful conversation.
    """
 
+   timeout: float | None = None
+   """
+   The number of seconds the provider has to finish the response for this
+   context. If the deadline passes, the request is aborted and the flow fails
+   with a FlowTimeoutError. If this is None, then there is no deadline.
+   """
+
+   metrics: StepMetrics = field(
+      default_factory=StepMetrics, repr=False, compare=False)
+   """
+   The latency metrics of the step. This is updated by the session.
+   """
+
+   response_buffer: ResponseBuffer | None = field(
+      default=None, repr=False, compare=False)
+   """
+   The response that is currently being streamed for this context, or None if
+   no request is in flight. This is managed by the session.
+   """
+
+   def partial_document(self) -> list[ChatItem]:
+      """
+      Returns the document, including the response streamed so far if there is
+      a request in flight.
+      """
+      if self.response_buffer is None:
+         return self.document
+      partial = ChatItem(type='assistant', text=self.response_buffer.text)
+      if len(self.document) > 0 and self.document[-1].type == 'assistant':
+         return self.document[:-1] + [partial]
+      return self.document + [partial]
+
+   def __post_init__(self):
+      # Flows tend to re-send the same (long) system prompt in every session
+      self.system_prompt = intern_text(self.system_prompt)
+
    def fetch_response(self) -> 'ChatGeneratorT':
       """ Do not use. See ChatContext.continue_context instead. """
       if self.provider is None:
          raise ValueError('Cannot fetch response without a provider')
       return self.provider.fetch_response(self)
 
-@dataclass
+@dataclass(slots=True)
 class ChatCompletion:
    """
    Represents a user/response pair, including all the intermediate prompting
@@ -103,6 +183,35 @@ class ChatCompletion:
    steps: list[ChatContext] = field(default_factory=list)
    flow_id: str | None = None
    references: list[ReferenceItem] = field(default_factory=list)
+   metrics: CompletionMetrics = field(
+      default_factory=CompletionMetrics, repr=False, compare=False)
+
+@dataclass
+class ChatContextGroup:
+   """
+   Represents a group of independent chat contexts. When a flow yields a group
+   instead of a single context, the session runs every context in the group
+   concurrently and only resumes the flow once they have finished.
+   """
+
+   contexts: list[ChatContext]
+   """
+   The contexts to run. Each context is recorded as a step in the completion,
+   in the order given here. None of them may be a final context.
+   """
+
+   wait_for: int | None = None
+   """
+   If this is set, then the flow is resumed as soon as this many contexts have
+   finished and the remaining ones are cancelled. Otherwise, all the contexts
+   must finish before the flow is resumed.
+   """
+
+   completed: list[ChatContext] = field(default_factory=list)
+   """
+   The contexts that finished, in the order they finished. This is filled in
+   by the session and can be read by the flow once it is resumed.
+   """
 
 class ChatHistory:
    """
@@ -123,6 +232,9 @@ class ChatHistory:
    def __len__(self):
       return len(self.__history)
 
+   def __getitem__(self, index: int) -> ChatCompletion:
+      return self.__history[index]
+
    def _current_completion(self) -> ChatCompletion:
       """ Used by ChatSession. Do not use. """
       return self.__history[-1]
@@ -136,6 +248,13 @@ class ChatHistory:
       self.__history.append(completion)
       return completion
 
+   def _commit_completion(self) -> None:
+      """
+      Used by ChatSession. Do not use. Called once a flow is done with the
+      current completion, so that histories backed by storage can persist it.
+      """
+      pass
+
 class IChatProvider(ABC):
    """
    IChatProvider is a class that can provide responses to a given context. For
@@ -154,6 +273,14 @@ class IChatProvider(ABC):
       """
       raise NotImplementedError()
 
+   def get_num_tokens(self, request: ChatContext) -> int:
+      """
+      Returns an estimate of the number of prompt tokens in the request. By
+      default, this counts the tokens the way OpenAI's chat models do.
+      """
+      from .tokens import count_prompt_tokens
+      return count_prompt_tokens(request)
+
    @abstractmethod
    def total_request_tokens(self) -> int:
       """ Returns the total number of tokens used in requests. """
@@ -169,11 +296,20 @@ PromptFlowFunctionT = Callable[['ChatSession'], ChatContext]
 A function that takes in a ChatSession and returns a ChatContext.
 """
 
-PromptFlowT = Generator[tuple[str, ChatContext], None, None]
+PromptFlowT = Generator[tuple[str, ChatContext | ChatContextGroup], None, None]
 """
-A generator that yields tuples of (name, function) where name is the name of
-the flow step and function is the function that generates the context for that
-step.
+A generator that yields tuples of (name, context) where name is the name of
+the flow step and context is the context for that step. The context can also
+be a ChatContextGroup, in which case the contexts in the group are run
+concurrently.
+"""
+
+AsyncPromptFlowT = AsyncGenerator[
+   tuple[str, ChatContext | ChatContextGroup], None]
+"""
+The asynchronous version of PromptFlowT. Flows that do I/O or heavy work
+between steps (i.e., retrieval) should be written as async generators so they
+can await that work instead of blocking the event loop.
 """
 
 ChatIteratorT = AsyncGenerator[str, None]
@@ -181,8 +317,8 @@ ChatIteratorT = AsyncGenerator[str, None]
 A generator that yields strings (chunks of the response).
 """
 
-PromptFlowIteratorT = Generator[
-   tuple[ChatCompletion | str, ChatIteratorT], None, None]
+PromptFlowIteratorT = AsyncGenerator[
+   tuple[ChatCompletion | str, ChatIteratorT], None]
 """
 A generator that yields tuples of (completion, iterator) where completion is
 the current completion and iterator is the iterator for the response. See
@@ -199,7 +335,7 @@ class FlowDescriptor:
    id: str
    name: str
    description: str
-   entry: Callable[['ChatSession'], PromptFlowT]
+   entry: Callable[['ChatSession'], PromptFlowT | AsyncPromptFlowT]
 
 @final
 class ChatSession():
@@ -211,10 +347,17 @@ class ChatSession():
 
    __history: ChatHistory
    __notifier: IChatNotifier
+   __task: asyncio.Task | None
+   __loop: asyncio.AbstractEventLoop | None
+   __prefetched: dict[str, asyncio.Future]
 
-   def __init__(self, notifier: IChatNotifier):
-      self.__history = ChatHistory()
+   def __init__(self, notifier: IChatNotifier,
+                history: ChatHistory | None = None):
+      self.__history = history if history is not None else ChatHistory()
       self.__notifier = notifier
+      self.__task = None
+      self.__loop = None
+      self.__prefetched = {}
 
    @property
    def history(self) -> ChatHistory:
@@ -226,8 +369,9 @@ class ChatSession():
       """ Returns the notifier for the chat session. """
       return self.__notifier
 
-   def __start_flow_stream(self, user_query: str,
-                           flow_entry: PromptFlowT) -> PromptFlowIteratorT:
+   async def __start_flow_stream(self, user_query: str,
+                                 flow_entry: PromptFlowT | AsyncPromptFlowT,
+                                 flow_id: str | None) -> PromptFlowIteratorT:
       """
       Given a flow generator, this method will start each flow and yield the
       resulting context and the iterator for the response. The iterator for the
@@ -238,39 +382,146 @@ class ChatSession():
          user_query=user_query,
          response='',
          steps=[],
-         flow_id=getattr(flow_entry, 'flow_id', None)
+         flow_id=flow_id or getattr(flow_entry, 'flow_id', None)
       ))
-      for name, new_context in flow_entry:
-         completion.steps.append(new_context)
-         if new_context.is_final_context:
-            yield (completion, self.continue_context())
-         else:
-            yield (name, self.continue_context())
-         if new_context.is_final_context:
-            completion.response = new_context.document[-1].text
-
-   async def start_flow_raw(self, user_query: str, flow_entry: PromptFlowT):
+      started = mark = time.perf_counter()
+      try:
+         async for name, new_context in _iterate_flow(flow_entry):
+            flow_time = time.perf_counter() - mark
+            if isinstance(new_context, ChatContextGroup):
+               if any(x.is_final_context for x in new_context.contexts):
+                  raise ValueError('Cannot run a final context in a group')
+               contexts = new_context.contexts
+            else:
+               contexts = [new_context]
+            for context in contexts:
+               context.metrics.name = name
+               context.metrics.flow_time = flow_time
+            completion.steps.extend(contexts)
+            if isinstance(new_context, ChatContextGroup):
+               yield (name, self.__continue_group(new_context))
+            elif new_context.is_final_context:
+               yield (completion, self.continue_context())
+               completion.response = new_context.document[-1].text
+            else:
+               yield (name, self.continue_context())
+            for context in contexts:
+               self.notifier.notify_step_metrics(context.metrics)
+            mark = time.perf_counter()
+      finally:
+         completion.metrics.total_time = time.perf_counter() - started
+
+   async def start_flow_raw(self, user_query: str,
+                            flow_entry: PromptFlowT | AsyncPromptFlowT,
+                            flow_id: str | None = None,
+                            timeout: float | None = None):
       """
-      Given a flow generator, this method will start each flow and
-      automatically notify the notifier when a new flow is started.
+      Given a flow generator (either sync or async), this method will start
+      each flow and automatically notify the notifier when a new flow is
+      started. If a timeout is given, then the whole flow must finish within
+      that many seconds, otherwise it is aborted with a FlowTimeoutError. The
+      flow can also be aborted with cancel().
       """
-      flow = self.__start_flow_stream(user_query, flow_entry)
-      for x, response in flow:
+      self.__task = asyncio.current_task()
+      self.__loop = asyncio.get_running_loop()
+      flow = self.__start_flow_stream(user_query, flow_entry, flow_id)
+      started = time.perf_counter()
+      try:
+         await asyncio.wait_for(self.__run_flow(flow, started), timeout)
+      except FlowTimeoutError:
+         raise
+      except asyncio.TimeoutError:
+         raise FlowTimeoutError(f'Flow timed out after {timeout}s') from None
+      finally:
+         self.__task = None
+         await flow.aclose()
+         self.__discard_prefetched()
+         self.__history._commit_completion()
+
+   async def __run_flow(self, flow: PromptFlowIteratorT, started: float):
+      """ Runs the flow stream, see start_flow_raw. """
+      async for x, response in flow:
          if type(x) == str:
             self.notifier.notify_flow_step(x)
          elif type(x) == ChatCompletion:
             self.notifier.notify_final_response()
          async for chunk in response:
             if type(x) == ChatCompletion:
+               if x.metrics.time_to_first_token is None:
+                  x.metrics.time_to_first_token = \
+                     time.perf_counter() - started
                self.notifier.notify_assistant_message(chunk)
 
-   async def start_flow(self, user_query: str, flow_entry: FlowDescriptor):
+   async def start_flow(self, user_query: str, flow_entry: FlowDescriptor,
+                        timeout: float | None = None):
       """
       Given a flow descriptor, start the flow. See start_flow_raw and
       start_flow_stream for more information.
       """
-      await self.start_flow_raw(user_query, flow_entry.entry(self))
-      self.current_completion().flow_id = flow_entry.id
+      await self.start_flow_raw(
+         user_query, flow_entry.entry(self),
+         flow_id=flow_entry.id, timeout=timeout)
+
+   def prefetch(self, key: str,
+                work: Awaitable[T] | Callable[[], T]) -> asyncio.Future[T]:
+      """
+      Starts work speculatively (i.e., loading an index or running a
+      retrieval) so it runs while the next flow steps are streaming. The work
+      is either an awaitable, or a plain function which is run in a worker
+      thread. The result is claimed with take_prefetch, and whatever is not
+      claimed by the end of the flow is cancelled and discarded. This must be
+      called from within a running flow.
+      """
+      loop = asyncio.get_running_loop()
+      if key in self.__prefetched:
+         self.__prefetched.pop(key).cancel()
+      if inspect.isawaitable(work):
+         future = asyncio.ensure_future(work)
+      else:
+         future = loop.run_in_executor(None, work)
+      future.add_done_callback(_ignore_result)
+      self.__prefetched[key] = future
+      return future
+
+   def has_prefetch(self, key: str) -> bool:
+      """ Returns True if there is unclaimed prefetched work for the key. """
+      return key in self.__prefetched
+
+   async def take_prefetch(self, key: str) -> Any:
+      """
+      Claims the work started by prefetch, waiting for it to finish if it has
+      not yet. Raises a KeyError if nothing was prefetched for the key.
+      """
+      if key not in self.__prefetched:
+         raise KeyError(f'Nothing was prefetched for {key}')
+      return await self.__prefetched.pop(key)
+
+   def __discard_prefetched(self) -> None:
+      """ Cancels the prefetched work that was never claimed. """
+      for future in self.__prefetched.values():
+         future.cancel()
+      self.__prefetched.clear()
+
+   def is_running(self) -> bool:
+      """ Returns True if a flow is currently running. """
+      task = self.__task
+      return task is not None and not task.done()
+
+   def cancel(self) -> bool:
+      """
+      Cancels the flow that is currently running, aborting any in-flight
+      provider request. This can be called from any thread. Returns False if
+      there was no flow running.
+      """
+      task, loop = self.__task, self.__loop
+      if task is None or loop is None or task.done():
+         return False
+      try:
+         loop.call_soon_threadsafe(task.cancel)
+      except RuntimeError:
+         # The event loop was closed in the meantime
+         return False
+      return True
 
    def current_context(self) -> ChatContext:
       """ Returns the current context. """
@@ -284,48 +535,139 @@ class ChatSession():
       assert completion is not None
       return completion
 
-   async def continue_context(self) -> ChatIteratorT:
+   async def continue_context(self, context: ChatContext | None = None
+                              ) -> ChatIteratorT:
       """
       Continues the current context by querying the chat provider (i.e.,
-      OpenAI's API or otherwise) for a response.
+      OpenAI's API or otherwise) for a response. If a context is given, then
+      that context is continued instead of the current one.
       """
       # Check if the request is valid first
-      context = self.current_context()
+      if context is None:
+         context = self.current_context()
       if len(context.document) == 0:
          raise ValueError('Cannot continue context with empty chat')
       # If there is already a response "hint", then use that
       has_existing_response = context.document[-1].type == 'assistant'
-      response_text = context.document[-1].text if has_existing_response else ''
+      buffer = ResponseBuffer(
+         context.document[-1].text if has_existing_response else '')
       if has_existing_response and context.is_final_context:
-         yield response_text
+         yield buffer.text
       # Ok, it's valid, get the response
+      loop = asyncio.get_running_loop()
+      deadline = None
+      if context.timeout is not None:
+         deadline = loop.time() + context.timeout
+      context.response_buffer = buffer
+      metrics = context.metrics
+      started = time.perf_counter()
       response = context.fetch_response()
-      async for chunk, ptokens, ctokens in response:
-         response_text += chunk
-         # And also the token counts for the context (note this is never
-         # cumulative, as contexts are "immutable" in the sense that every new
-         # request re-sends the entire context).
-         context.request_tokens = ptokens
-         context.completion_tokens = ctokens
-         yield chunk
-      # Update the context now
+      try:
+         while True:
+            try:
+               if deadline is None:
+                  chunk, ptokens, ctokens = await anext(response)
+               else:
+                  chunk, ptokens, ctokens = await asyncio.wait_for(
+                     anext(response), max(0, deadline - loop.time()))
+            except StopAsyncIteration:
+               break
+            except asyncio.TimeoutError:
+               raise FlowTimeoutError(
+                  f'Step timed out after {context.timeout}s') from None
+            buffer.append(chunk)
+            if metrics.time_to_first_token is None:
+               metrics.time_to_first_token = time.perf_counter() - started
+            metrics.chunks += 1
+            # And also the token counts for the context (note this is never
+            # cumulative, as contexts are "immutable" in the sense that every
+            # new request re-sends the entire context).
+            context.request_tokens = ptokens
+            context.completion_tokens = ctokens
+            yield chunk
+      finally:
+         context.response_buffer = None
+         metrics.stream_time = time.perf_counter() - started
+         metrics.completion_tokens = context.completion_tokens
+         # Make sure the provider lets go of the request if we stop early
+         await response.aclose()
+      # Update the context now, joining the response only once
       if has_existing_response:
-         context.document[-1].text = response_text
+         context.document[-1].text = buffer.text
       else:
          context.document.append(ChatItem(
             type='assistant',
-            text=response_text
+            text=buffer.text
          ))
 
+   async def __continue_group(self, group: ChatContextGroup) -> ChatIteratorT:
+      """
+      Continues every context in the group concurrently. This yields the full
+      response text of each context as soon as it finishes.
+      """
+      async def run(context: ChatContext) -> ChatContext:
+         async for _ in self.continue_context(context):
+            pass
+         return context
+      tasks = [asyncio.ensure_future(run(x)) for x in group.contexts]
+      wait_for = len(tasks)
+      if group.wait_for is not None:
+         wait_for = max(0, min(group.wait_for, wait_for))
+      pending = set(tasks)
+      try:
+         while len(group.completed) < wait_for:
+            done, pending = await asyncio.wait(
+               pending, return_when=asyncio.FIRST_COMPLETED)
+            # Keep the order stable if several finish at the same time
+            for task in sorted(done, key=tasks.index):
+               context = task.result()
+               group.completed.append(context)
+               yield context.document[-1].text
+      finally:
+         # Cancel whatever is left over (either we have enough responses or
+         # one of the contexts raised an exception)
+         for task in pending:
+            task.cancel()
+         if len(pending) > 0:
+            await asyncio.wait(pending)
+
+def _ignore_result(future: asyncio.Future) -> None:
+   """
+   Retrieves the exception of discarded prefetched work, so that asyncio
+   does not complain about it never being retrieved.
+   """
+   if not future.cancelled():
+      future.exception()
+
+async def _iterate_flow(flow: PromptFlowT | AsyncPromptFlowT
+                        ) -> AsyncPromptFlowT:
+   """ Iterates over a flow, regardless of whether it is sync or async. """
+   if inspect.isasyncgen(flow):
+      try:
+         async for x in flow:
+            yield x
+      finally:
+         await flow.aclose()
+   elif hasattr(flow, '__iter__'):
+      for x in flow:
+         yield x
+   else:
+      raise TypeError(
+         f'A flow entry must return a generator, not {type(flow).__name__}')
+
 __all__ = [
+   'FlowTimeoutError',
    'ReferenceItem',
+   'ResponseBuffer',
    'ChatGeneratorT',
    'ChatContext',
+   'ChatContextGroup',
    'ChatItem',
    'ChatCompletion',
    'ChatHistory',
    'IChatProvider',
    'PromptFlowT',
+   'AsyncPromptFlowT',
    'PromptFlowFunctionT',
    'PromptFlowIteratorT',
    'ChatIteratorT',
@@ -0,0 +1,156 @@
+"""
+Internal module for embedding large corpora across a pool of processes.
+"""
+
+import os, hashlib, multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable
+from .embedcache import EmbeddingCache
+
+RunBatchT = Callable[[list[str]], np.ndarray]
+
+# The embedding function of the worker process, see _init_worker
+_worker_run: RunBatchT | None = None
+
+def _init_worker(load: Callable[[], RunBatchT], num_threads: int):
+   global _worker_run
+   try:
+      import torch
+      torch.set_num_threads(num_threads)
+   except ImportError:
+      pass
+   _worker_run = load()
+
+def _embed_shard(texts: list[str]) -> np.ndarray:
+   assert _worker_run is not None
+   return np.asarray(_worker_run(texts), dtype=np.float32)
+
+def _save_shard(path: str, vectors: np.ndarray):
+   # Write to a temporary file first so a killed run never leaves a partial
+   # shard behind
+   tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+   np.save(tmp_path, vectors)
+   os.replace(tmp_path, path)
+
+def _shard_path(directory: str, index: int, texts: list[str]) -> str:
+   """
+   Returns the file of the shard, named after a hash of its texts, so the
+   shards of a different corpus (or shard size) are never reused.
+   """
+   h = hashlib.blake2b(digest_size=8)
+   for text in texts:
+      data = text.encode('utf-8')
+      h.update(len(data).to_bytes(8, 'little'))
+      h.update(data)
+   return os.path.join(directory, f'shard-{index:05d}-{h.hexdigest()}.npy')
+
+def embed_sharded(texts: list[str], load: Callable[[], RunBatchT],
+                  dimension: int, directory: str,
+                  num_workers: int | None = None,
+                  num_threads: int | None = None,
+                  shard_size: int = 1024,
+                  keep_shards: bool = False,
+                  cache: EmbeddingCache | None = None,
+                  prefix: str = '') -> np.ndarray:
+   """
+   Embeds the texts in shards of shard_size across num_workers processes,
+   and returns the vectors in the order of the texts.
+
+   Every worker calls load once to get its embedding function (i.e., the
+   run_model of an embedder), so load must be a module-level function that
+   the worker can import. The embedder should be created without its cache
+   (i.e., EmberV1Embedder(cache=False)), as the workers only run the model
+   on the texts this process sends them. Workers run with num_threads torch threads each,
+   which defaults to splitting the cores evenly between them. The workers
+   are spawned rather than forked, as forking a process that already runs
+   torch threads can deadlock.
+
+   With an embedding cache (and the instruction prefix of the texts, see
+   embed_cached), only the texts missing from the cache are sharded, and
+   the vectors of every finished shard are appended to the cache by this
+   process, so an interrupted run resumes from the texts it already
+   embedded. Without one, finished shards are written to the directory
+   instead, and an interrupted run resumes from the shards it already has.
+   Once every shard is there, they are merged and (unless keep_shards is
+   set) removed.
+   """
+   cpu_count = os.cpu_count() or 1
+   if num_workers is None:
+      num_workers = max(1, cpu_count // 4)
+   if num_threads is None:
+      num_threads = max(1, cpu_count // num_workers)
+   result = np.empty((len(texts), dimension), dtype=np.float32)
+   if cache is not None:
+      keys = [cache.key(prefix, text) for text in texts]
+      found = cache.get_many(keys)
+      misses = [i for i, x in enumerate(found) if x is None]
+      for i, vector in enumerate(found):
+         if vector is not None:
+            result[i] = vector
+      # Texts repeated in the corpus are embedded once
+      todo = list({keys[i]: i for i in misses}.values())
+   else:
+      todo = list(range(len(texts)))
+   shards: list[tuple[list[int], str | None]] = []
+   for i in range(0, len(todo), shard_size):
+      indices = todo[i:i + shard_size]
+      path = None
+      if cache is None:
+         path = _shard_path(
+            directory, i // shard_size, [texts[j] for j in indices])
+      shards.append((indices, path))
+   pending: list[tuple[list[int], str | None]] = []
+   for indices, path in shards:
+      if path is not None and os.path.isfile(path):
+         result[indices] = np.load(path)
+      else:
+         pending.append((indices, path))
+   print(f'embed_sharded: {len(texts) - len(todo)}/{len(texts)} cached, '
+         f'{len(shards) - len(pending)}/{len(shards)} shards done, '
+         f'{num_workers} workers x {num_threads} threads')
+   if len(pending) > 0:
+      if cache is None:
+         os.makedirs(directory, exist_ok=True)
+      executor = ProcessPoolExecutor(
+         max_workers=min(num_workers, len(pending)),
+         mp_context=multiprocessing.get_context('spawn'),
+         initializer=_init_worker,
+         initargs=(load, num_threads))
+      try:
+         futures = {
+            executor.submit(
+               _embed_shard, [prefix + texts[i] for i in indices]): (
+               indices, path)
+            for indices, path in pending
+         }
+         done = len(shards) - len(pending)
+         for future in as_completed(futures):
+            indices, path = futures[future]
+            vectors = future.result()
+            result[indices] = vectors
+            if cache is not None:
+               cache.put_many([keys[i] for i in indices], vectors)
+            else:
+               assert path is not None
+               _save_shard(path, vectors)
+            done += 1
+            print(f'embed_sharded: {done}/{len(shards)}')
+      except BaseException:
+         # Do not wait for the shards that have not started
+         executor.shutdown(wait=False, cancel_futures=True)
+         raise
+      executor.shutdown()
+   if cache is not None:
+      # Copy the vectors of the repeated texts
+      row = {keys[i]: i for i in todo}
+      result[misses] = result[[row[keys[i]] for i in misses]]
+   elif not keep_shards:
+      for _, path in shards:
+         assert path is not None
+         os.remove(path)
+   return result
+
+__all__ = [
+   'embed_sharded'
+]
@@ -0,0 +1,299 @@
+"""
+Internal module to persist chat histories to disk.
+"""
+
+import os, json
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Iterator
+from .metrics import StepMetrics, CompletionMetrics
+from .session import (
+   ChatCompletion, ChatContext, ChatGeneratorT, ChatHistory, ChatItem,
+   IChatProvider, ReferenceItem
+)
+
+def _encode_user_data(user_data: dict[str, Any]) -> dict[str, Any]:
+   """ Keeps only the entries of user_data that can be stored as JSON. """
+   result = {}
+   for key, value in user_data.items():
+      try:
+         json.dumps(value)
+      except (TypeError, ValueError):
+         continue
+      result[key] = value
+   return result
+
+class DeferredChatProvider(IChatProvider):
+   """
+   Stands in for the provider of a step read back from a session log. The
+   provider is only resolved (by name) when the step is actually used, so
+   loading a history never creates provider clients. Unknown providers
+   resolve to the no-op provider, as past steps are never sent again.
+   """
+
+   name: str | None
+   __provider: IChatProvider | None
+
+   def __init__(self, name: str | None):
+      self.name = name
+      self.__provider = None
+
+   def resolve(self) -> IChatProvider:
+      """ Returns the provider, resolving it on first use. """
+      from .resolver import resolve_provider
+      if self.__provider is None:
+         try:
+            self.__provider = resolve_provider(self.name)  # type: ignore
+         except ValueError:
+            self.__provider = resolve_provider('no-op')
+      return self.__provider
+
+   def fetch_response(self, request: ChatContext) -> ChatGeneratorT:
+      return self.resolve().fetch_response(request)
+
+   def get_num_tokens(self, request: ChatContext) -> int:
+      return self.resolve().get_num_tokens(request)
+
+   def total_request_tokens(self) -> int:
+      # A provider that was never resolved never sent anything
+      if self.__provider is None:
+         return 0
+      return self.__provider.total_request_tokens()
+
+   def total_completion_tokens(self) -> int:
+      if self.__provider is None:
+         return 0
+      return self.__provider.total_completion_tokens()
+
+def _provider_name(provider: IChatProvider) -> str | None:
+   from .resolver import provider_name
+   if isinstance(provider, DeferredChatProvider):
+      return provider.name
+   return provider_name(provider)
+
+def completion_to_dict(completion: ChatCompletion) -> dict[str, Any]:
+   """
+   Converts a completion (with all its steps) into a JSON-serializable dict.
+   Providers are stored by the name they were resolved from.
+   """
+   return {
+      'user_query': completion.user_query,
+      'response': completion.response,
+      'flow_id': completion.flow_id,
+      'metrics': asdict(completion.metrics),
+      'references': [
+         [x.type, x.data, x.url] for x in completion.references
+      ],
+      'steps': [{
+         'provider': _provider_name(step.provider),
+         'document': [[x.type, x.text] for x in step.document],
+         'is_final_context': step.is_final_context,
+         'model': step.model,
+         'system_prompt': step.system_prompt,
+         'temperature': step.temperature,
+         'max_tokens': step.max_tokens,
+         'frequency_penalty': step.frequency_penalty,
+         'presence_penalty': step.presence_penalty,
+         'request_tokens': step.request_tokens,
+         'completion_tokens': step.completion_tokens,
+         'user_data': _encode_user_data(step.user_data),
+         'metrics': asdict(step.metrics),
+      } for step in completion.steps]
+   }
+
+def completion_from_dict(data: dict[str, Any]) -> ChatCompletion:
+   """
+   Converts a dict created by completion_to_dict back into a completion.
+   The providers of the steps are only resolved when they are used (see
+   DeferredChatProvider).
+   """
+   steps: list[ChatContext] = []
+   for step in data['steps']:
+      steps.append(ChatContext(
+         provider=DeferredChatProvider(step['provider']),
+         document=[ChatItem(type=t, text=x) for t, x in step['document']],
+         is_final_context=step['is_final_context'],
+         model=step['model'],
+         system_prompt=step['system_prompt'],
+         temperature=step['temperature'],
+         max_tokens=step['max_tokens'],
+         frequency_penalty=step['frequency_penalty'],
+         presence_penalty=step['presence_penalty'],
+         request_tokens=step['request_tokens'],
+         completion_tokens=step['completion_tokens'],
+         user_data=step['user_data'],
+         metrics=StepMetrics(**step.get('metrics', {})),
+      ))
+   return ChatCompletion(
+      user_query=data['user_query'],
+      response=data['response'],
+      steps=steps,
+      flow_id=data['flow_id'],
+      metrics=CompletionMetrics(**data.get('metrics', {})),
+      references=[
+         ReferenceItem(type=t, data=d, url=u)
+         for t, d, u in data['references']
+      ]
+   )
+
+class SessionLog:
+   """
+   An append-only log of the completions of a single session. Every
+   completion is stored as one JSON line, so a completion can be read back
+   from its byte offset without parsing the rest of the log.
+   """
+
+   path: str
+
+   def __init__(self, path: str):
+      self.path = path
+
+   def exists(self) -> bool:
+      """ Returns True if anything was ever written to the log. """
+      return os.path.isfile(self.path)
+
+   def offsets(self) -> list[int]:
+      """ Returns the byte offset of every completion in the log. """
+      if not self.exists():
+         return []
+      result: list[int] = []
+      offset = 0
+      with open(self.path, 'rb') as f:
+         for line in f:
+            # Skip a torn write at the end of the log
+            if line.endswith(b'\n'):
+               result.append(offset)
+            offset += len(line)
+      return result
+
+   def append(self, completion: ChatCompletion) -> int:
+      """ Appends the completion to the log and returns its offset. """
+      line = json.dumps(
+         completion_to_dict(completion),
+         ensure_ascii=False,
+         separators=(',', ':')
+      ).encode('utf-8') + b'\n'
+      os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+      with open(self.path, 'ab') as f:
+         offset = f.tell()
+         f.write(line)
+      return offset
+
+   def load(self, offset: int) -> ChatCompletion:
+      """ Reads the completion at the given offset. """
+      with open(self.path, 'rb') as f:
+         f.seek(offset)
+         return completion_from_dict(json.loads(f.readline()))
+
+   def iter_from(self, offset: int = 0) -> Iterator[tuple[int, bytes]]:
+      """
+      Yields the offset and the (unparsed) line of every completion from the
+      given offset on, in a single pass.
+      """
+      if not self.exists():
+         return
+      with open(self.path, 'rb') as f:
+         f.seek(offset)
+         for line in f:
+            # Skip a torn write at the end of the log
+            if line.endswith(b'\n'):
+               yield offset, line
+            offset += len(line)
+
+class PersistentChatHistory(ChatHistory):
+   """
+   A chat history backed by a SessionLog. Completions are written to the log
+   once their flow is done. Only the offsets of the committed completions
+   are kept, and they are read back on demand through a small LRU (of
+   max_loaded completions), so a session costs little memory however long
+   its history is. The completions that are not committed yet (i.e., the
+   one a flow is running) stay in memory until they are, so the flow always
+   sees the same objects.
+   """
+
+   max_loaded: int
+   __log: SessionLog
+   __offsets: list[int]
+   __loaded: OrderedDict[int, ChatCompletion]
+   __pending: list[ChatCompletion]
+
+   def __init__(self, log: SessionLog, max_loaded: int = 16):
+      super().__init__()
+      self.__log = log
+      self.__offsets = log.offsets()
+      self.__loaded = OrderedDict()
+      self.__pending = []
+      self.max_loaded = max_loaded
+
+   @property
+   def log(self) -> SessionLog:
+      """ Returns the log backing the history. """
+      return self.__log
+
+   def __remember(self, index: int, completion: ChatCompletion):
+      self.__loaded[index] = completion
+      self.__loaded.move_to_end(index)
+      while len(self.__loaded) > self.max_loaded:
+         self.__loaded.popitem(last=False)
+
+   def __load(self, index: int) -> ChatCompletion:
+      completion = self.__loaded.get(index)
+      if completion is None:
+         completion = self.__log.load(self.__offsets[index])
+      self.__remember(index, completion)
+      return completion
+
+   def __iter__(self):
+      committed = len(self.__offsets)
+      if committed > 0:
+         # Read the log in a single pass, parsing only what is not loaded
+         lines = self.__log.iter_from(self.__offsets[0])
+         for index, (_, line) in zip(range(committed), lines):
+            completion = self.__loaded.get(index)
+            if completion is None:
+               completion = completion_from_dict(json.loads(line))
+               self.__remember(index, completion)
+            yield completion
+      yield from list(self.__pending)
+
+   def __len__(self):
+      return len(self.__offsets) + len(self.__pending)
+
+   def __getitem__(self, index: int) -> ChatCompletion:
+      if index < 0:
+         index += len(self)
+      if index < 0 or index >= len(self):
+         raise IndexError('history index out of range')
+      committed = len(self.__offsets)
+      if index < committed:
+         return self.__load(index)
+      return self.__pending[index - committed]
+
+   def _current_completion(self) -> ChatCompletion:
+      """ Used by ChatSession. Do not use. """
+      return self[-1]
+
+   def _current_context(self) -> ChatContext:
+      """ Used by ChatSession. Do not use. """
+      return self._current_completion().steps[-1]
+
+   def _add_completion(self, completion: ChatCompletion) -> ChatCompletion:
+      """ Used by ChatSession. Do not use. """
+      self.__pending.append(completion)
+      return completion
+
+   def _commit_completion(self) -> None:
+      """ Used by ChatSession. Do not use. """
+      for completion in self.__pending:
+         self.__offsets.append(self.__log.append(completion))
+         # The completion is likely to be read again soon (i.e., to render it)
+         self.__remember(len(self.__offsets) - 1, completion)
+      self.__pending = []
+
+__all__ = [
+   'SessionLog',
+   'PersistentChatHistory',
+   'DeferredChatProvider',
+   'completion_to_dict',
+   'completion_from_dict',
+]
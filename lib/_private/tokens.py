@@ -0,0 +1,111 @@
+"""
+Internal module for counting prompt tokens with tiktoken.
+"""
+
+import hashlib
+import tiktoken
+from collections import OrderedDict
+from threading import Lock
+from .session import ChatContext
+
+DEFAULT_ENCODING = 'cl100k_base'
+
+class TokenCounter:
+   """
+   Counts tokens with tiktoken. Counts are memoized by (encoding, hash of the
+   text) in a bounded LRU, so re-counting text that was seen before (i.e.,
+   the system prompt or the history of a conversation) does not re-encode it.
+   """
+   __counts: OrderedDict[tuple[str, bytes], int]
+   __encodings: dict[str, str]
+   __lock: Lock
+
+   def __init__(self, max_entries: int = 65536):
+      self.max_entries = max_entries
+      self.__counts = OrderedDict()
+      self.__encodings = {}
+      self.__lock = Lock()
+
+   def encoding_for_model(self, model: str | None) -> str:
+      """
+      Returns the name of the encoding used by the model. Unknown models use
+      the default encoding.
+      """
+      if model is None:
+         return DEFAULT_ENCODING
+      name = self.__encodings.get(model)
+      if name is None:
+         try:
+            name = tiktoken.encoding_name_for_model(model)
+         except KeyError:
+            name = DEFAULT_ENCODING
+         self.__encodings[model] = name
+      return name
+
+   def count(self, text: str, encoding: str = DEFAULT_ENCODING) -> int:
+      """ Returns the number of tokens in the text. """
+      if text == '':
+         return 0
+      key = (encoding, hashlib.blake2b(
+         text.encode('utf-8'), digest_size=16).digest())
+      with self.__lock:
+         count = self.__counts.get(key)
+         if count is not None:
+            self.__counts.move_to_end(key)
+            return count
+      count = len(tiktoken.get_encoding(encoding).encode(
+         text, disallowed_special=()))
+      with self.__lock:
+         self.__counts[key] = count
+         while len(self.__counts) > self.max_entries:
+            self.__counts.popitem(last=False)
+      return count
+
+   def count_prompt(self, request: ChatContext,
+                    model: str | None = None) -> int:
+      """
+      Returns the number of prompt tokens the chat completions API charges
+      for the request, including the per-message overhead and the tokens
+      that prime the reply.
+      """
+      model = model or request.model
+      encoding = self.encoding_for_model(model)
+      # See OpenAI's cookbook, "How to count tokens with tiktoken"
+      per_message = 4 if model == 'gpt-3.5-turbo-0301' else 3
+      total = 3
+      if request.system_prompt:
+         total += per_message + self.count('system', encoding) + \
+            self.count(request.system_prompt, encoding)
+      for item in request.document:
+         total += per_message + self.count(item.type, encoding) + \
+            self.count(item.text, encoding)
+      return total
+
+_global_counter = TokenCounter()
+
+def get_token_counter() -> TokenCounter:
+   """ Returns the token counter shared by all the sessions. """
+   return _global_counter
+
+def count_tokens(text: str, model: str | None = None) -> int:
+   """
+   Returns the number of tokens in the text for the given model. See
+   TokenCounter.count.
+   """
+   return _global_counter.count(
+      text, _global_counter.encoding_for_model(model))
+
+def count_prompt_tokens(request: ChatContext,
+                        model: str | None = None) -> int:
+   """
+   Returns the number of prompt tokens in the request. See
+   TokenCounter.count_prompt.
+   """
+   return _global_counter.count_prompt(request, model)
+
+__all__ = [
+   'TokenCounter',
+   'get_token_counter',
+   'count_tokens',
+   'count_prompt_tokens',
+]
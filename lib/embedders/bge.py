@@ -29,7 +29,17 @@ import torch
 import numpy as np
 from enum import Enum
 from docarray.typing import NdArray
-from lib import IEmbedder, load_model_and_tokenizer
+from lib import (
+   IEmbedder,
+   load_model_and_tokenizer,
+   load_tokenizer,
+   load_onnx_model,
+   resolve_embedding_backend,
+   EmbeddingCache,
+   embed_cached,
+   get_embedding_cache,
+   run_bucketed
+)
 
 _bgeInstructions = {
    "qa": {
@@ -74,41 +84,106 @@ class BgeInstructionType(str, Enum):
    """ For conversational search passage retrieval. """
 
 class BgeLLMEmbedder(IEmbedder):
-   def __init__(self):
-      self.model, self.tokenizer = load_model_and_tokenizer(
-         'BAAI/llm-embedder')
+   def __init__(self, max_batch_tokens: int = 8192,
+                backend: str | None = None, cache: bool = True):
+      self.backend = resolve_embedding_backend(backend)
+      self.max_batch_tokens = max_batch_tokens
+      self.use_cache = cache
+      if self.backend == 'torch':
+         self.model, self.tokenizer = load_model_and_tokenizer(
+            'BAAI/llm-embedder')
+         self.session = None
+      else:
+         self.model = None
+         self.tokenizer = load_tokenizer('BAAI/llm-embedder')
+         self.session = load_onnx_model(
+            'BAAI/llm-embedder', quantize=self.backend == 'onnx-int8')
+
+   @property
+   def cache(self) -> EmbeddingCache | None:
+      """
+      The embedding cache of the model (and backend), or None if it is
+      disabled. The cache is only opened on first use, so embedders that
+      only run the model (i.e., in the workers of embed_sharded) never touch
+      it.
+      """
+      if not self.use_cache:
+         return None
+      # Every backend gives slightly different vectors, so they never share
+      # cache entries
+      cache_name = 'BAAI/llm-embedder'
+      if self.backend != 'torch':
+         cache_name += f'@{self.backend}'
+      return get_embedding_cache(cache_name, 768)
 
    def embed_nl_query(self, N: int):
       data: list[tuple[BgeInstructionType, str]] = []
       def append(s: tuple[BgeInstructionType, str]): data.append(s)
       for _ in range(N):
          yield append
-      return self.run_batch([
-         _bgeInstructions[type]['query'] + text
-         for type, text in data
-      ])
+      return self.run_batch(
+         [text for _, text in data],
+         [_bgeInstructions[type]['query'] for type, _ in data]
+      )
 
    def embed_nl_key(self, N: int):
       data: list[tuple[BgeInstructionType, str]] = []
       def append(s: tuple[BgeInstructionType, str]): data.append(s)
       for _ in range(N):
          yield append
-      return self.run_batch([
-         _bgeInstructions[type]['key'] + text
-         for type, text in data
-      ])
+      return self.run_batch(
+         [text for _, text in data],
+         [_bgeInstructions[type]['key'] for type, _ in data]
+      )
+
+   def run_batch(self, data: list[str], prefixes: list[str] | None = None):
+      """
+      Embeds the texts, each with its instruction prefix. The model only runs
+      on the texts that are not in the embedding cache.
+      """
+      if prefixes is None:
+         prefixes = [''] * len(data)
+      return embed_cached(
+         self.cache, list(zip(prefixes, data)), self.run_model)
 
-   def run_batch(self, data: list[str]):
+   def run_model(self, data: list[str]):
+      """
+      Runs the model over the texts, in batches of similar lengths that fit
+      in max_batch_tokens once padded.
+      """
       if len(data) == 0:
          return np.empty((0, 768))
-      inputs = self.tokenizer(data, padding=True, return_tensors='pt')
-      with torch.no_grad():
-         outputs = self.model(**inputs)
-         # CLS pooling
-         embeddings = outputs.last_hidden_state[:, 0]
-         # Normalize
-         embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-      return embeddings.detach().numpy()
+      encoded = self.tokenizer(data)
+      def run(batch: list[int]):
+         batch_encoded = {
+            key: [value[i] for i in batch] for key, value in encoded.items()
+         }
+         if self.session is not None:
+            return self.run_onnx(batch_encoded)
+         inputs = self.tokenizer.pad(batch_encoded, return_tensors='pt')
+         with torch.no_grad():
+            outputs = self.model(**inputs)
+            # CLS pooling
+            embeddings = outputs.last_hidden_state[:, 0]
+            # Normalize
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+         return embeddings.detach().numpy()
+      return run_bucketed(
+         [len(x) for x in encoded['input_ids']], run,
+         self.max_batch_tokens, 768)
+
+   def run_onnx(self, encoded: dict[str, list[list[int]]]):
+      """ Runs the ONNX model over a batch of tokenized texts. """
+      assert self.session is not None
+      inputs = self.tokenizer.pad(encoded, return_tensors='np')
+      hidden = self.session.run(['last_hidden_state'], {
+         x.name: inputs[x.name].astype(np.int64)
+         for x in self.session.get_inputs()
+      })[0]
+      # CLS pooling
+      embeddings = hidden[:, 0]
+      # Normalize
+      return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
    def vector_type(self) -> NdArray:
       return NdArray[768,]  # type: ignore
@@ -14,8 +14,15 @@ import torch, numpy as np
 from lib import (
    IEmbedder,
    load_model_and_tokenizer,
+   load_tokenizer,
+   load_onnx_model,
+   resolve_embedding_backend,
    is_model_cached,
-   is_tokenizer_cached
+   is_tokenizer_cached,
+   EmbeddingCache,
+   embed_cached,
+   get_embedding_cache,
+   run_bucketed
 )
 
 def _average_pool(last_hidden_states, attention_mask):
@@ -24,9 +31,37 @@ def _average_pool(last_hidden_states, attention_mask):
    return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
 
 class EmberV1Embedder(IEmbedder):
-   def __init__(self):
-      self.model, self.tokenizer = load_model_and_tokenizer(
-         'llmrails/ember-v1')
+   def __init__(self, max_batch_tokens: int = 8192,
+                backend: str | None = None, cache: bool = True):
+      self.backend = resolve_embedding_backend(backend)
+      self.max_batch_tokens = max_batch_tokens
+      self.use_cache = cache
+      if self.backend == 'torch':
+         self.model, self.tokenizer = load_model_and_tokenizer(
+            'llmrails/ember-v1')
+         self.session = None
+      else:
+         self.model = None
+         self.tokenizer = load_tokenizer('llmrails/ember-v1')
+         self.session = load_onnx_model(
+            'llmrails/ember-v1', quantize=self.backend == 'onnx-int8')
+
+   @property
+   def cache(self) -> EmbeddingCache | None:
+      """
+      The embedding cache of the model (and backend), or None if it is
+      disabled. The cache is only opened on first use, so embedders that
+      only run the model (i.e., in the workers of embed_sharded) never touch
+      it.
+      """
+      if not self.use_cache:
+         return None
+      # Every backend gives slightly different vectors, so they never share
+      # cache entries
+      cache_name = 'llmrails/ember-v1'
+      if self.backend != 'torch':
+         cache_name += f'@{self.backend}'
+      return get_embedding_cache(cache_name, 1024)
 
    def embed_nl_query(self, N: int):
       data: list[str] = []
@@ -39,22 +74,54 @@ class EmberV1Embedder(IEmbedder):
       return self.embed_nl_query(N)
 
    def run_batch(self, data: list[str]):
+      """
+      Embeds the texts. The model only runs on the texts that are not in the
+      embedding cache.
+      """
+      return embed_cached(
+         self.cache, [('', text) for text in data], self.run_model)
+
+   def run_model(self, data: list[str]):
+      """
+      Runs the model over the texts, in batches of similar lengths that fit
+      in max_batch_tokens once padded.
+      """
       if len(data) == 0:
          return np.empty((0, 1024))
-      inputs = self.tokenizer(
-         data, max_length=512,
-         padding=True, truncation=True,
-         return_tensors='pt'
-      )
-      with torch.no_grad():
-         outputs = self.model(**inputs)
-         # Average pooling
-         embeddings = _average_pool(
-            outputs.last_hidden_state, inputs['attention_mask']
-         )
-         # Normalize embeddings
-         embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-      return embeddings.detach().numpy()
+      encoded = self.tokenizer(data, max_length=512, truncation=True)
+      def run(batch: list[int]):
+         batch_encoded = {
+            key: [value[i] for i in batch] for key, value in encoded.items()
+         }
+         if self.session is not None:
+            return self.run_onnx(batch_encoded)
+         inputs = self.tokenizer.pad(batch_encoded, return_tensors='pt')
+         with torch.no_grad():
+            outputs = self.model(**inputs)
+            # Average pooling
+            embeddings = _average_pool(
+               outputs.last_hidden_state, inputs['attention_mask']
+            )
+            # Normalize embeddings
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+         return embeddings.detach().numpy()
+      return run_bucketed(
+         [len(x) for x in encoded['input_ids']], run,
+         self.max_batch_tokens, 1024)
+
+   def run_onnx(self, encoded: dict[str, list[list[int]]]):
+      """ Runs the ONNX model over a batch of tokenized texts. """
+      assert self.session is not None
+      inputs = self.tokenizer.pad(encoded, return_tensors='np')
+      hidden = self.session.run(['last_hidden_state'], {
+         x.name: inputs[x.name].astype(np.int64)
+         for x in self.session.get_inputs()
+      })[0]
+      # Average pooling
+      mask = inputs['attention_mask'][..., None].astype(hidden.dtype)
+      embeddings = (hidden * mask).sum(axis=1) / mask.sum(axis=1)
+      # Normalize
+      return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
    def vector_type(self) -> NdArray:
       return NdArray[1024,]  # type: ignore
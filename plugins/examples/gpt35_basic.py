@@ -2,23 +2,30 @@ import lib as lp
 
 my_system_prompt = "You are a helpful assistant named Ducky. Format your reponses in Markdown. However, enclose inline math expressions with dollar signs like this $\\latex 1 + 2 + 3$ and multi-line math expressions with double dollar signs like this $$\\frac{1}{2}x+y$$. Be nice to the user."
 
+# Keep the re-sent history well under the model's context window, and
+# summarize the turns that fall out of it
+history_budget = lp.HistoryBudget(
+   max_tokens=12000,
+   count_tokens=lambda text: lp.count_tokens(text, 'gpt-3.5-turbo-1106'),
+   summarize=True
+)
+
 
 def gpt_35(session: lp.ChatSession) -> lp.PromptFlowT:
-   # Re-construct the chat history
-   history = []
-   for completion in session.history:
-      # Append the previous user query
-      history.append(lp.ChatItem(type='user', text=completion.user_query))
-      # Check if the item has a response
-      if completion.response:
-         history.append(lp.ChatItem(
-            type='assistant', text=completion.response))
+   # Grab the chat history that fits the budget
+   window = history_budget.window(session)
+   if window.needs_summary():
+      yield "Summarizing history", window.summary_context(
+         provider=lp.resolve_provider('openai'),
+         model='gpt-3.5-turbo-1106'
+      )
+      window.set_summary(session.current_context().document[-1].text)
    # Return the constructed chat context
    yield "GPT 3.5-Turbo", lp.ChatContext(
       model='gpt-3.5-turbo-1106',
       provider=lp.resolve_provider('openai'),
       system_prompt=my_system_prompt,
-      document=history,
+      document=window.document(),
       temperature=1.0,
       # max_tokens=256,
       is_final_context=True,
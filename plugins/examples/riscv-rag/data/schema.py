@@ -1,4 +1,4 @@
-import os, json
+import os, json, asyncio, threading
 
 from sympy import li
 from lib import *
@@ -9,11 +9,28 @@ from docarray.index.backends.hnswlib import HnswDocumentIndex
 db_path_hardcoded = os.path.join(os.path.dirname(__file__), 'riscv.vdb')
 work_dir_hardcoded = os.path.join(os.path.dirname(__file__), 'tmp_0')
 
+_query_service: EmbeddingService | None = None
+_query_service_lock = threading.Lock()
+
 @EmbeddedDoc({'embedding': EmberV1Embedder()})
 class RiscVDoc(BaseDoc):
    text: str
 
-def build_embeddings():
+shards_dir_hardcoded = os.path.join(os.path.dirname(__file__), 'shards')
+
+def _load_key_embedder():
+   """
+   Loads the embedder of every build_embeddings worker. The workers never
+   touch the embedding cache, build_embeddings looks it up and fills it.
+   """
+   return EmberV1Embedder(cache=False).run_model
+
+def build_embeddings(num_workers: int | None = None):
+   """
+   Embeds the corpus across num_workers processes (see embed_sharded), and
+   writes the docs to the database. An interrupted build picks up from the
+   texts it already embedded.
+   """
    input_file = os.path.join(
        os.path.dirname(__file__),
        'output_tokens_combined.json'
@@ -27,10 +44,16 @@ def build_embeddings():
             continue
          for text in subsection['text']:
             docs.append(RiscVDoc(text=text))
-   for doc, embed in batch_embed(
-      docs, 'embedding', EmberV1Embedder().embed_nl_key, batch_size=64
-   ):
-      embed(doc.text)
+   # Large shards give the embedder more texts to bucket by length. Only
+   # the texts missing from the embedding cache are sharded, and this
+   # process adds their vectors to it (the model is already loaded by
+   # RiscVDoc, so the embedder is cheap to create)
+   vectors = embed_sharded(
+      [doc.text for doc in docs], _load_key_embedder, 1024,
+      shards_dir_hardcoded, num_workers=num_workers, shard_size=1024,
+      cache=EmberV1Embedder().cache)
+   for doc, vector in zip(docs, vectors):
+      doc.embedding = vector
    docs.push(f'file://{db_path_hardcoded}')
 
 def load_embeddings():
@@ -49,8 +72,41 @@ def query_db(index: HnswDocumentIndex[RiscVDoc], queries: DocList[RiscVDoc],
       embed(doc.text)
    return index.find_batched(queries, 'embedding', limit=limit)
 
+async def load_embeddings_async():
+   """ Same as load_embeddings, but runs in a worker thread. """
+   return await asyncio.to_thread(load_embeddings)
+
+def get_query_service() -> EmbeddingService:
+   """
+   Returns the service that embeds the queries of every session, so that
+   concurrent sessions share batches.
+   """
+   global _query_service
+   with _query_service_lock:
+      if _query_service is None:
+         _query_service = EmbeddingService(
+            EmberV1Embedder().run_batch, name='riscv-query-embedder')
+      return _query_service
+
+async def query_db_async(index: HnswDocumentIndex[RiscVDoc],
+                         queries: DocList[RiscVDoc],
+                         limit: int = 10, batch_size: int = 1):
+   """
+   Same as query_db, but the queries are embedded by the shared query
+   service (which forms its own batches, so batch_size is ignored), and the
+   search runs in a worker thread.
+   """
+   vectors = await get_query_service().embed([doc.text for doc in queries])
+   for doc, vector in zip(queries, vectors):
+      doc.embedding = vector
+   return await asyncio.to_thread(
+      index.find_batched, queries, 'embedding', limit=limit)
+
 __all__ = [
    'RiscVDoc',
    'build_embeddings',
-   'query_db'
+   'query_db',
+   'load_embeddings_async',
+   'get_query_service',
+   'query_db_async'
 ]
@@ -1,6 +1,6 @@
 import re
 import lib as lp
-from data.schema import load_embeddings, query_db, RiscVDoc
+from data.schema import load_embeddings_async, query_db_async, RiscVDoc
 from docarray import DocList
 from docarray.index.backends.hnswlib import HnswDocumentIndex
 
@@ -9,13 +9,14 @@ from lib.embedders.emberv1 import EmberV1Embedder
 cached_db: HnswDocumentIndex[RiscVDoc] | None = None
 PATTERN = re.compile(r'"([^"]+)"')
 
-def flowentry(session: lp.ChatSession) -> lp.PromptFlowT:
+async def flowentry(session: lp.ChatSession) -> lp.AsyncPromptFlowT:
    user_query = session.current_completion().user_query
 
-   # 1. Load the database if it's not already loaded
+   # 1. Load the database if it's not already loaded. This is done in the
+   # background while the queries are being generated.
    global cached_db
    if cached_db is None:
-      cached_db = load_embeddings()
+      session.prefetch('db', load_embeddings_async())
       yield "Loading database", lp.ChatContext(
          provider=lp.resolve_provider('no-op'),
          system_prompt='',
@@ -25,23 +26,30 @@ def flowentry(session: lp.ChatSession) -> lp.PromptFlowT:
          )],
          is_final_context=False,
       )
-   assert cached_db is not None
 
    # 2. Construct the prompt for generating queries
+   # (the same question always gives the same queries, so they are cached,
+   # and deterministic so that identical questions asked at the same time
+   # share one request)
    yield "Generating queries", lp.ChatContext(
-      provider=lp.resolve_provider('openai'),
+      provider=lp.resolve_provider('openai-cached'),
       model='gpt-3.5-turbo-1106',
       system_prompt="You are an assistant that will help with querying an embedding vector database. The database contains embeddings of text chunks from the RISC-V database. Come up with 1-3 query phrases for the embedding database that will be the most effective in answering the user's question. Use compiler terminology. Do not start queries with a verb. Instead, just type out related topics. Surround each query in double quotes \"like this\".",
       document=[lp.ChatItem(
          type='user',
          text=f'Can you come up with search queries for the question:\n{user_query}'
       )],
-      temperature=0.2,
+      temperature=0,
       frequency_penalty=1.0,
       presence_penalty=0.25,
       is_final_context=False,
    )
 
+   # Wait for the database if it was still loading
+   if session.has_prefetch('db'):
+      cached_db = await session.take_prefetch('db')
+   assert cached_db is not None
+
    # 3. Extract the queries from the response
    queries = DocList()
    phrases = PATTERN.findall(session.current_context().document[-1].text)
@@ -50,7 +58,8 @@ def flowentry(session: lp.ChatSession) -> lp.PromptFlowT:
       queries.append(RiscVDoc(text=phrase))
 
    # 4. Take the queries and search the database
-   doclistlist, scores = query_db(cached_db, queries, limit=3, batch_size=64)
+   doclistlist, scores = await query_db_async(
+      cached_db, queries, limit=3, batch_size=64)
    results: set[str] = set()
    for doclist in doclistlist:
       for doc in doclist:
@@ -1,15 +1,15 @@
 import lib as lp
-from data.schema import load_embeddings, query_db, RiscVDoc
+from data.schema import load_embeddings_async, query_db_async, RiscVDoc
 from docarray import DocList
 from docarray.index.backends.hnswlib import HnswDocumentIndex
 
 cached_db: HnswDocumentIndex[RiscVDoc] | None = None
 
-def flowentry(session: lp.ChatSession) -> lp.PromptFlowT:
+async def flowentry(session: lp.ChatSession) -> lp.AsyncPromptFlowT:
    # 1. Load the database if it's not already loaded
    global cached_db
    if cached_db is None:
-      cached_db = load_embeddings()
+      cached_db = await load_embeddings_async()
       yield "Loading database", lp.ChatContext(
          provider=lp.resolve_provider('no-op'),
          system_prompt='',
@@ -25,7 +25,7 @@ def flowentry(session: lp.ChatSession) -> lp.PromptFlowT:
    queries = DocList([RiscVDoc(text=user_query)])
    assert cached_db is not None
    session.notifier.notify_search(user_query)
-   doclistlist, scores = query_db(cached_db, queries, limit=10)
+   doclistlist, scores = await query_db_async(cached_db, queries, limit=10)
    results: list[str] = []
    for i, doc in enumerate(doclistlist[0]):
       results.append(
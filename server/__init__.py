@@ -7,7 +7,7 @@ from .session import *
 from .notify import get_announcer
 import lib as lp
 
-# Warm up the OpenAI API
+# Warm up the OpenAI API (this fetches the model list in the background)
 lp.resolve_provider('openai')
 # Fetch the flows initially
 reload_flows()
@@ -40,11 +40,20 @@ def main():
 
 @app.route('/api/listen', methods=['GET'])
 def api_listen():
+   session = current_session()
    def stream():
       messages = get_announcer().listen()
-      while True:
-         msg = messages.get()
-         yield msg
+      if session:
+         session.listen()
+      try:
+         while True:
+            msg = messages.get()
+            yield msg
+      finally:
+         get_announcer().unlisten(messages)
+         # Once every client went away, stop generating a response for them
+         if session and session.unlisten() == 0:
+            session.cancel()
    return flask.Response(stream(), mimetype='text/event-stream')
 
 @app.route('/api/ping', methods=['POST'])
@@ -52,6 +61,20 @@ def api_ping():
    get_announcer().announce(data='pong', event='ping')
    return {}, 200
 
+@app.route('/api/scheduler', methods=['GET'])
+def api_scheduler():
+   scheduler = lp.provider_scheduler('openai')
+   if scheduler is None:
+      return {}, 200
+   stats = scheduler.stats()
+   return {
+      'queue_depth': stats.queue_depth,
+      'in_flight': stats.in_flight,
+      'requests': stats.requests,
+      'mean_wait_time': stats.mean_wait_time,
+      'max_wait_time': stats.max_wait_time,
+   }, 200
+
 @app.route('/api/session/send', methods=['POST'])
 def api_session_send():
    data = flask.request.get_json()
@@ -1,4 +1,5 @@
 import json
+from dataclasses import asdict
 from .sse import MessageAnnouncer
 import lib as lp
 
@@ -21,4 +22,10 @@ class ChatNotifier(lp.IChatNotifier):
    def notify_final_response(self) -> None:
       get_announcer().announce(data='', event='final-response-start')
 
+   def notify_step_metrics(self, metrics: lp.StepMetrics) -> None:
+      get_announcer().announce(data=json.dumps({
+         **asdict(metrics),
+         'tokens_per_second': metrics.tokens_per_second
+      }), event='step-metrics')
+
 __all__ = ['ChatNotifier', 'get_announcer']
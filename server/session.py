@@ -1,14 +1,24 @@
-import asyncio
+import os, time, asyncio, threading
 import lib as lp
-from uuid import uuid4
+from uuid import uuid4, UUID
 from dataclasses import dataclass, field
 from typing import Literal
 from .notify import ChatNotifier
 from dataclasses import asdict
 
 global_sessions: dict[str, 'ChatSessionWrapper'] = {}
+global_sessions_lock = threading.Lock()
 global_flows: list[lp.FlowDescriptor]
 
+# Where the session logs are kept, so sessions survive a server restart
+session_dir = os.environ.get('DUCKY_SESSION_DIR', os.path.join(
+   os.path.dirname(os.path.realpath(__file__)), '..', '.sessions'))
+
+# Sessions unused for this many seconds (with no listener and no message
+# running) are dropped from memory, they are re-opened from their log
+session_idle_timeout = float(
+   os.environ.get('DUCKY_SESSION_IDLE_TIMEOUT', '900'))
+
 @dataclass
 class ChatSessionItem:
    type: Literal['user', 'assistant', 'system']
@@ -16,6 +26,7 @@ class ChatSessionItem:
    children: list['ChatSessionItem']
    tag: str | None = None
    references: list[lp.ReferenceItem] = field(default_factory=list)
+   metrics: dict | None = None
 
 class ChatSessionWrapper:
    """
@@ -26,11 +37,38 @@ class ChatSessionWrapper:
    id: str
    session: lp.ChatSession
    selected_flow: lp.FlowDescriptor
+   __lock: threading.Lock
+   __state_lock: threading.Lock
+   __generation: int
+   __task: asyncio.Task | None
+   __loop: asyncio.AbstractEventLoop | None
+   __listeners: int
+   __last_used: float
 
    def __init__(self, id: str):
       self.id = id
-      self.session = lp.ChatSession(notifier=ChatNotifier())
+      # Held while a message is processed, so messages run one at a time
+      self.__lock = threading.Lock()
+      # Guards the fields below, which other threads use to cancel messages
+      self.__state_lock = threading.Lock()
+      # Bumped by every new message and cancellation, so a message that was
+      # superseded before it started never runs
+      self.__generation = 0
+      self.__task = None
+      self.__loop = None
+      self.__listeners = 0
+      self.__last_used = time.monotonic()
+      self.session = lp.ChatSession(
+         notifier=ChatNotifier(),
+         history=lp.PersistentChatHistory(_session_log(id))
+      )
+      # A re-opened session keeps using the flow of its last message
       self.selected_flow = get_flows()[0]
+      history = self.session.history
+      if len(history) > 0:
+         for flow in get_flows():
+            if flow.id == history[-1].flow_id:
+               self.selected_flow = flow
 
    def serialize(self) -> dict:
       """
@@ -49,7 +87,7 @@ class ChatSessionWrapper:
                   message=step.system_prompt,
                   children=[]
                ))
-            for chatitem in step.document:
+            for chatitem in step.partial_document():
                steps.append(ChatSessionItem(
                   type=chatitem.type,
                   message=chatitem.text,
@@ -64,9 +102,10 @@ class ChatSessionWrapper:
          result.append(ChatSessionItem(
             type='assistant',
             tag=_find_flow_name_by_id(item.flow_id),
-            message=item.response,
+            message=item.response or _partial_response(item),
             children=outer_steps,
-            references=item.references))
+            references=item.references,
+            metrics=_serialize_metrics(item)))
       return {
          'id': self.id,
          'flow_id': self.selected_flow.id,
@@ -75,9 +114,64 @@ class ChatSessionWrapper:
 
    def send_message(self, message: str) -> str | None:
       """
-      Sends a message to the chat session.
+      Sends a message to the chat session. If the session is still busy with
+      the previous message, then that message is cancelled first.
+      """
+      with self.__state_lock:
+         self.__generation += 1
+         generation = self.__generation
+         self.__cancel_task()
+      with self.__lock:
+         return asyncio.run(self.__send_message_safe(message, generation))
+
+   def cancel(self) -> None:
+      """
+      Cancels the message that is currently being processed (if any), as
+      well as the messages waiting for it.
+      """
+      with self.__state_lock:
+         self.__generation += 1
+         self.__cancel_task()
+
+   def __cancel_task(self) -> None:
+      """ Call with the state lock held. """
+      if self.__task is None or self.__loop is None:
+         return
+      try:
+         self.__loop.call_soon_threadsafe(self.__task.cancel)
+      except RuntimeError:
+         # The event loop was closed in the meantime
+         pass
+
+   def listen(self) -> None:
+      """ Registers an SSE listener of the session. """
+      with self.__state_lock:
+         self.__listeners += 1
+
+   def unlisten(self) -> int:
+      """
+      Unregisters an SSE listener of the session, and returns the number of
+      listeners left.
+      """
+      with self.__state_lock:
+         self.__listeners = max(0, self.__listeners - 1)
+         self.__last_used = time.monotonic()
+         return self.__listeners
+
+   def touch(self) -> None:
+      """ Marks the session as used, see is_idle. """
+      with self.__state_lock:
+         self.__last_used = time.monotonic()
+
+   def is_idle(self, timeout: float) -> bool:
+      """
+      Returns True if the session has no listener and no message running,
+      and was not used for the given number of seconds.
       """
-      return asyncio.run(self.__send_message_safe(message))
+      with self.__state_lock:
+         return self.__listeners == 0 and self.__task is None and \
+            not self.__lock.locked() and \
+            time.monotonic() - self.__last_used > timeout
 
    def select_flow(self, id: str) -> None:
       """
@@ -89,17 +183,52 @@ class ChatSessionWrapper:
             return
       raise ValueError(f'No flow with id {id} exists')
 
-   async def __send_message_safe(self, message: str) -> str | None:
+   async def __send_message_safe(self, message: str,
+                                 generation: int) -> str | None:
       """
       Exception-safe wrapper for send_message so asyncio doesn't crash!
       """
+      # Record the task before the first await, so it can be cancelled from
+      # the moment the message starts
+      with self.__state_lock:
+         if generation != self.__generation:
+            return 'Request cancelled'
+         self.__task = asyncio.current_task()
+         self.__loop = asyncio.get_running_loop()
       try:
          await self.session.start_flow(message, self.selected_flow)
+      except asyncio.CancelledError:
+         return 'Request cancelled'
       except Exception as e:
          # FIXME: Better error messages
          return f'Error {type(e)}: {e}'
+      finally:
+         with self.__state_lock:
+            self.__task = None
+            self.__loop = None
       return None
 
+def _serialize_metrics(completion: lp.ChatCompletion) -> dict:
+   """
+   Serializes the timings of a completion and each of its steps.
+   """
+   return {
+      **asdict(completion.metrics),
+      'steps': [{
+         **asdict(step.metrics),
+         'tokens_per_second': step.metrics.tokens_per_second
+      } for step in completion.steps]
+   }
+
+def _partial_response(completion: lp.ChatCompletion) -> str:
+   """
+   Returns the final response streamed so far for an in-flight completion.
+   """
+   for step in reversed(completion.steps):
+      if step.is_final_context and step.response_buffer is not None:
+         return step.response_buffer.text
+   return ''
+
 def _find_flow_name_by_id(id: str | None) -> str | None:
    """
    Finds a flow by its id.
@@ -109,14 +238,39 @@ def _find_flow_name_by_id(id: str | None) -> str | None:
          return flow.name
    return None
 
+def _session_log(sessionid: str) -> lp.SessionLog:
+   """
+   Gets the on-disk log of a session by its id.
+   """
+   # The id comes from a cookie, so make sure it can't escape session_dir
+   sessionid = str(UUID(sessionid))
+   return lp.SessionLog(os.path.join(session_dir, f'{sessionid}.jsonl'))
+
+def _evict_idle_sessions() -> None:
+   """
+   Drops the idle sessions (see session_idle_timeout) from memory. Call with
+   the sessions lock held.
+   """
+   global global_sessions
+   for sessionid, session in list(global_sessions.items()):
+      if session.is_idle(session_idle_timeout):
+         del global_sessions[sessionid]
+
 def get_session(sessionid: str) -> ChatSessionWrapper:
    """
-   Gets a session by its id.
+   Gets a session by its id. Sessions that are not in memory (i.e., after a
+   restart, or once they were idle) are re-opened from their log.
    """
    global global_sessions
-   if sessionid not in global_sessions:
-      raise ValueError(f'No session with id {sessionid} exists')
-   return global_sessions[sessionid]
+   with global_sessions_lock:
+      _evict_idle_sessions()
+      if sessionid not in global_sessions:
+         if not session_exists(sessionid):
+            raise ValueError(f'No session with id {sessionid} exists')
+         global_sessions[sessionid] = ChatSessionWrapper(id=sessionid)
+      session = global_sessions[sessionid]
+      session.touch()
+   return session
 
 def session_exists(sessionid: str | None) -> bool:
    """
@@ -125,7 +279,12 @@ def session_exists(sessionid: str | None) -> bool:
    global global_sessions
    if sessionid is None:
       return False
-   return sessionid in global_sessions
+   if sessionid in global_sessions:
+      return True
+   try:
+      return _session_log(sessionid).exists()
+   except ValueError:
+      return False
 
 def new_session() -> ChatSessionWrapper:
    """
@@ -133,8 +292,10 @@ def new_session() -> ChatSessionWrapper:
    """
    global global_sessions
    sessionid = str(uuid4())
-   global_sessions[sessionid] = ChatSessionWrapper(id=sessionid)
-   return global_sessions[sessionid]
+   with global_sessions_lock:
+      _evict_idle_sessions()
+      global_sessions[sessionid] = ChatSessionWrapper(id=sessionid)
+      return global_sessions[sessionid]
 
 def get_flows() -> list[lp.FlowDescriptor]:
    """
@@ -13,6 +13,12 @@ class MessageAnnouncer:
       self.listeners.append(q)
       return q
 
+   def unlisten(self, q: Queue):
+      try:
+         self.listeners.remove(q)
+      except ValueError:
+         pass
+
    def announce(self, data: str, event=None):
       # We don't follow the event-stream spec here because we want to be able
       # to tell when an event happens but the client missed it. We do this by
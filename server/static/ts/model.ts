@@ -19,6 +19,29 @@ export type MessageStepT = {
    message: string;
 }
 
+/**
+ * The timings of a single message step, in seconds.
+ */
+export type StepMetricsT = {
+   name: string;
+   flow_time: number;
+   time_to_first_token: number | null;
+   queue_time: number;
+   stream_time: number;
+   chunks: number;
+   completion_tokens: number;
+   tokens_per_second: number;
+}
+
+/**
+ * The timings of a chat completion, in seconds.
+ */
+export type MetricsT = {
+   total_time: number;
+   time_to_first_token: number | null;
+   steps: StepMetricsT[];
+}
+
 /**
  * A single chat completion, which may contain multiple steps.
  */
@@ -28,6 +51,7 @@ export type MessageT = {
    children: MessageStepT[][];
    tag?: string | null;
    references?: ReferenceT[];
+   metrics?: MetricsT | null;
 }
 
 /**
@@ -33,6 +33,11 @@ function on_notify_final_response_start(_: any) {
    app.view.messageView.scrollToBottom();
 }
 
+function on_step_metrics(data: any) {
+   const metrics = JSON.parse(data);
+   console.debug(`Step "${metrics.name}" metrics`, metrics);
+}
+
 const event_src = new EventSource("/api/listen");
 
 /**
@@ -45,6 +50,7 @@ export function registerSSEHandlers() {
       'flow-step': on_flow_step,
       'vector-search': on_notify_search,
       'final-response-start': on_notify_final_response_start,
+      'step-metrics': on_step_metrics,
    }
    event_src.onmessage = (event) => {
       // Grab the event data and base64-decode it, then parse it as JSON
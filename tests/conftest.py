@@ -0,0 +1,43 @@
+import pytest
+
+def word_tokenizer(num_words: int = 256):
+   """
+   A BERT-like tokenizer (with [CLS] and [SEP]) over the words w0, w1, ...,
+   which needs no download.
+   """
+   from tokenizers import Tokenizer, models, pre_tokenizers, processors
+   from transformers import PreTrainedTokenizerFast
+   vocab = {'[PAD]': 0, '[UNK]': 1, '[CLS]': 2, '[SEP]': 3}
+   for i in range(num_words):
+      vocab[f'w{i}'] = len(vocab)
+   tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='[UNK]'))
+   tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+   tokenizer.post_processor = processors.TemplateProcessing(
+      single='[CLS] $A [SEP]', special_tokens=[('[CLS]', 2), ('[SEP]', 3)])
+   return PreTrainedTokenizerFast(
+      tokenizer_object=tokenizer, pad_token='[PAD]', unk_token='[UNK]',
+      cls_token='[CLS]', sep_token='[SEP]', model_max_length=512)
+
+def random_bert(hidden_size: int, num_words: int = 256):
+   """ A small BERT encoder with random weights. """
+   import torch, transformers
+   torch.manual_seed(0)
+   config = transformers.BertConfig(
+      vocab_size=num_words + 4, hidden_size=hidden_size,
+      num_hidden_layers=2, num_attention_heads=4, intermediate_size=128,
+      max_position_embeddings=512)
+   return transformers.BertModel(config).eval()
+
+@pytest.fixture
+def random_ember(monkeypatch):
+   """
+   Serves a random BERT (with the dimension of ember-v1) and a word
+   tokenizer as llmrails/ember-v1, with the embedding cache disabled.
+   """
+   pytest.importorskip('torch')
+   from lib._private import cache
+   name = 'llmrails/ember-v1'
+   monkeypatch.setitem(cache._model_cache, name, random_bert(1024))
+   monkeypatch.setitem(cache._tokenizer_cache, name, word_tokenizer())
+   monkeypatch.setenv('DUCKY_EMBEDDING_CACHE', '0')
+   return name
@@ -0,0 +1,63 @@
+import asyncio, threading
+import lib as lp
+from lib._private.chat import CachedChatProvider, CompletionCache
+
+class CountingProvider(lp.IChatProvider):
+   """ Streams a fixed response, counting the requests. """
+
+   def __init__(self):
+      self.requests = 0
+
+   async def fetch_response(self, request: lp.ChatContext):
+      self.requests += 1
+      for text in ['Hello', ', ', 'world']:
+         yield text, 1, 1
+
+   def total_request_tokens(self) -> int:
+      return 0
+
+   def total_completion_tokens(self) -> int:
+      return 0
+
+class ThreadRecordingCache(CompletionCache):
+   """ Records the threads that read and write the directory. """
+
+   def __init__(self, *args, **kwargs):
+      super().__init__(*args, **kwargs)
+      self.threads: list[int] = []
+
+   def get(self, key):
+      self.threads.append(threading.get_ident())
+      return super().get(key)
+
+   def put(self, key, chunks):
+      self.threads.append(threading.get_ident())
+      return super().put(key, chunks)
+
+def request() -> lp.ChatContext:
+   return lp.ChatContext(
+      provider=lp.resolve_provider('no-op'),
+      document=[lp.ChatItem(type='user', text='Hi')],
+      temperature=0,
+   )
+
+async def fetch(provider: CachedChatProvider) -> tuple[str, int]:
+   chunks = [x async for x, _, _ in provider.fetch_response(request())]
+   return ''.join(chunks), threading.get_ident()
+
+def test_directory_is_used_off_the_event_loop(tmp_path):
+   inner = CountingProvider()
+   cache = ThreadRecordingCache(str(tmp_path), prune_interval=1)
+   provider = CachedChatProvider(inner, cache)
+   text, loop_thread = asyncio.run(fetch(provider))
+   assert text == 'Hello, world'
+   # The miss read and the write (and its prune) ran in worker threads
+   assert len(cache.threads) == 2
+   assert loop_thread not in cache.threads
+   # A memory hit never touches the directory
+   assert asyncio.run(fetch(provider))[0] == 'Hello, world'
+   assert len(cache.threads) == 2
+   # A fresh cache on the same directory reads the entry back
+   provider = CachedChatProvider(inner, CompletionCache(str(tmp_path)))
+   assert asyncio.run(fetch(provider))[0] == 'Hello, world'
+   assert inner.requests == 1
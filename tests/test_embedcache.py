@@ -0,0 +1,68 @@
+import numpy as np
+
+import lib as lp
+
+DIMENSION = 4
+
+def vectors(*values: float) -> np.ndarray:
+   return np.array([[x] * DIMENSION for x in values], dtype=np.float32)
+
+def open_cache(directory, **kwargs) -> lp.EmbeddingCache:
+   return lp.EmbeddingCache(str(directory), 'model', DIMENSION, **kwargs)
+
+def lookup(cache: lp.EmbeddingCache, *texts: str) -> list[float | None]:
+   found = cache.get_many([cache.key('', x) for x in texts])
+   return [None if x is None else float(x[0]) for x in found]
+
+def put(cache: lp.EmbeddingCache, texts: list[str], values: np.ndarray):
+   cache.put_many([cache.key('', x) for x in texts], values)
+
+def test_torn_tail_is_dropped_on_open(tmp_path):
+   cache = open_cache(tmp_path)
+   put(cache, ['a', 'b', 'c'], vectors(1, 2, 3))
+   # A writer killed halfway through its vectors, with the keys unwritten
+   with open(tmp_path / 'vectors.f32', 'ab') as f:
+      f.write(vectors(4).tobytes()[:6])
+   reopened = open_cache(tmp_path)
+   assert len(reopened) == 3
+   assert lookup(reopened, 'a', 'b', 'c') == [1, 2, 3]
+   assert (tmp_path / 'vectors.f32').stat().st_size == 3 * DIMENSION * 4
+   # A writer killed after its vectors, halfway through its keys
+   put(reopened, ['d'], vectors(4))
+   with open(tmp_path / 'vectors.f32', 'ab') as f:
+      f.write(vectors(5).tobytes())
+   with open(tmp_path / 'keys.bin', 'ab') as f:
+      f.write(reopened.key('', 'e')[:7])
+   reopened = open_cache(tmp_path)
+   assert len(reopened) == 4
+   assert lookup(reopened, 'd', 'e') == [4, None]
+   # New rows start right after the last complete entry
+   put(reopened, ['f'], vectors(6))
+   assert lookup(open_cache(tmp_path), 'a', 'd', 'f') == [1, 4, 6]
+
+def test_instances_see_each_others_rows(tmp_path):
+   first, second = open_cache(tmp_path), open_cache(tmp_path)
+   put(first, ['a'], vectors(1))
+   put(second, ['b'], vectors(2))
+   put(first, ['c', 'b'], vectors(3, 20))
+   assert lookup(second, 'a', 'b', 'c') == [1, 2, 3]
+   assert lookup(first, 'a', 'b', 'c') == [1, 2, 3]
+   assert len(first) == len(second) == 3
+   assert lookup(open_cache(tmp_path), 'a', 'b', 'c') == [1, 2, 3]
+
+def test_duplicate_keys_in_one_put(tmp_path):
+   cache = open_cache(tmp_path)
+   put(cache, ['a', 'b', 'a', 'c'], vectors(1, 2, 1, 3))
+   assert len(cache) == 3
+   assert lookup(cache, 'a', 'b', 'c') == [1, 2, 3]
+   # The rows on disk line up with the keys too
+   assert lookup(open_cache(tmp_path), 'a', 'b', 'c') == [1, 2, 3]
+   assert (tmp_path / 'vectors.f32').stat().st_size == 3 * DIMENSION * 4
+
+def test_full_cache_stores_nothing_more(tmp_path):
+   cache = open_cache(tmp_path, max_entries=2)
+   put(cache, ['a', 'b', 'c'], vectors(1, 2, 3))
+   assert len(cache) == 2
+   # The vector that did not fit is still served from memory
+   assert lookup(cache, 'a', 'b', 'c') == [1, 2, 3]
+   assert lookup(open_cache(tmp_path), 'a', 'b', 'c') == [1, 2, None]
@@ -0,0 +1,45 @@
+import random
+import numpy as np
+import pytest
+
+import lib as lp
+
+def random_lengths(n: int, seed: int = 0) -> list[int]:
+   rng = random.Random(seed)
+   return [rng.choice([1, 3, 8, 40, 130, 512]) + rng.randrange(4)
+           for _ in range(n)]
+
+@pytest.mark.parametrize('max_tokens', [1, 64, 512, 4096])
+def test_bucket_by_length_respects_budget(max_tokens):
+   lengths = random_lengths(200)
+   batches = lp.bucket_by_length(lengths, max_tokens)
+   # Every input is in exactly one batch
+   assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+   for batch in batches:
+      padded = len(batch) * max(lengths[i] for i in batch)
+      assert padded <= max_tokens or len(batch) == 1
+
+def test_run_bucketed_restores_order():
+   lengths = random_lengths(100)
+   calls: list[list[int]] = []
+   def run(batch: list[int]) -> np.ndarray:
+      # A stub model: the vector of an input encodes its index and length
+      calls.append(batch)
+      return np.array([[i, lengths[i]] for i in batch], dtype=np.float32)
+   result = lp.run_bucketed(lengths, run, 1024, 2)
+   assert len(calls) > 1
+   assert result[:, 0].tolist() == list(range(len(lengths)))
+   assert result[:, 1].tolist() == lengths
+
+def test_embedder_matches_unbatched(random_ember):
+   from lib.embedders import EmberV1Embedder
+   rng = random.Random(0)
+   texts = [' '.join(f'w{rng.randrange(256)}'
+                     for _ in range(rng.choice([1, 5, 30, 120])))
+            for _ in range(24)]
+   embedder = EmberV1Embedder(max_batch_tokens=256)
+   vectors = embedder.run_model(texts)
+   assert vectors.shape == (len(texts), 1024)
+   for text, vector in zip(texts, vectors):
+      np.testing.assert_allclose(
+         vector, embedder.run_model([text])[0], atol=1e-5)
@@ -0,0 +1,109 @@
+import asyncio, threading
+import numpy as np
+import pytest
+
+import lib as lp
+
+class StubModel:
+   """
+   Embeds a text as its number (i.e., 'text 3' as [3, 3]), recording the
+   texts of every batch. Batches wait for the gate, if any.
+   """
+
+   def __init__(self, gate: threading.Event | None = None,
+                error: Exception | None = None):
+      self.gate = gate
+      self.error = error
+      self.batches: list[list[str]] = []
+      self.started = threading.Event()
+
+   def __call__(self, texts: list[str]) -> np.ndarray:
+      self.batches.append(texts)
+      self.started.set()
+      if self.gate is not None:
+         self.gate.wait(10)
+      if self.error is not None:
+         raise self.error
+      return np.array([[float(x.split()[1])] * 2 for x in texts])
+
+def texts(*numbers: int) -> list[str]:
+   return [f'text {i}' for i in numbers]
+
+def test_callers_on_separate_loops_share_a_batch():
+   model = StubModel()
+   service = lp.EmbeddingService(model, window=0.5)
+   inputs = [texts(0, 1), texts(2), texts(3, 4, 5), texts(6)]
+   results: list[np.ndarray | None] = [None] * len(inputs)
+   def caller(i: int):
+      results[i] = asyncio.run(service.embed(inputs[i]))
+   threads = [threading.Thread(target=caller, args=(i,))
+              for i in range(len(inputs))]
+   try:
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join(10)
+   finally:
+      service.close(10)
+   assert len(model.batches) == 1
+   # Every caller gets its own rows, in order
+   for x, result in zip(inputs, results):
+      assert result is not None
+      assert result[:, 0].tolist() == [float(t.split()[1]) for t in x]
+
+def test_batches_stop_at_max_batch_size():
+   model = StubModel()
+   service = lp.EmbeddingService(model, window=0.2, max_batch_size=4)
+   async def run():
+      return await asyncio.gather(
+         *[service.embed(texts(2 * i, 2 * i + 1)) for i in range(5)])
+   try:
+      results = asyncio.run(run())
+   finally:
+      service.close(10)
+   assert [len(x) for x in model.batches] == [4, 4, 2]
+   assert np.concatenate(results)[:, 0].tolist() == list(range(10))
+
+def test_errors_reach_every_caller():
+   model = StubModel(error=ValueError('model failed'))
+   service = lp.EmbeddingService(model, window=0.2)
+   async def run():
+      return await asyncio.gather(
+         *[service.embed(texts(i)) for i in range(3)],
+         return_exceptions=True)
+   try:
+      results = asyncio.run(run())
+   finally:
+      service.close(10)
+   assert len(model.batches) == 1
+   assert all(isinstance(x, ValueError) for x in results)
+
+def test_cancelled_callers_are_skipped():
+   gate = threading.Event()
+   model = StubModel(gate=gate)
+   service = lp.EmbeddingService(model, window=0.0)
+   async def run():
+      first = asyncio.create_task(service.embed(texts(0)))
+      # Wait for the worker to block on the first batch
+      await asyncio.to_thread(model.started.wait, 10)
+      cancelled = asyncio.create_task(service.embed(texts(1)))
+      await asyncio.sleep(0)
+      cancelled.cancel()
+      await asyncio.gather(cancelled, return_exceptions=True)
+      last = asyncio.create_task(service.embed(texts(2)))
+      await asyncio.sleep(0)
+      gate.set()
+      return await first, await last
+   try:
+      first, last = asyncio.run(run())
+   finally:
+      service.close(10)
+   assert model.batches == [texts(0), texts(2)]
+   assert first[:, 0].tolist() == [0.0] and last[:, 0].tolist() == [2.0]
+
+def test_close_fails_requests():
+   service = lp.EmbeddingService(StubModel())
+   assert asyncio.run(service.embed(texts(0))).shape == (1, 2)
+   service.close(10)
+   with pytest.raises(RuntimeError):
+      asyncio.run(service.embed(texts(1)))
@@ -0,0 +1,40 @@
+import lib as lp
+
+class SilentNotifier(lp.IChatNotifier):
+   def notify_assistant_message(self, message: str) -> None: pass
+   def notify_flow_step(self, name: str) -> None: pass
+   def notify_search(self, query: str) -> None: pass
+   def notify_final_response(self) -> None: pass
+
+def completion(query: str, response: str) -> lp.ChatCompletion:
+   return lp.ChatCompletion(
+      user_query=query, response=response, steps=[], flow_id=None)
+
+def roles(document: list[lp.ChatItem]) -> list[str]:
+   return [x.type for x in document]
+
+def test_turns_without_a_response_are_skipped():
+   history = lp.ChatHistory([
+      completion('first', 'one'),
+      # Cancelled before anything was answered
+      completion('second', ''),
+      completion('third', 'three'),
+      completion('current', ''),
+   ])
+   session = lp.ChatSession(notifier=SilentNotifier(), history=history)
+   window = lp.HistoryBudget(1000).window(session)
+   document = window.document()
+   assert [x.text for x in document] == \
+      ['first', 'one', 'third', 'three', 'current']
+   assert roles(document) == \
+      ['user', 'assistant', 'user', 'assistant', 'user']
+
+def test_summary_keeps_the_roles_alternating():
+   history = lp.ChatHistory([completion('question', 'answer ' * 40)])
+   history._add_completion(completion('current', ''))
+   session = lp.ChatSession(notifier=SilentNotifier(), history=history)
+   budget = lp.HistoryBudget(60, summarize=True)
+   window = budget.window(session)
+   assert window.needs_summary()
+   window.set_summary('The user asked a question.')
+   assert roles(window.document()) == ['user', 'assistant', 'user']
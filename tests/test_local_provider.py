@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+import lib as lp
+from lib._private.chat import local
+from lib._private.chat.local import LocalChatProvider
+
+EOS = 99
+
+class StubTokenizer:
+   """ Maps every character of the chat to a token, and back to '<id>'. """
+   eos_token_id = EOS
+
+   def apply_chat_template(self, messages, add_generation_prompt=True):
+      return [1 + ord(c) % 90 for m in messages for c in m['content']]
+
+   def decode(self, ids, skip_special_tokens=True):
+      return ''.join(f'<{i}>' for i in ids)
+
+class CacheObjectModel(torch.nn.Module):
+   """
+   Wraps a model so that it takes and returns Cache objects instead of the
+   legacy tuples, like newer versions of transformers do.
+   """
+
+   def __init__(self, model):
+      super().__init__()
+      self.model = model
+
+   def forward(self, past_key_values=None, **kwargs):
+      from transformers.cache_utils import DynamicCache
+      if past_key_values is not None:
+         assert isinstance(past_key_values, DynamicCache)
+         past_key_values = past_key_values.to_legacy_cache()
+      outputs = self.model(past_key_values=past_key_values, **kwargs)
+      outputs.past_key_values = DynamicCache.from_legacy_cache(
+         outputs.past_key_values)
+      return outputs
+
+def make_model():
+   torch.manual_seed(0)
+   config = transformers.GPT2Config(
+      n_layer=2, n_embd=32, n_head=2, vocab_size=100, n_positions=256)
+   return transformers.GPT2LMHeadModel(config).eval()
+
+def reference(model, tokenizer, text: str, max_tokens: int) -> str:
+   """ Greedy decoding of a single sequence, without any KV cache. """
+   ids = tokenizer.apply_chat_template([{'role': 'user', 'content': text}])
+   generated = []
+   with torch.no_grad():
+      for _ in range(max_tokens):
+         logits = model(input_ids=torch.tensor([ids + generated])).logits
+         token = int(torch.argmax(logits[0, -1]))
+         if token == EOS:
+            break
+         generated.append(token)
+   return tokenizer.decode(generated)
+
+def request(text: str, max_tokens: int) -> lp.ChatContext:
+   return lp.ChatContext(
+      provider=lp.resolve_provider('no-op'),
+      document=[lp.ChatItem(type='user', text=text)],
+      temperature=0,
+      max_tokens=max_tokens,
+   )
+
+async def generate(provider: LocalChatProvider, text: str,
+                   max_tokens: int) -> str:
+   chunks = [x async for x, _, _ in provider.fetch_response(
+      request(text, max_tokens))]
+   return ''.join(chunks)
+
+@pytest.mark.parametrize('cache_objects', [False, True])
+def test_batched_matches_sequential(monkeypatch, cache_objects):
+   model, tokenizer = make_model(), StubTokenizer()
+   served = CacheObjectModel(model) if cache_objects else model
+   monkeypatch.setattr(
+      local, 'load_causal_lm_and_tokenizer', lambda name: (served, tokenizer))
+   # More requests than fit in a batch, of different lengths, so sequences
+   # join and leave the batch while others are being decoded
+   prompts = [('hi', 12), ('a longer prompt', 5), ('x', 20),
+              ('medium one', 9), ('another long prompt here', 15)]
+   provider = LocalChatProvider(max_batch_size=3)
+   async def run():
+      return await asyncio.gather(
+         *[generate(provider, text, n) for text, n in prompts])
+   try:
+      results = asyncio.run(run())
+   finally:
+      provider.close()
+   for (text, n), result in zip(prompts, results):
+      assert result == reference(model, tokenizer, text, n)
+
+def test_close_fails_requests(monkeypatch):
+   model, tokenizer = make_model(), StubTokenizer()
+   monkeypatch.setattr(
+      local, 'load_causal_lm_and_tokenizer', lambda name: (model, tokenizer))
+   provider = LocalChatProvider()
+   assert asyncio.run(generate(provider, 'warm up', 2)) != ''
+   provider.close(timeout=10)
+   with pytest.raises(RuntimeError):
+      asyncio.run(generate(provider, 'too late', 2))
+
+class PartialCharTokenizer(StubTokenizer):
+   """
+   Decodes the tokens divisible by 3 as the first half of a character,
+   which comes out as '�' unless another token follows it.
+   """
+
+   def decode(self, ids, skip_special_tokens=True):
+      text = super().decode(ids, skip_special_tokens)
+      if len(ids) > 0 and ids[-1] % 3 == 0:
+         text = text[:-len(f'<{ids[-1]}>')] + '�'
+      return text
+
+def test_held_back_text_is_flushed(monkeypatch):
+   model, tokenizer = make_model(), PartialCharTokenizer()
+   monkeypatch.setattr(
+      local, 'load_causal_lm_and_tokenizer', lambda name: (model, tokenizer))
+   provider = LocalChatProvider(max_batch_size=4)
+   requests = [('hi', n) for n in range(1, 13)]
+   async def run():
+      return await asyncio.gather(
+         *[generate(provider, text, n) for text, n in requests])
+   try:
+      results = asyncio.run(run())
+   finally:
+      provider.close()
+   expected = [reference(model, tokenizer, text, n) for text, n in requests]
+   # Some responses end in the middle of a character
+   assert any(x.endswith('�') for x in expected)
+   assert results == expected
@@ -0,0 +1,28 @@
+import random
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from lib._private import cache, resolver
+
+@pytest.mark.parametrize('backend, min_cosine', [
+   ('onnx', 0.9999),
+   ('onnx-int8', 0.99),
+])
+def test_onnx_parity(random_ember, monkeypatch, tmp_path, backend,
+                     min_cosine):
+   from lib.embedders import EmberV1Embedder
+   monkeypatch.setattr(resolver, 'cache_dir', str(tmp_path))
+   monkeypatch.setattr(cache, '_onnx_cache', {})
+   rng = random.Random(0)
+   texts = [' '.join(f'w{rng.randrange(256)}'
+                     for _ in range(rng.choice([1, 5, 30, 120])))
+            for _ in range(16)]
+   reference = EmberV1Embedder(backend='torch').run_model(texts)
+   vectors = EmberV1Embedder(backend=backend).run_model(texts)
+   assert vectors.shape == reference.shape
+   # The vectors are normalized, so the dot product is the cosine
+   cosine = (vectors * reference).sum(axis=1)
+   assert cosine.min() >= min_cosine
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+
+import lib as lp
+
+def stub_run(texts: list[str]) -> np.ndarray:
+   """ A stub model: the vector of a text is its length and checksum. """
+   return np.array([[len(x), sum(map(ord, x)) % 997] for x in texts],
+                   dtype=np.float32)
+
+def load_stub():
+   return stub_run
+
+def load_failing():
+   def run(texts: list[str]) -> np.ndarray:
+      raise AssertionError(f'{len(texts)} texts were embedded again')
+   return run
+
+def corpus() -> list[str]:
+   texts = [f'text {i} ' * (i % 7 + 1) for i in range(50)]
+   # Repeated texts are embedded once
+   return texts + texts[:10]
+
+def test_only_cache_misses_are_embedded(tmp_path):
+   texts = corpus()
+   cache = lp.EmbeddingCache(str(tmp_path / 'cache'), 'stub', 2)
+   # Vectors the stub model would never give, so hits are recognizable
+   cached = texts[::3]
+   cache.put_many([cache.key('p:', x) for x in cached],
+                  np.full((len(cached), 2), -1, dtype=np.float32))
+   vectors = lp.embed_sharded(
+      texts, load_stub, 2, str(tmp_path / 'shards'), num_workers=2,
+      num_threads=1, shard_size=8, cache=cache, prefix='p:')
+   for text, vector in zip(texts, vectors):
+      expected = [-1, -1] if text in cached else stub_run(['p:' + text])[0]
+      assert vector.tolist() == list(expected)
+   # The parent added every miss to the cache, and wrote no shards
+   assert len(cache) == len(set(texts))
+   assert not os.path.exists(tmp_path / 'shards')
+   # Everything is cached now, so a rebuild never runs the model
+   again = lp.embed_sharded(
+      texts, load_failing, 2, str(tmp_path / 'shards'), num_workers=2,
+      num_threads=1, shard_size=8,
+      cache=lp.EmbeddingCache(str(tmp_path / 'cache'), 'stub', 2),
+      prefix='p:')
+   np.testing.assert_array_equal(again, vectors)
+
+def test_shards_resume_without_cache(tmp_path):
+   texts = corpus()
+   directory = str(tmp_path / 'shards')
+   vectors = lp.embed_sharded(
+      texts, load_stub, 2, directory, num_workers=2, num_threads=1,
+      shard_size=16, keep_shards=True)
+   np.testing.assert_array_equal(vectors, stub_run(texts))
+   assert len(os.listdir(directory)) == 4
+   # The kept shards are reused, then removed
+   again = lp.embed_sharded(
+      texts, load_failing, 2, directory, num_workers=2, num_threads=1,
+      shard_size=16)
+   np.testing.assert_array_equal(again, vectors)
+   assert os.listdir(directory) == []
+
+def test_embedders_open_the_cache_lazily(random_ember, monkeypatch):
+   from lib.embedders import emberv1
+   def fail(*args):
+      raise AssertionError('The embedding cache was opened')
+   monkeypatch.setattr(emberv1, 'get_embedding_cache', fail)
+   # Like the workers of embed_sharded, which import RiscVDoc (creating an
+   # embedder) and only run the model
+   embedder = emberv1.EmberV1Embedder()
+   assert embedder.run_model(['w1 w2']).shape == (1, 1024)
+   assert emberv1.EmberV1Embedder(cache=False).cache is None
@@ -0,0 +1,29 @@
+import asyncio
+import pytest
+
+import lib as lp
+from lib._private.chat import LATENCY_PROFILES, SimulatedChatProvider
+
+def request(profile: str) -> lp.ChatContext:
+   return lp.ChatContext(
+      provider=lp.resolve_provider('no-op'),
+      document=[lp.ChatItem(type='user', text='Hi')],
+      user_data={'latency_profile': profile},
+   )
+
+async def fetch(provider: SimulatedChatProvider, profile: str) -> str:
+   chunks = [x async for x, _, _ in provider.fetch_response(request(profile))]
+   return ''.join(chunks)
+
+def test_profile_by_name():
+   provider = SimulatedChatProvider(text='a b c')
+   assert provider.get_profile(request('gpt-4')) is LATENCY_PROFILES['gpt-4']
+   assert asyncio.run(fetch(provider, 'instant')) == 'a b c'
+
+def test_unknown_profile_lists_the_valid_names():
+   provider = SimulatedChatProvider(text='a b c')
+   with pytest.raises(ValueError) as e:
+      asyncio.run(fetch(provider, 'slow'))
+   assert 'slow' in str(e.value)
+   for name in LATENCY_PROFILES:
+      assert name in str(e.value)
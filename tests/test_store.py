@@ -0,0 +1,43 @@
+import lib as lp
+
+def completion(i: int) -> lp.ChatCompletion:
+   return lp.ChatCompletion(
+      user_query=f'question {i}',
+      response=f'answer {i}',
+      steps=[lp.ChatContext(
+         provider=lp.resolve_provider('no-op'),
+         document=[lp.ChatItem(type='user', text=f'question {i}')],
+      )],
+      flow_id='flow',
+   )
+
+def test_history_keeps_a_bounded_number_of_completions(tmp_path):
+   log = lp.SessionLog(str(tmp_path / 'session.jsonl'))
+   history = lp.PersistentChatHistory(log, max_loaded=4)
+   for i in range(10):
+      current = history._add_completion(completion(i))
+      # The flow sees the same object until it is committed
+      assert history._current_completion() is current
+      current.response = f'answer {i}'
+      history._commit_completion()
+   assert [x.response for x in history] == [f'answer {i}' for i in range(10)]
+   assert history[3].user_query == 'question 3'
+   assert history[-1].user_query == 'question 9'
+   # Only the offsets and the most recently used completions are kept
+   assert len(history._PersistentChatHistory__loaded) == 4
+   # A re-opened history reads the completions back from the log
+   reopened = lp.PersistentChatHistory(log)
+   assert len(reopened) == 10
+   assert [x.user_query for x in reopened] == \
+      [f'question {i}' for i in range(10)]
+
+def test_history_skips_a_torn_write(tmp_path):
+   log = lp.SessionLog(str(tmp_path / 'session.jsonl'))
+   history = lp.PersistentChatHistory(log)
+   history._add_completion(completion(0))
+   history._commit_completion()
+   with open(log.path, 'ab') as f:
+      f.write(b'{"user_query": "torn')
+   reopened = lp.PersistentChatHistory(log)
+   assert len(reopened) == 1
+   assert reopened[0].user_query == 'question 0'